@@ -0,0 +1,265 @@
+"""
+Mergin Maps DB Sync - a tool for two-way synchronization between Mergin Maps and a PostGIS database
+
+Copyright (C) 2024 Lutra Consulting
+
+License: MIT
+
+Generators of synthetic datasets (GeoPackage files and PostGIS schemas) used by the benchmarks.
+Each dataset has `tables` tables named `table_<i>` with `rows` polygons, each polygon having
+`vertices` vertices (which controls the geometry complexity).
+"""
+
+import math
+import random
+import sqlite3
+import struct
+
+import psycopg2.extensions
+from psycopg2 import sql
+
+SRS_ID = 4326
+SRS_WKT = (
+    'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],'
+    'PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433],AUTHORITY["EPSG","4326"]]'
+)
+
+# offsets of the rows edited in the database and in GeoPackage, so that the edits
+# on both sides do not touch the same rows (unless a conflict is wanted)
+DB_EDIT_OFFSET = 0
+GPKG_EDIT_OFFSET = 1
+
+
+def table_name(index: int) -> str:
+    return f"table_{index}"
+
+
+def polygon_coords(fid: int, vertices: int):
+    """Returns closed ring of a polygon approximating a circle - polygons are placed in a grid"""
+    cx = (fid % 1000) * 0.01
+    cy = (fid // 1000) * 0.01
+    radius = 0.004
+    coords = []
+    for i in range(vertices):
+        angle = 2 * math.pi * i / vertices
+        coords.append((cx + radius * math.cos(angle), cy + radius * math.sin(angle)))
+    coords.append(coords[0])
+    return coords
+
+
+def gpkg_polygon(coords) -> bytes:
+    """Encodes polygon as GeoPackage binary geometry (header with envelope + little endian WKB)"""
+    xs = [x for x, _ in coords]
+    ys = [y for _, y in coords]
+    # magic, version 0, flags: little endian with xy envelope
+    header = b"GP" + struct.pack("<BBi4d", 0, 0b00000011, SRS_ID, min(xs), max(xs), min(ys), max(ys))
+    wkb = struct.pack("<BIII", 1, 3, 1, len(coords)) + b"".join(struct.pack("<2d", x, y) for x, y in coords)
+    return header + wkb
+
+
+def edited_fids(rows: int, edit_rate: float, offset: int):
+    """Returns IDs of rows to be edited - evenly spread across the table"""
+    if edit_rate <= 0:
+        return []
+    step = max(2, round(1 / edit_rate))
+    return list(range(1 + offset, rows + 1, step))
+
+
+def create_gpkg(path: str, rows: int, tables: int = 1, vertices: int = 8) -> None:
+    """Creates a new GeoPackage with the synthetic dataset"""
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    cur.execute("PRAGMA application_id = 1196444487")  # 'GPKG'
+    cur.execute("PRAGMA user_version = 10200")
+    cur.execute(
+        "CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER NOT NULL PRIMARY KEY, "
+        "organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, "
+        "description TEXT)"
+    )
+    cur.executemany(
+        "INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            ("Undefined cartesian SRS", -1, "NONE", -1, "undefined", None),
+            ("Undefined geographic SRS", 0, "NONE", 0, "undefined", None),
+            ("WGS 84 geodetic", SRS_ID, "EPSG", SRS_ID, SRS_WKT, None),
+        ],
+    )
+    cur.execute(
+        "CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, "
+        "identifier TEXT UNIQUE, description TEXT DEFAULT '', "
+        "last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), "
+        "min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER, "
+        "CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id))"
+    )
+    cur.execute(
+        "CREATE TABLE gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL, "
+        "geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL, "
+        "CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name))"
+    )
+    for t in range(tables):
+        name = table_name(t)
+        cur.execute(
+            f'CREATE TABLE "{name}" (fid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, geometry POLYGON, '
+            "name TEXT, value INTEGER)"
+        )
+        cur.execute(
+            "INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) VALUES (?, 'features', ?, ?)",
+            (name, name, SRS_ID),
+        )
+        cur.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geometry', 'POLYGON', ?, 0, 0)", (name, SRS_ID))
+        cur.executemany(
+            f'INSERT INTO "{name}" (fid, geometry, name, value) VALUES (?, ?, ?, ?)',
+            ((fid, gpkg_polygon(polygon_coords(fid, vertices)), f"feature {fid}", fid) for fid in range(1, rows + 1)),
+        )
+    conn.commit()
+    conn.close()
+
+
+def edit_gpkg(path: str, rows: int, tables: int, edit_rate: float, vertices: int = 8, offset=GPKG_EDIT_OFFSET) -> int:
+    """Updates, inserts and deletes rows in the GeoPackage (as if edited in the field), returns number of edits"""
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    edits = 0
+    for t in range(tables):
+        name = table_name(t)
+        fids = edited_fids(rows, edit_rate, offset)
+        # 80% updates, 10% deletes, 10% inserts
+        deleted = fids[: len(fids) // 10]
+        updated = fids[len(fids) // 10 :]
+        cur.executemany(
+            f"UPDATE \"{name}\" SET value = value + 1, name = name || '*' WHERE fid = ?", ((f,) for f in updated)
+        )
+        cur.executemany(f'DELETE FROM "{name}" WHERE fid = ?', ((f,) for f in deleted))
+        cur.executemany(
+            f'INSERT INTO "{name}" (geometry, name, value) VALUES (?, ?, ?)',
+            ((gpkg_polygon(polygon_coords(f, vertices)), "new feature", f) for f in deleted),
+        )
+        edits += len(updated) + 2 * len(deleted)
+    conn.commit()
+    conn.close()
+    return edits
+
+
+def _split_edits(count: int):
+    """Splits number of edits to (updates, deletes, inserts) - 80% updates, 10% deletes, 10% inserts"""
+    deletes = count // 10
+    return count - 2 * deletes, deletes, deletes
+
+
+def edit_gpkg_rows(
+    path: str, table: str, count: int, parity: int, vertices: int = 8, rng: random.Random = random
+) -> int:
+    """Edits given number of randomly chosen rows (only those with fid % 2 == parity are updated or deleted,
+    so that edits from the database and GeoPackage do not conflict), returns number of edits"""
+    updates, deletes, inserts = _split_edits(count)
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    fids = [row[0] for row in cur.execute(f'SELECT fid FROM "{table}" WHERE fid % 2 = ?', (parity,))]
+    fids = rng.sample(fids, min(len(fids), updates + deletes))
+    cur.executemany(
+        f"UPDATE \"{table}\" SET value = value + 1, name = name || '*' WHERE fid = ?", ((f,) for f in fids[deletes:])
+    )
+    cur.executemany(f'DELETE FROM "{table}" WHERE fid = ?', ((f,) for f in fids[:deletes]))
+    cur.executemany(
+        f'INSERT INTO "{table}" (geometry, name, value) VALUES (?, ?, ?)',
+        ((gpkg_polygon(polygon_coords(rng.randrange(10**6), vertices)), "new feature", 0) for _ in range(inserts)),
+    )
+    conn.commit()
+    conn.close()
+    return len(fids) + inserts
+
+
+def edit_db_rows(
+    conn: psycopg2.extensions.connection, schema: str, table: str, count: int, parity: int, rng: random.Random = random
+) -> int:
+    """Same as edit_gpkg_rows() but for a table in the database schema"""
+    updates, deletes, inserts = _split_edits(count)
+    table = sql.Identifier(schema, table)
+    cur = conn.cursor()
+    cur.execute(sql.SQL("SELECT fid FROM {} WHERE fid % 2 = %s").format(table), (parity,))
+    fids = [row[0] for row in cur.fetchall()]
+    fids = rng.sample(fids, min(len(fids), updates + deletes))
+    if fids[deletes:]:
+        cur.execute(
+            sql.SQL("UPDATE {} SET value = value + 1, name = name || '*' WHERE fid = ANY(%s)").format(table),
+            (fids[deletes:],),
+        )
+    if fids[:deletes]:
+        cur.execute(sql.SQL("DELETE FROM {} WHERE fid = ANY(%s)").format(table), (fids[:deletes],))
+    if inserts:
+        cur.execute(
+            sql.SQL(
+                "INSERT INTO {} (geometry, name, value) "
+                "SELECT ST_Buffer(ST_SetSRID(ST_MakePoint(random() * 10, random() * 10), {}), 0.004, 2), "
+                "'new feature', 0 FROM generate_series(1, %s)"
+            ).format(table, sql.Literal(SRS_ID)),
+            (inserts,),
+        )
+    conn.commit()
+    return len(fids) + inserts
+
+
+def create_db_schema(
+    conn: psycopg2.extensions.connection, schema: str, rows: int, tables: int = 1, vertices: int = 8
+) -> None:
+    """Creates a new schema in the database with the synthetic dataset"""
+    cur = conn.cursor()
+    cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE").format(sql.Identifier(schema)))
+    cur.execute(sql.SQL("CREATE SCHEMA {}").format(sql.Identifier(schema)))
+    for t in range(tables):
+        table = sql.Identifier(schema, table_name(t))
+        cur.execute(
+            sql.SQL(
+                "CREATE TABLE {} (fid SERIAL PRIMARY KEY, geometry geometry(Polygon, {}), name TEXT, value INTEGER)"
+            ).format(table, sql.Literal(SRS_ID))
+        )
+        # buffer of a point with N segments per quarter circle has 4 * N + 1 vertices
+        cur.execute(
+            sql.SQL(
+                "INSERT INTO {} (fid, geometry, name, value) "
+                "SELECT i, ST_Buffer(ST_SetSRID(ST_MakePoint((i % 1000) * 0.01, (i / 1000) * 0.01), {}), "
+                "0.004, {}), 'feature ' || i, i FROM generate_series(1, %s) AS i"
+            ).format(table, sql.Literal(SRS_ID), sql.Literal(max(1, vertices // 4))),
+            (rows,),
+        )
+        cur.execute(
+            sql.SQL("SELECT setval(pg_get_serial_sequence(%s, 'fid'), %s)"),
+            (f'"{schema}"."{table_name(t)}"', rows),
+        )
+    conn.commit()
+
+
+def edit_db_schema(
+    conn: psycopg2.extensions.connection,
+    schema: str,
+    rows: int,
+    tables: int,
+    edit_rate: float,
+    offset=DB_EDIT_OFFSET,
+) -> int:
+    """Updates, inserts and deletes rows in the database schema (as if edited in the office), returns number of edits"""
+    cur = conn.cursor()
+    edits = 0
+    for t in range(tables):
+        table = sql.Identifier(schema, table_name(t))
+        fids = edited_fids(rows, edit_rate, offset)
+        # 80% updates, 10% deletes, 10% inserts
+        deleted = fids[: len(fids) // 10]
+        updated = fids[len(fids) // 10 :]
+        if updated:
+            cur.execute(
+                sql.SQL("UPDATE {} SET value = value + 1, name = name || '*' WHERE fid = ANY(%s)").format(table),
+                (updated,),
+            )
+        if deleted:
+            cur.execute(sql.SQL("DELETE FROM {} WHERE fid = ANY(%s)").format(table), (deleted,))
+            cur.execute(
+                sql.SQL(
+                    "INSERT INTO {} (geometry, name, value) "
+                    "SELECT ST_Translate(geometry, 0.001, 0.001), 'new feature', value FROM {} WHERE fid = ANY(%s)"
+                ).format(table, table),
+                (updated[: len(deleted)],),
+            )
+        edits += len(updated) + 2 * len(deleted)
+    conn.commit()
+    return edits
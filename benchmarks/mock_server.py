@@ -0,0 +1,579 @@
+"""
+Mergin Maps DB Sync - a tool for two-way synchronization between Mergin Maps and a PostGIS database
+
+Copyright (C) 2024 Lutra Consulting
+
+License: MIT
+
+Local stand-in for Mergin Maps server implementing the subset of the API used by DB Sync and
+its tests (login, project create/info/delete, projects by names, version history, download and
+pull of files and diffs, push of files and diffs). All data are kept in a temporary directory.
+
+Latency (added to each request) and bandwidth (applied to request and response bodies) can be
+injected, so that sync throughput can be measured deterministically without network access.
+
+Run from the root of the repository:
+
+    python -m benchmarks.mock_server --port 5000 --username test --password secret --latency 0.05
+"""
+
+import argparse
+import base64
+import copy
+import datetime
+import hashlib
+import http.server
+import json
+import logging
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+import pygeodiff
+from mergin.utils import generate_checksum, int_version
+
+SERVER_VERSION = "2025.1.0"
+
+
+class _HttpError(Exception):
+    def __init__(self, code: int, detail: str):
+        super().__init__(detail)
+        self.code = code
+        self.detail = detail
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def _public_file(meta: dict) -> dict:
+    """Returns file metadata without internal keys"""
+    return {key: value for key, value in meta.items() if key != "location"}
+
+
+class MockMerginServer:
+    """
+    Mergin Maps server stand-in running in a background thread.
+
+    :param users: dictionary of usernames and their passwords
+    :param latency: seconds added to the handling of each request
+    :param bandwidth: bytes per second for transfer of request and response bodies (None = unlimited)
+    :param token_expiry: seconds after which the auth tokens expire
+    """
+
+    def __init__(
+        self,
+        users: dict,
+        latency: float = 0.0,
+        bandwidth: float = None,
+        token_expiry: float = 12 * 3600,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.users = dict(users)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.token_expiry = token_expiry
+        self.host = host
+        self.port = port
+        self.projects = {}  # key = full project name, value = project dictionary
+        self.tokens = {}  # key = token, value = (username, expiration as datetime)
+        self.transactions = {}  # key = transaction ID, value = pending push
+        self.workspaces = {}  # key = namespace, value = workspace ID
+        self.request_count = 0
+        self._storage_dir = None
+        self._http_server = None
+        self._lock = threading.RLock()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/"
+
+    def start(self) -> "MockMerginServer":
+        self._storage_dir = tempfile.mkdtemp(prefix="dbsync-mock-server-")
+        self._http_server = http.server.ThreadingHTTPServer((self.host, self.port), _MockRequestHandler)
+        self._http_server.daemon_threads = True
+        self._http_server.mock = self
+        self.port = self._http_server.server_address[1]
+        thread = threading.Thread(target=self._http_server.serve_forever, name="mock-mergin-server", daemon=True)
+        thread.start()
+        logging.debug(f"Mock Mergin Maps server running on {self.url}")
+        return self
+
+    def stop(self) -> None:
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+            self._http_server = None
+        if self._storage_dir is not None:
+            shutil.rmtree(self._storage_dir, ignore_errors=True)
+            self._storage_dir = None
+
+    def delay(self, size: int = 0) -> None:
+        """Sleeps for the time it would take to transfer the given number of bytes"""
+        if self.bandwidth and size:
+            time.sleep(size / self.bandwidth)
+
+    # auth
+
+    def login(self, login: str, password: str) -> dict:
+        if self.users.get(login) != password:
+            raise _HttpError(401, "Invalid username or password")
+        expire = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.token_expiry)
+        # like the tokens of the real server, the payload can be decoded by the client (e.g. to use a stored token)
+        payload = json.dumps({"username": login, "expire": expire.isoformat()}).encode("utf-8")
+        token = base64.urlsafe_b64encode(payload).decode("ascii").rstrip("=") + "." + secrets.token_hex(16)
+        self.tokens[token] = (login, expire)
+        return {"username": login, "session": {"token": token, "expire": expire.isoformat()}}
+
+    def authenticate(self, header: str) -> str:
+        """Returns username for the Authorization header value"""
+        token = (header or "").replace("Bearer ", "", 1)
+        if token not in self.tokens:
+            raise _HttpError(401, "Authentication information is missing or invalid.")
+        username, expire = self.tokens[token]
+        if expire < datetime.datetime.now(datetime.timezone.utc):
+            raise _HttpError(401, "Token has expired.")
+        return username
+
+    def user_profile(self, username: str) -> dict:
+        return {"username": username, "email": f"{username}@example.com", "verified_email": True}
+
+    # projects
+
+    def _project(self, full_name: str) -> dict:
+        if full_name not in self.projects:
+            raise _HttpError(404, f"Project {full_name} not found")
+        return self.projects[full_name]
+
+    def _project_by_id(self, project_id: str) -> dict:
+        for project in self.projects.values():
+            if project["id"] == project_id:
+                return project
+        raise _HttpError(404, f"Project {project_id} not found")
+
+    def _blob_path(self, project: dict, location: str) -> str:
+        return os.path.join(self._storage_dir, project["id"], location)
+
+    def create_project(self, namespace: str, name: str) -> None:
+        with self._lock:
+            full_name = f"{namespace}/{name}"
+            if full_name in self.projects:
+                raise _HttpError(409, f"Project {full_name} already exists")
+            now = _now()
+            self.projects[full_name] = {
+                "id": str(uuid.uuid4()),
+                "name": name,
+                "namespace": namespace,
+                "workspace_id": self.workspaces.setdefault(namespace, len(self.workspaces) + 1),
+                "created": now,
+                "updated": now,
+                "versions": [],  # list of dictionaries with "name", "created", "author", "changes", "files"
+                "history": {},  # key = file path, value = {version: change record} since the file was added
+            }
+
+    def delete_project(self, project: dict) -> None:
+        with self._lock:
+            del self.projects[f"{project['namespace']}/{project['name']}"]
+            shutil.rmtree(self._blob_path(project, ""), ignore_errors=True)
+
+    def _version_files(self, project: dict, version: str) -> dict:
+        """Returns files of the project version (key = path, value = metadata)"""
+        if version == "v0":
+            return {}
+        for v in project["versions"]:
+            if v["name"] == version:
+                return v["files"]
+        raise _HttpError(404, f"Version {version} not found")
+
+    def project_info(self, project: dict, since: str = None, version: str = None) -> dict:
+        latest = project["versions"][-1]["name"] if project["versions"] else "v0"
+        version = version or latest
+        files = []
+        for path, meta in self._version_files(project, version).items():
+            info = _public_file(meta)
+            if since:
+                info["history"] = {
+                    v: record
+                    for v, record in project["history"].get(path, {}).items()
+                    if int_version(v) > int_version(since)
+                }
+            files.append(info)
+        return {
+            "id": project["id"],
+            "name": project["name"],
+            "namespace": project["namespace"],
+            "workspace_id": project["workspace_id"],
+            "version": version,
+            "files": files,
+            "created": project["created"],
+            "updated": project["updated"],
+            "disk_usage": sum(f["size"] for f in files),
+            "tags": [],
+            "access": {"public": False, "ownersnames": [], "writersnames": [], "readersnames": []},
+            "permissions": {"delete": True, "update": True, "upload": True},
+            "role": "owner",
+        }
+
+    def projects_by_names(self, names: list) -> dict:
+        result = {}
+        for name in names:
+            if name in self.projects:
+                info = self.project_info(self.projects[name])
+                del info["files"]
+                result[name] = info
+            else:
+                result[name] = {"error": 404}
+        return result
+
+    def project_versions(self, project: dict, page: int, per_page: int, descending: bool) -> dict:
+        versions = [{key: value for key, value in v.items() if key != "files"} for v in project["versions"]]
+        if descending:
+            versions.reverse()
+        start = (page - 1) * per_page
+        return {"versions": versions[start : start + per_page], "count": len(versions)}
+
+    def raw_file(self, project: dict, path: str, version: str, diff: bool) -> str:
+        """Returns path of the stored file (or its diff) at the given version"""
+        if diff:
+            record = project["history"].get(path, {}).get(version)
+            if record is None or "diff" not in record:
+                raise _HttpError(404, f"No diff of {path} at version {version}")
+            return self._blob_path(project, os.path.join("diffs", record["diff"]["path"]))
+        files = self._version_files(project, version)
+        if path not in files:
+            raise _HttpError(404, f"File {path} not found at version {version}")
+        return self._blob_path(project, files[path]["location"])
+
+    # push
+
+    def push_start(self, project: dict, username: str, data: dict) -> dict:
+        with self._lock:
+            latest = project["versions"][-1]["name"] if project["versions"] else "v0"
+            if data["version"] != latest:
+                raise _HttpError(409, f"Version mismatch, client cannot push to an outdated project ({latest})")
+            changes = data["changes"]
+            files = self._version_files(project, latest)
+            for f in changes["added"]:
+                if f["path"] in files:
+                    raise _HttpError(400, f"File {f['path']} already exists")
+            for f in changes["updated"] + changes["removed"]:
+                if f["path"] not in files:
+                    raise _HttpError(400, f"File {f['path']} does not exist")
+            for f in changes["updated"]:
+                if "diff" in f and files[f["path"]]["checksum"] != f["checksum"]:
+                    raise _HttpError(422, f"Diff of {f['path']} was not created from the latest version")
+            transaction = {
+                "id": str(uuid.uuid4()),
+                "project": project,
+                "username": username,
+                "changes": changes,
+                "chunks": {},  # key = chunk ID, value = path of the uploaded data
+            }
+            if not changes["added"] + changes["updated"]:
+                self._create_version(transaction)
+                return self.project_info(project)
+            transaction["dir"] = tempfile.mkdtemp(prefix="tx-", dir=self._storage_dir)
+            self.transactions[transaction["id"]] = transaction
+            return {"transaction": transaction["id"]}
+
+    def _transaction(self, transaction_id: str) -> dict:
+        if transaction_id not in self.transactions:
+            raise _HttpError(404, f"Transaction {transaction_id} not found")
+        return self.transactions[transaction_id]
+
+    def push_chunk(self, transaction_id: str, chunk_id: str, data: bytes) -> dict:
+        transaction = self._transaction(transaction_id)
+        chunk_path = os.path.join(transaction["dir"], chunk_id)
+        with open(chunk_path, "wb") as f:
+            f.write(data)
+        transaction["chunks"][chunk_id] = chunk_path
+        return {"checksum": hashlib.sha1(data).hexdigest(), "size": len(data)}
+
+    def push_cancel(self, transaction_id: str) -> None:
+        with self._lock:
+            transaction = self.transactions.pop(transaction_id, None)
+        if transaction is not None:
+            shutil.rmtree(transaction["dir"], ignore_errors=True)
+
+    def push_finish(self, transaction_id: str) -> dict:
+        with self._lock:
+            transaction = self._transaction(transaction_id)
+            try:
+                for f in transaction["changes"]["added"] + transaction["changes"]["updated"]:
+                    upload_path = os.path.join(transaction["dir"], "upload-" + str(uuid.uuid4()))
+                    with open(upload_path, "wb") as upload:
+                        for chunk_id in f["chunks"]:
+                            if chunk_id not in transaction["chunks"]:
+                                raise _HttpError(422, f"Missing chunk {chunk_id} of {f['path']}")
+                            with open(transaction["chunks"][chunk_id], "rb") as chunk:
+                                shutil.copyfileobj(chunk, upload)
+                    expected_checksum = f["diff"]["checksum"] if "diff" in f else f["checksum"]
+                    if generate_checksum(upload_path) != expected_checksum:
+                        raise _HttpError(422, f"Checksum of uploaded {f['path']} does not match")
+                    f["upload_path"] = upload_path
+                self._create_version(transaction)
+            finally:
+                self.push_cancel(transaction_id)
+            return self.project_info(transaction["project"])
+
+    def _create_version(self, transaction: dict) -> None:
+        """Stores uploaded files (applying uploaded diffs) as a new version of the project"""
+        project = transaction["project"]
+        changes = transaction["changes"]
+        previous_files = self._version_files(project, project["versions"][-1]["name"]) if project["versions"] else {}
+        files = copy.deepcopy(previous_files)
+        version = f"v{len(project['versions']) + 1}"
+
+        for f in changes["removed"]:
+            del files[f["path"]]
+            project["history"].pop(f["path"], None)
+
+        for f in changes["added"] + changes["updated"]:
+            path = f["path"]
+            location = os.path.join("files", version, path)
+            blob_path = self._blob_path(project, location)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            record = {"change": "updated" if path in files else "added"}
+            if "diff" in f:
+                diff_location = os.path.join("diffs", f["diff"]["path"])
+                diff_blob_path = self._blob_path(project, diff_location)
+                os.makedirs(os.path.dirname(diff_blob_path), exist_ok=True)
+                shutil.move(f["upload_path"], diff_blob_path)
+                shutil.copy(self._blob_path(project, previous_files[path]["location"]), blob_path)
+                try:
+                    pygeodiff.GeoDiff().apply_changeset(blob_path, diff_blob_path)
+                except pygeodiff.GeoDiffLibError as e:
+                    raise _HttpError(422, f"Failed to apply diff of {path}: {e}")
+                record["diff"] = {
+                    "path": f["diff"]["path"],
+                    "checksum": f["diff"]["checksum"],
+                    "size": f["diff"]["size"],
+                }
+            else:
+                shutil.move(f["upload_path"], blob_path)
+                if record["change"] == "added":
+                    project["history"][path] = {}
+            files[path] = {
+                "path": path,
+                "checksum": generate_checksum(blob_path),
+                "size": os.path.getsize(blob_path),
+                "mtime": _now(),
+                "location": location,
+            }
+            project["history"][path][version] = {**_public_file(files[path]), **record}
+
+        now = _now()
+        project["updated"] = now
+        project["versions"].append(
+            {
+                "name": version,
+                "created": now,
+                "author": transaction["username"],
+                "changes": {
+                    key: [{"path": f["path"]} for f in changes.get(key, [])]
+                    for key in ("added", "updated", "removed", "renamed")
+                },
+                "files": files,
+            }
+        )
+
+
+class _MockRequestHandler(http.server.BaseHTTPRequestHandler):
+    PROJECT = r"(?P<project>[^/]+/[^/]+)"
+
+    # (method, path pattern, handler name, whether authentication is required)
+    ROUTES = [
+        ("GET", r"/config", "_config", False),
+        ("POST", r"/v1/auth/login", "_login", False),
+        ("GET", r"/v1/user/profile", "_user_profile", True),
+        ("GET", r"/v1/project/raw/" + PROJECT, "_raw", True),
+        ("GET", r"/v1/project/versions/paginated/" + PROJECT, "_versions", True),
+        ("GET", r"/v1/project/by_uuid/(?P<project_id>[^/]+)", "_info_by_id", True),
+        ("GET", r"/v1/project/" + PROJECT, "_info", True),
+        ("POST", r"/v1/project/by_names", "_by_names", True),
+        ("POST", r"/v1/project/push/chunk/(?P<transaction>[^/]+)/(?P<chunk>[^/]+)", "_push_chunk", True),
+        ("POST", r"/v1/project/push/finish/(?P<transaction>[^/]+)", "_push_finish", True),
+        ("POST", r"/v1/project/push/cancel/(?P<transaction>[^/]+)", "_push_cancel", True),
+        ("POST", r"/v1/project/push/" + PROJECT, "_push", True),
+        ("POST", r"/v1/project/(?P<namespace>[^/]+)", "_create", True),
+        ("DELETE", r"/v2/projects/(?P<project_id>[^/]+)", "_delete_by_id", True),
+        ("DELETE", r"/v1/project/" + PROJECT, "_delete", True),
+    ]
+
+    @property
+    def mock(self) -> MockMerginServer:
+        return self.server.mock
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def log_message(self, format, *args):
+        logging.debug("Mock Mergin Maps server: " + format % args)
+
+    def _dispatch(self, method: str) -> None:
+        with self.mock._lock:
+            self.mock.request_count += 1
+        if self.mock.latency:
+            time.sleep(self.mock.latency)
+        url = urllib.parse.urlsplit(self.path)
+        path = "/" + urllib.parse.unquote(url.path).lstrip("/")
+        self.query = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length", 0))
+        self.body = self.rfile.read(length) if length else b""
+        self.mock.delay(len(self.body))
+        try:
+            for route_method, pattern, handler, auth_required in self.ROUTES:
+                match = re.fullmatch(pattern, path)
+                if route_method == method and match:
+                    self.username = self.mock.authenticate(self.headers.get("Authorization")) if auth_required else None
+                    getattr(self, handler)(**match.groupdict())
+                    return
+            raise _HttpError(404, f"Not found: {method} {path}")
+        except _HttpError as e:
+            self._send_json({"detail": e.detail}, e.code)
+
+    def _send(self, body: bytes, code: int = 200, content_type: str = "application/json", headers: dict = None):
+        self.mock.delay(len(body))
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data, code: int = 200) -> None:
+        self._send(json.dumps(data).encode("utf-8"), code)
+
+    def _json_body(self):
+        return json.loads(self.body.decode("utf-8"))
+
+    def _config(self):
+        self._send_json({"version": SERVER_VERSION, "server_type": "ce"})
+
+    def _login(self):
+        data = self._json_body()
+        self._send_json(self.mock.login(data.get("login"), data.get("password")))
+
+    def _user_profile(self):
+        self._send_json(self.mock.user_profile(self.username))
+
+    def _info(self, project):
+        info = self.mock.project_info(self.mock._project(project), self.query.get("since"), self.query.get("version"))
+        self._send_json(info)
+
+    def _info_by_id(self, project_id):
+        info = self.mock.project_info(
+            self.mock._project_by_id(project_id), self.query.get("since"), self.query.get("version")
+        )
+        self._send_json(info)
+
+    def _by_names(self):
+        self._send_json(self.mock.projects_by_names(self._json_body()["projects"]))
+
+    def _versions(self, project):
+        self._send_json(
+            self.mock.project_versions(
+                self.mock._project(project),
+                int(self.query.get("page", 1)),
+                int(self.query.get("per_page", 100)),
+                self.query.get("descending") == "True",
+            )
+        )
+
+    def _raw(self, project):
+        file_path = self.mock.raw_file(
+            self.mock._project(project),
+            self.query["file"],
+            self.query["version"],
+            self.query.get("diff") == "True",
+        )
+        with open(file_path, "rb") as f:
+            data = f.read()
+        range_match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if range_match is None:
+            self._send(data, content_type="application/octet-stream")
+            return
+        start = int(range_match.group(1))
+        end = int(range_match.group(2)) if range_match.group(2) else len(data) - 1
+        self._send(
+            data[start : end + 1],
+            206,
+            "application/octet-stream",
+            {"Content-Range": f"bytes {start}-{min(end, len(data) - 1)}/{len(data)}"},
+        )
+
+    def _create(self, namespace):
+        self.mock.create_project(namespace, self._json_body()["name"])
+        self._send_json({})
+
+    def _delete(self, project):
+        self.mock.delete_project(self.mock._project(project))
+        self._send_json({})
+
+    def _delete_by_id(self, project_id):
+        self.mock.delete_project(self.mock._project_by_id(project_id))
+        self._send(b"", 204)
+
+    def _push(self, project):
+        self._send_json(self.mock.push_start(self.mock._project(project), self.username, self._json_body()))
+
+    def _push_chunk(self, transaction, chunk):
+        self._send_json(self.mock.push_chunk(transaction, chunk, self.body))
+
+    def _push_finish(self, transaction):
+        self._send_json(self.mock.push_finish(transaction))
+
+    def _push_cancel(self, transaction):
+        self.mock.push_cancel(transaction)
+        self._send_json({})
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="mock_server.py",
+        description="Local stand-in for Mergin Maps server for offline tests and benchmarks.",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=5000, help="Port to listen on.")
+    parser.add_argument("--username", default=os.environ.get("TEST_API_USERNAME", "test"))
+    parser.add_argument("--password", default=os.environ.get("TEST_API_PASSWORD", "test"))
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to each request.")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Transfer speed in bytes per second.")
+    parser.add_argument("--token-expiry", type=float, default=12 * 3600, help="Expiration of auth tokens (seconds).")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    server = MockMerginServer(
+        {args.username: args.password},
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        token_expiry=args.token_expiry,
+        host=args.host,
+        port=args.port,
+    ).start()
+    logging.info(f"Mock Mergin Maps server running on {server.url} (press Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Mergin Maps DB Sync - a tool for two-way synchronization between Mergin Maps and a PostGIS database
+
+Copyright (C) 2024 Lutra Consulting
+
+License: MIT
+
+Benchmarks of DB Sync operations (init, push, pull with and without rebase, status, dataset
+comparison) on synthetic datasets of various sizes. Needs a Mergin Maps server and a PostGIS
+database, results are written as JSON so that they can be compared between releases.
+
+Run from the root of the repository:
+
+    python -m benchmarks.run_benchmarks --rows 1000 10000 --output results.json
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import psycopg2
+from mergin import ClientError, MerginClient
+
+import dbsync
+import timing_functions
+from config import config
+from version import __version__
+
+from . import dataset
+from .mock_server import MockMerginServer
+
+SYNC_FILE = "benchmark.gpkg"
+
+
+def _measure(results: list, operation: str, params: dict, func, *args, **kwargs):
+    """Runs the function and stores its wall time together with time spent in individual phases"""
+    timing_functions.start_cycle()
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    wall_time = time.perf_counter() - start
+
+    phases = {}
+    for record in timing_functions.records:
+        phase = phases.setdefault(record["phase"], {"wall_time": 0.0, "cpu_time": 0.0, "count": 0})
+        phase["wall_time"] += record["wall_time"]
+        phase["cpu_time"] += record["cpu_time"]
+        phase["count"] += 1
+
+    result = {**params, "operation": operation, "wall_time": wall_time, "phases": phases}
+    results.append(result)
+    logging.info(f"{operation:20} rows={params['rows']:<10} tables={params['tables']:<4} {wall_time:.3f}s")
+    return result
+
+
+def _geodiff_version() -> str:
+    try:
+        res = subprocess.run([config.geodiff_exe, "version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return res.stdout.decode().strip()
+    except FileNotFoundError:
+        return ""
+
+
+def _setup_project(mc: MerginClient, full_project_name: str, project_dir: str, gpkg_path: str = None) -> None:
+    """(Re)creates Mergin Maps project, optionally with the GeoPackage as the sync file"""
+    try:
+        mc.delete_project_now(full_project_name)
+    except ClientError:
+        pass
+    if os.path.exists(project_dir):
+        shutil.rmtree(project_dir)
+    mc.create_project(full_project_name)
+    mc.download_project(full_project_name, project_dir)
+    if gpkg_path:
+        shutil.copy(gpkg_path, os.path.join(project_dir, SYNC_FILE))
+        mc.push_project(project_dir)
+
+
+def run_benchmark(mc: MerginClient, args, rows: int, results: list) -> None:
+    params = {
+        "rows": rows,
+        "tables": args.tables,
+        "vertices": args.vertices,
+        "edit_rate": args.edit_rate,
+        "init_from": args.init_from,
+    }
+    project_name = f"dbsync_benchmark_{rows}_{args.tables}"
+    full_project_name = f"{args.workspace}/{project_name}"
+    work_dir = os.path.join(args.work_dir, f"{project_name}_dbsync")
+    project_dir = os.path.join(args.work_dir, f"{project_name}_work")  # "field" copy of the project
+    schema_modified = f"{project_name}_main"
+    schema_base = f"{project_name}_base"
+
+    conn = psycopg2.connect(args.db_conninfo)
+    dbsync._drop_schema(conn, schema_base)
+    dbsync._drop_schema(conn, schema_modified)
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+
+    if args.init_from == "gpkg":
+        gpkg_path = os.path.join(args.work_dir, f"{project_name}.gpkg")
+        dataset.create_gpkg(gpkg_path, rows, args.tables, args.vertices)
+        _setup_project(mc, full_project_name, project_dir, gpkg_path)
+    else:
+        dataset.create_db_schema(conn, schema_modified, rows, args.tables, args.vertices)
+        _setup_project(mc, full_project_name, project_dir)
+
+    conn_cfg = {
+        "driver": "postgres",
+        "conn_info": args.db_conninfo,
+        "modified": schema_modified,
+        "base": schema_base,
+        "mergin_project": full_project_name,
+        "sync_file": SYNC_FILE,
+    }
+    config.update({"WORKING_DIR": work_dir, "CONNECTIONS": [conn_cfg], "init_from": args.init_from})
+    conn_cfg = config.connections[0]
+    dbsync_project_dir = os.path.join(work_dir, project_name)
+
+    _measure(results, "init", params, dbsync.init, conn_cfg, mc, from_gpkg=args.init_from == "gpkg")
+    mc.pull_project(project_dir)
+
+    for _ in range(args.repeat):
+        # DB -> Mergin Maps
+        dataset.edit_db_schema(conn, schema_modified, rows, args.tables, args.edit_rate)
+        _measure(results, "push", params, dbsync.push, conn_cfg, mc)
+        mc.pull_project(project_dir)
+
+        # Mergin Maps -> DB
+        dataset.edit_gpkg(os.path.join(project_dir, SYNC_FILE), rows, args.tables, args.edit_rate, args.vertices)
+        mc.push_project(project_dir)
+        _measure(results, "pull", params, dbsync.pull, conn_cfg, mc)
+
+        # concurrent changes on both sides
+        dataset.edit_db_schema(conn, schema_modified, rows, args.tables, args.edit_rate)
+        dataset.edit_gpkg(os.path.join(project_dir, SYNC_FILE), rows, args.tables, args.edit_rate, args.vertices)
+        mc.push_project(project_dir)
+        _measure(results, "pull_rebase", params, dbsync.pull, conn_cfg, mc)
+        dbsync.push(conn_cfg, mc)
+        mc.pull_project(project_dir)
+
+        dataset.edit_db_schema(conn, schema_modified, rows, args.tables, args.edit_rate)
+        _measure(results, "status", params, dbsync.status, conn_cfg, mc)
+        _measure(
+            results,
+            "compare_datasets",
+            params,
+            dbsync._compare_datasets,
+            "sqlite",
+            "",
+            os.path.join(dbsync_project_dir, SYNC_FILE),
+            conn_cfg.driver,
+            conn_cfg.conn_info,
+            conn_cfg.modified,
+            [],
+        )
+        dbsync.push(conn_cfg, mc)
+        mc.pull_project(project_dir)
+
+    if not args.keep:
+        dbsync._forget_mergin_project(dbsync_project_dir)
+        dbsync._drop_schema(conn, schema_base)
+        dbsync._drop_schema(conn, schema_modified)
+        mc.delete_project_now(full_project_name)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        shutil.rmtree(project_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="run_benchmarks.py",
+        description="Benchmarks of DB Sync operations on synthetic datasets.",
+    )
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000], help="Numbers of rows per table.")
+    parser.add_argument("--tables", type=int, default=1, help="Number of tables.")
+    parser.add_argument("--vertices", type=int, default=8, help="Number of vertices of each polygon.")
+    parser.add_argument("--edit-rate", type=float, default=0.01, help="Fraction of rows edited between syncs.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of repetitions of push/pull/status.")
+    parser.add_argument("--init-from", choices=["gpkg", "db"], default="gpkg", help="How to initialize the sync.")
+    parser.add_argument("--output", default="benchmark-results.json", help="File to write results to (JSON).")
+    parser.add_argument("--work-dir", default=None, help="Directory for temporary files.")
+    parser.add_argument("--keep", action="store_true", help="Keep projects, schemas and files after the run.")
+    parser.add_argument(
+        "--url",
+        default=os.environ.get("TEST_MERGIN_URL"),
+        help="Mergin Maps server URL, or 'mock' to use a local stand-in of the server.",
+    )
+    parser.add_argument("--mock-latency", type=float, default=0.0, help="Latency of mock server requests (seconds).")
+    parser.add_argument("--mock-bandwidth", type=float, default=None, help="Bandwidth of mock server (bytes/s).")
+    parser.add_argument("--username", default=os.environ.get("TEST_API_USERNAME"))
+    parser.add_argument("--password", default=os.environ.get("TEST_API_PASSWORD"))
+    parser.add_argument("--workspace", default=os.environ.get("TEST_API_WORKSPACE"))
+    parser.add_argument("--db-conninfo", default=os.environ.get("TEST_DB_CONNINFO"))
+    parser.add_argument("--geodiff-exe", default=os.environ.get("TEST_GEODIFF_EXE", config.geodiff_exe))
+    args = parser.parse_args()
+
+    # INFO level so that the output is not flooded with debug messages of DB Sync
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if not (args.url and args.username and args.password and args.workspace and args.db_conninfo):
+        parser.error("Mergin Maps server, credentials, workspace and database connection must be set")
+    if args.work_dir is None:
+        args.work_dir = tempfile.mkdtemp(prefix="dbsync-benchmark-")
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    mock_server = None
+    server_info = {"url": args.url}
+    if args.url == "mock":
+        mock_server = MockMerginServer(
+            {args.username: args.password}, latency=args.mock_latency, bandwidth=args.mock_bandwidth
+        ).start()
+        args.url = mock_server.url
+        server_info.update({"latency": args.mock_latency, "bandwidth": args.mock_bandwidth})
+
+    config.update(
+        {
+            "GEODIFF_EXE": args.geodiff_exe,
+            "MERGIN__URL": args.url,
+            "MERGIN__USERNAME": args.username,
+            "MERGIN__PASSWORD": args.password,
+        }
+    )
+    mc = MerginClient(args.url, login=args.username, password=args.password)
+
+    results = []
+    try:
+        for rows in args.rows:
+            run_benchmark(mc, args, rows, results)
+    finally:
+        if mock_server is not None:
+            mock_server.stop()
+
+    output = {
+        "dbsync_version": __version__,
+        "geodiff_version": _geodiff_version(),
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "server": server_info,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    logging.info(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Mergin Maps DB Sync - a tool for two-way synchronization between Mergin Maps and a PostGIS database
+
+Copyright (C) 2024 Lutra Consulting
+
+License: MIT
+"""
+
+import hashlib
+import mmap
+import os
+import shutil
+import typing
+
+# Changesets produced by geodiff use the binary format of SQLite session extension:
+# - table header: 'T', number of columns (varint), one primary key flag byte per column, table name (nul-terminated)
+# - change: operation byte, "indirect" flag byte, values (old + new values for updates)
+# - value: type byte followed by the data (8 bytes for integers and floats, varint length + bytes for text and blobs)
+TABLE_MARKER = ord("T")
+OP_INSERT = 18
+OP_UPDATE = 23
+OP_DELETE = 9
+_VALUE_UNDEFINED, _VALUE_INT, _VALUE_DOUBLE, _VALUE_TEXT, _VALUE_BLOB, _VALUE_NULL = range(6)
+
+
+class ChangesetFormatError(Exception):
+    pass
+
+
+def _read_varint(data: bytes, pos: int) -> typing.Tuple[int, int]:
+    """Returns value of SQLite varint at the position and the position after it"""
+    value = 0
+    for i in range(9):
+        if pos >= len(data):
+            raise ChangesetFormatError("Unexpected end of changeset")
+        byte = data[pos]
+        pos += 1
+        if i == 8:
+            return (value << 8) | byte, pos
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, pos
+
+
+def _skip_value(data: bytes, pos: int) -> int:
+    if pos >= len(data):
+        raise ChangesetFormatError("Unexpected end of changeset")
+    value_type = data[pos]
+    pos += 1
+    if value_type in (_VALUE_INT, _VALUE_DOUBLE):
+        pos += 8
+    elif value_type in (_VALUE_TEXT, _VALUE_BLOB):
+        size, pos = _read_varint(data, pos)
+        pos += size
+    elif value_type not in (_VALUE_UNDEFINED, _VALUE_NULL):
+        raise ChangesetFormatError(f"Unknown value type {value_type}")
+    return pos
+
+
+def read_changes(data) -> typing.Iterator[typing.Tuple[bytes, bytes]]:
+    """Yields (table header, change) pairs with raw bytes of each change in the changeset"""
+    pos = 0
+    header = None
+    columns = 0
+    while pos < len(data):
+        if data[pos] == TABLE_MARKER:
+            start = pos
+            columns, pos = _read_varint(data, pos + 1)
+            pos = data.find(b"\0", pos + columns) + 1
+            if pos == 0:
+                raise ChangesetFormatError("Unexpected end of changeset")
+            header = data[start:pos]
+            continue
+        if header is None:
+            raise ChangesetFormatError("Change without table header")
+        start = pos
+        operation = data[pos]
+        if operation not in (OP_INSERT, OP_UPDATE, OP_DELETE):
+            raise ChangesetFormatError(f"Unknown operation {operation}")
+        pos += 2
+        for _ in range(columns * 2 if operation == OP_UPDATE else columns):
+            pos = _skip_value(data, pos)
+        yield header, data[start:pos]
+
+
+def split_changeset(changeset: str, output_dir: str, max_rows: int = None, max_bytes: int = None) -> typing.List[str]:
+    """
+    Splits the changeset into chunks with at most `max_rows` changes and `max_bytes` bytes (approximately - a chunk
+    has always at least one change), keeping the order of changes. Applying the chunks one by one gives the same
+    result as applying the whole changeset. Returns paths of the chunks written to the output directory.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    chunks = []
+    content = []
+    rows = size = 0
+    current_header = None
+
+    def write_chunk():
+        path = os.path.join(output_dir, f"chunk-{len(chunks):04d}")
+        with open(path, "wb") as f:
+            f.write(b"".join(content))
+        chunks.append(path)
+
+    if os.path.getsize(changeset) == 0:
+        return chunks
+
+    # the changeset may be too big to be read to memory at once
+    with open(changeset, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for header, change in read_changes(data):
+            if rows and (
+                (max_rows and rows >= max_rows) or (max_bytes and size + len(change) + len(header) > max_bytes)
+            ):
+                write_chunk()
+                content, rows, size, current_header = [], 0, 0, None
+            if header is not current_header:
+                content.append(header)
+                size += len(header)
+                current_header = header
+            content.append(change)
+            rows += 1
+            size += len(change)
+    if rows:
+        write_chunk()
+    return chunks
+
+
+def concat_changesets(changesets: typing.List[str], output: str) -> None:
+    """Writes changes of all the changesets to the output changeset - the changesets must not have changes
+    of the same rows (e.g. each of them has changes of different tables)"""
+    with open(output, "wb") as out:
+        for changeset in changesets:
+            with open(changeset, "rb") as f:
+                shutil.copyfileobj(f, out)
+
+
+def changeset_digest(changeset: str) -> str:
+    """
+    Returns digest of the changes in the changeset which does not depend on the order of tables in it
+    (e.g. when concatenated from changesets of groups of tables which may change between diffs)
+    """
+    table_digests = {}
+    if os.path.getsize(changeset) == 0:
+        return hashlib.sha1().hexdigest()
+    with open(changeset, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for header, change in read_changes(data):
+            if header not in table_digests:
+                table_digests[header] = hashlib.sha1(header)
+            table_digests[header].update(change)
+    digest = hashlib.sha1()
+    for header in sorted(table_digests):
+        digest.update(table_digests[header].digest())
+    return digest.hexdigest()
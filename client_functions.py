@@ -0,0 +1,147 @@
+"""
+Mergin Maps DB Sync - a tool for two-way synchronization between Mergin Maps and a PostGIS database
+
+Copyright (C) 2024 Lutra Consulting
+
+License: MIT
+"""
+
+import datetime
+import json
+import logging
+import os
+import threading
+import typing
+
+from dynaconf import Dynaconf
+from mergin import MerginClient
+
+# the auth token gets refreshed when it expires in less than this many seconds
+TOKEN_REFRESH_MARGIN = 3600
+# delay (in seconds) before another attempt to refresh the token if it failed
+TOKEN_RETRY_DELAY = 60
+
+
+class MerginClientManager:
+    """
+    Provides a single MerginClient shared by all threads of the daemon and keeps its auth token valid.
+
+    The token gets refreshed in background before it expires, independently of sync cycles (which may keep failing
+    for longer than the token is valid). If `token_file` is set in the `mergin` section of the config, the token
+    is stored there, so that a restarted daemon does not need to log in again.
+    """
+
+    def __init__(
+        self,
+        config: Dynaconf,
+        create_client: typing.Callable[..., MerginClient],
+        refresh_margin: float = TOKEN_REFRESH_MARGIN,
+    ):
+        self.config = config
+        self.create_client = create_client  # called with `auth_token` argument to use a stored token
+        self.refresh_margin = refresh_margin
+        self.token_file = config.mergin.get("token_file", None)
+        self._client = None
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def client(self) -> MerginClient:
+        """Returns the client (logs in on the first call)"""
+        with self._lock:
+            if self._client is None:
+                self._client = self._create_client()
+                self._store_token()
+                self._schedule_refresh()
+            return self._client
+
+    def close(self) -> None:
+        """Stops refreshing the token"""
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+
+    def _create_client(self) -> MerginClient:
+        token = self._load_token()
+        if token:
+            try:
+                mc = self.create_client(auth_token=token)
+                # make sure the token was not revoked in the meantime
+                mc.user_info()
+                logging.debug("Using stored Mergin Maps auth token.")
+                return mc
+            except Exception as e:
+                logging.debug(f"Unable to use stored Mergin Maps auth token, logging in: {e}")
+        return self.create_client()
+
+    def _seconds_to_expire(self) -> float:
+        expire = self._client._auth_session["expire"]
+        return (expire - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+
+    def _schedule_refresh(self, delay: float = None) -> None:
+        if delay is None:
+            # tokens valid for a shorter time than the margin get refreshed in half of their validity
+            remaining = self._seconds_to_expire()
+            delay = max(remaining - self.refresh_margin, remaining / 2, 0)
+        self._timer = threading.Timer(delay, self._refresh)
+        self._timer.name = "token-refresh"
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh(self) -> None:
+        with self._lock:
+            if self._timer is None:
+                return  # closed
+        # log in with a separate client, so that other threads can keep using the shared one in the meantime
+        try:
+            session = self.create_client()._auth_session
+        except Exception as e:
+            with self._lock:
+                if self._timer is not None:
+                    logging.warning(f"Unable to refresh Mergin Maps auth token: {e}")
+                    self._schedule_refresh(TOKEN_RETRY_DELAY)
+            return
+        with self._lock:
+            if self._timer is None:
+                return  # closed in the meantime
+            self._client._auth_session = session
+            logging.debug("Mergin Maps auth token refreshed.")
+            self._store_token()
+            self._schedule_refresh()
+
+    def _load_token(self) -> typing.Optional[str]:
+        """Returns the stored token if it was issued for the configured server and user and does not expire soon"""
+        if not self.token_file or not os.path.exists(self.token_file):
+            return None
+        try:
+            with open(self.token_file, "r") as f:
+                stored = json.load(f)
+            expire = datetime.datetime.fromisoformat(stored["expire"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.debug(f"Unable to read stored Mergin Maps auth token: {e}")
+            return None
+        if (stored.get("url"), stored.get("username")) != (self.config.mergin.url, self.config.mergin.username):
+            return None
+        if (expire - datetime.datetime.now(datetime.timezone.utc)).total_seconds() < self.refresh_margin:
+            return None
+        return stored["token"]
+
+    def _store_token(self) -> None:
+        """Writes the token to the token file (readable by the owner only)"""
+        if not self.token_file:
+            return
+        session = self._client._auth_session
+        stored = {
+            "url": self.config.mergin.url,
+            "username": self.config.mergin.username,
+            "token": session["token"],
+            "expire": session["expire"].isoformat(),
+        }
+        tmp_file = f"{self.token_file}.tmp"
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(stored, f)
+            os.replace(tmp_file, self.token_file)
+        except OSError as e:
+            logging.warning(f"Unable to store Mergin Maps auth token: {e}")
@@ -8,8 +8,8 @@ License: MIT
 
 import pathlib
 import platform
+import shutil
 import smtplib
-import subprocess
 import tempfile
 
 from dynaconf import Dynaconf
@@ -29,27 +29,52 @@ class ConfigError(Exception):
     pass
 
 
-def validate_config(config):
-    """Validate config - make sure values are consistent"""
+def validate_config(config, check_smtp: bool = True):
+    """Validate config - make sure values are consistent. Connection to the SMTP server (which may be slow)
+    is not checked when `check_smtp` is false, check_smtp_server() can be used to check it later."""
 
     # validate that geodiff can be found, otherwise it does not make sense to run DB Sync
-    try:
-        subprocess.run(
-            [
-                config.geodiff_exe,
-                "help",
-            ],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-    except FileNotFoundError:
+    if shutil.which(config.geodiff_exe) is None:
         raise ConfigError(
             "Config error: Geodiff executable not found. Is it installed and available in `PATH` environment variable?"
         )
 
+    if "geodiff_log_level" in config:
+        if (
+            isinstance(config.geodiff_log_level, bool)
+            or not isinstance(config.geodiff_log_level, int)
+            or not 0 <= config.geodiff_log_level <= 4
+        ):
+            raise ConfigError("Config error: `geodiff_log_level` must be set to a number between 0 and 4.")
+
     if not (config.mergin.url and config.mergin.username and config.mergin.password):
         raise ConfigError("Config error: Incorrect mergin settings")
 
+    if "download_workers" in config.mergin:
+        if (
+            isinstance(config.mergin.download_workers, bool)
+            or not isinstance(config.mergin.download_workers, int)
+            or config.mergin.download_workers < 1
+        ):
+            raise ConfigError("Config error: `download_workers` must be set to a positive integer.")
+
+    if "project_cache_size" in config.mergin:
+        if (
+            isinstance(config.mergin.project_cache_size, bool)
+            or not isinstance(config.mergin.project_cache_size, int)
+            or config.mergin.project_cache_size < 1
+        ):
+            raise ConfigError("Config error: `project_cache_size` must be set to a positive integer.")
+
+    if "project_id_check_interval" in config.mergin:
+        interval = config.mergin.project_id_check_interval
+        if isinstance(interval, bool) or not isinstance(interval, (int, float)):
+            raise ConfigError("Config error: `project_id_check_interval` must be set to a number.")
+
+    if "token_file" in config.mergin:
+        if not isinstance(config.mergin.token_file, str):
+            raise ConfigError("Config error: `token_file` must be set to a path.")
+
     if not (config.connections and len(config.connections)):
         raise ConfigError("Config error: Connections list can not be empty")
 
@@ -89,6 +114,36 @@ def validate_config(config):
                 "Config error: Name of the Mergin Maps project should be provided in the namespace/name format."
             )
 
+        if "measure_latency" in conn:
+            if not isinstance(conn.measure_latency, bool):
+                raise ConfigError("Config error: `measure_latency` must be set to either `true` or `false`.")
+
+        if "change_source" in conn:
+            if conn.change_source not in ("diff", "logical"):
+                raise ConfigError("Config error: `change_source` must be set to either `diff` or `logical`.")
+
+        if "skip_unchanged_tables" in conn:
+            if not isinstance(conn.skip_unchanged_tables, bool):
+                raise ConfigError("Config error: `skip_unchanged_tables` must be set to either `true` or `false`.")
+
+        for setting in (
+            "push_quiet_time",
+            "push_max_delay",
+            "geodiff_timeout",
+            "server_timeout",
+            "full_compare_interval",
+        ):
+            if setting in conn:
+                value = conn[setting]
+                if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                    raise ConfigError(f"Config error: `{setting}` must be a non-negative number of seconds.")
+
+        for setting in ("push_chunk_rows", "push_chunk_bytes", "diff_jobs"):
+            if setting in conn:
+                value = conn[setting]
+                if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+                    raise ConfigError(f"Config error: `{setting}` must be a positive integer.")
+
         if "skip_tables" in conn:
             if conn.skip_tables is None:
                 continue
@@ -103,6 +158,63 @@ def validate_config(config):
             ):
                 raise ConfigError("Config error: Ignored tables parameter should be a list")
 
+    if "daemon" in config:
+        if "metrics_port" in config.daemon:
+            if (
+                isinstance(config.daemon.metrics_port, bool)
+                or not isinstance(config.daemon.metrics_port, int)
+                or not 0 <= config.daemon.metrics_port <= 65535
+            ):
+                raise ConfigError("Config error: `metrics_port` must be set to a valid port number.")
+
+        if "metrics_host" in config.daemon:
+            if not isinstance(config.daemon.metrics_host, str):
+                raise ConfigError("Config error: `metrics_host` must be set to a host name or an IP address.")
+
+        if "control_port" in config.daemon:
+            if (
+                isinstance(config.daemon.control_port, bool)
+                or not isinstance(config.daemon.control_port, int)
+                or not 0 <= config.daemon.control_port <= 65535
+            ):
+                raise ConfigError("Config error: `control_port` must be set to a valid port number.")
+
+        if "control_host" in config.daemon:
+            if not isinstance(config.daemon.control_host, str):
+                raise ConfigError("Config error: `control_host` must be set to a host name or an IP address.")
+
+        if "coordination" in config.daemon:
+            if not isinstance(config.daemon.coordination, bool):
+                raise ConfigError("Config error: `coordination` must be set to either `true` or `false`.")
+
+        if "lock_policy" in config.daemon:
+            if config.daemon.lock_policy not in ("wait", "skip"):
+                raise ConfigError("Config error: `lock_policy` must be set to either `wait` or `skip`.")
+
+        if "lock_timeout" in config.daemon:
+            if (
+                isinstance(config.daemon.lock_timeout, bool)
+                or not isinstance(config.daemon.lock_timeout, (int, float))
+                or config.daemon.lock_timeout < 0
+            ):
+                raise ConfigError("Config error: `lock_timeout` must be a non-negative number of seconds.")
+
+        if "init_workers" in config.daemon:
+            if (
+                isinstance(config.daemon.init_workers, bool)
+                or not isinstance(config.daemon.init_workers, int)
+                or config.daemon.init_workers < 1
+            ):
+                raise ConfigError("Config error: `init_workers` must be set to a positive integer.")
+
+        if "shutdown_timeout" in config.daemon:
+            if (
+                isinstance(config.daemon.shutdown_timeout, bool)
+                or not isinstance(config.daemon.shutdown_timeout, (int, float))
+                or config.daemon.shutdown_timeout < 0
+            ):
+                raise ConfigError("Config error: `shutdown_timeout` must be a non-negative number of seconds.")
+
     if "notification" in config:
         settings = [
             "smtp_server",
@@ -134,14 +246,28 @@ def validate_config(config):
             if not isinstance(config.notification.minimal_email_interval, (int, float)):
                 raise ConfigError("Config error: `minimal_email_interval` must be set to a number.")
 
-        try:
-            smtp_conn = create_connection_and_log_user(config)
-            smtp_conn.quit()
-        except (OSError, smtplib.SMTPConnectError, smtplib.SMTPAuthenticationError) as e:
-            err = str(e)
-            if isinstance(e, (smtplib.SMTPConnectError, smtplib.SMTPAuthenticationError)):
-                err = str(e.smtp_error)
-            raise ConfigError(f"Config SMTP Error: {err}.")
+        if "smtp_timeout" in config.notification:
+            if (
+                isinstance(config.notification.smtp_timeout, bool)
+                or not isinstance(config.notification.smtp_timeout, (int, float))
+                or config.notification.smtp_timeout <= 0
+            ):
+                raise ConfigError("Config error: `smtp_timeout` must be set to a positive number.")
+
+        if check_smtp:
+            check_smtp_server(config)
+
+
+def check_smtp_server(config):
+    """Checks that it is possible to connect and log in to the SMTP server of notifications"""
+    try:
+        smtp_conn = create_connection_and_log_user(config)
+        smtp_conn.quit()
+    except (OSError, smtplib.SMTPConnectError, smtplib.SMTPAuthenticationError) as e:
+        err = str(e)
+        if isinstance(e, (smtplib.SMTPConnectError, smtplib.SMTPAuthenticationError)):
+            err = str(e.smtp_error)
+        raise ConfigError(f"Config SMTP Error: {err}.")
 
 
 def get_ignored_tables(
@@ -0,0 +1,154 @@
+"""
+Mergin Maps DB Sync - a tool for two-way synchronization between Mergin Maps and a PostGIS database
+
+Copyright (C) 2024 Lutra Consulting
+
+License: MIT
+"""
+
+import http.server
+import json
+import logging
+import threading
+import time
+import typing
+import urllib.parse
+
+import metrics_functions
+from version import __version__
+
+# Operations that can be requested on demand and what they run
+OPERATIONS = {
+    "sync": ("pull", "push"),
+    "pull": ("pull",),
+    "push": ("push",),
+}
+
+
+class SyncScheduler:
+    """
+    Keeps on-demand sync requests for the daemon loop, which waits for them instead of sleeping.
+
+    Requests for the same connection and operation are merged while they are pending: a burst
+    of requests, or requests made while a cycle is running, results in a single run right after
+    the current cycle.
+    """
+
+    def __init__(self, connections: typing.List[str]):
+        self.connections = list(connections)
+        self._pending = {}  # key = project name of the connection, value = set of operations to run
+        self._condition = threading.Condition()
+        self._state = "syncing"
+        self._cycle_started = time.time()
+        self._next_cycle = None
+        self._stopped = False
+
+    def request(self, operation: str, connection: str = None) -> dict:
+        """
+        Requests running of the operation ("sync", "pull" or "push") for the connection (all connections if None).
+        Returns project names of connections that got queued and of those merged with already pending requests.
+        Raises KeyError if the connection is not known.
+        """
+        if connection is not None and connection not in self.connections:
+            raise KeyError(connection)
+        result = {"queued": [], "coalesced": []}
+        with self._condition:
+            for name in self.connections if connection is None else [connection]:
+                pending = self._pending.setdefault(name, set())
+                if pending.issuperset(OPERATIONS[operation]):
+                    result["coalesced"].append(name)
+                else:
+                    pending.update(OPERATIONS[operation])
+                    result["queued"].append(name)
+            self._condition.notify_all()
+        logging.debug(f"On-demand {operation} requested: {result}")
+        return result
+
+    def wait(self, timeout: float) -> typing.Dict[str, typing.Set[str]]:
+        """
+        Waits at most `timeout` seconds for on-demand requests and returns them (empty dict if there were none)
+        as a dictionary with project names as keys and sets of operations to run as values.
+        """
+        with self._condition:
+            self._state = "sleeping"
+            self._next_cycle = time.time() + max(timeout, 0)
+            self._condition.wait_for(lambda: self._pending or self._stopped, max(timeout, 0))
+            if self._stopped:
+                self._state = "stopping"
+                return {}
+            requests, self._pending = self._pending, {}
+            self._state = "syncing"
+            self._cycle_started = time.time()
+            self._next_cycle = None
+        return requests
+
+    def stop(self) -> None:
+        """Wakes up the waiting daemon loop and makes any further wait() return immediately, used on shutdown"""
+        with self._condition:
+            self._stopped = True
+            self._state = "stopping"
+            self._condition.notify_all()
+
+    def status(self) -> dict:
+        """Returns state of the daemon and of its connections"""
+        with self._condition:
+            status = {
+                "version": __version__,
+                "state": self._state,
+                "cycle_started": self._cycle_started if self._state == "syncing" else None,
+                "next_cycle": self._next_cycle,
+                "pending": {name: sorted(operations) for name, operations in self._pending.items()},
+            }
+        status["connections"] = {
+            name: {
+                "last_pull": metrics_functions.LAST_SUCCESS.value(connection=name, operation="pull"),
+                "last_push": metrics_functions.LAST_SUCCESS.value(connection=name, operation="push"),
+                "errors": metrics_functions.ERRORS.value(connection=name, operation="pull")
+                + metrics_functions.ERRORS.value(connection=name, operation="push"),
+            }
+            for name in self.connections
+        }
+        return status
+
+
+class _ControlRequestHandler(http.server.BaseHTTPRequestHandler):
+    def _send_json(self, code: int, data: dict) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path != "/status":
+            self._send_json(404, {"error": "Not found"})
+            return
+        self._send_json(200, self.server.scheduler.status())
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        operation = url.path.strip("/")
+        if operation not in OPERATIONS:
+            self._send_json(404, {"error": "Not found"})
+            return
+        connection = urllib.parse.parse_qs(url.query).get("connection", [None])[0]
+        try:
+            result = self.server.scheduler.request(operation, connection)
+        except KeyError:
+            self._send_json(404, {"error": f"Unknown connection: {connection}"})
+            return
+        self._send_json(202, result)
+
+    def log_message(self, format, *args):
+        logging.debug("Control server: " + format % args)
+
+
+def start_http_server(scheduler: SyncScheduler, port: int, host: str = "127.0.0.1") -> http.server.ThreadingHTTPServer:
+    """Starts serving the control API for the scheduler on http://host:port in a background thread"""
+    server = http.server.ThreadingHTTPServer((host, port), _ControlRequestHandler)
+    server.scheduler = scheduler
+    thread = threading.Thread(target=server.serve_forever, name="control-server", daemon=True)
+    thread.start()
+    logging.debug(f"Serving control API on http://{host}:{server.server_address[1]}")
+    return server
@@ -6,14 +6,21 @@ Copyright (C) 2020 Lutra Consulting
 License: MIT
 """
 
+import collections
+import concurrent.futures
+import contextlib
+import datetime
 import getpass
 import json
+import math
 import os
 import shutil
-import string
+import socket
 import subprocess
 import tempfile
-import random
+import threading
+import time
+import typing
 import uuid
 import re
 import pathlib
@@ -35,6 +42,16 @@ from mergin import (
     ClientError,
     InvalidProject,
 )
+from mergin.common import (
+    CHUNK_SIZE,
+)
+from mergin.client_pull import (
+    DownloadQueueItem,
+    UpdateTask,
+)
+from mergin.utils import (
+    int_version,
+)
 from version import (
     __version__,
 )
@@ -44,13 +61,51 @@ from config import (
     get_ignored_tables,
     ConfigError,
 )
-
-# set high logging level for geodiff (used by geodiff executable)
-# so we get as much information as possible
-os.environ["GEODIFF_LOGGER_LEVEL"] = "4"  # 0 = nothing, 1 = errors, 2 = warning, 3 = info, 4 = debug
+import timing_functions
+import metrics_functions
+import profiling_functions
+import lock_functions
+import changeset_functions
+
+# default logging level of geodiff executable (`geodiff_log_level` setting) - high, so we get as much information
+# as possible: 0 = nothing, 1 = errors, 2 = warning, 3 = info, 4 = debug
+DEFAULT_GEODIFF_LOG_LEVEL = 4
+# used by geodiff of mergin-client in this process (updated from the setting in create_mergin_client())
+os.environ["GEODIFF_LOGGER_LEVEL"] = str(DEFAULT_GEODIFF_LOG_LEVEL)
+
+# at most this many bytes of output of a geodiff call get logged (errors are logged always)
+GEODIFF_LOG_LIMIT = 64 * 1024
+
+# logging levels of lines of geodiff output by their prefix
+GEODIFF_LOG_PREFIXES = {
+    "Error:": logging.ERROR,
+    "Warn:": logging.WARNING,
+    "Warning:": logging.WARNING,
+    "Info:": logging.INFO,
+    "Debug:": logging.DEBUG,
+}
 
 FORCE_INIT_MESSAGE = "Running `dbsync_deamon.py` with `--force-init` should fix the issue."
 
+# how long a geodiff process gets to exit after SIGTERM before it gets killed
+GEODIFF_TERMINATE_TIMEOUT = 5
+
+# set on shutdown of the daemon - no further connections get processed
+stop_requested = threading.Event()
+
+# connection being processed in this thread (its time limits apply to geodiff calls) - see _time_limits()
+_current_operation = threading.local()
+
+# how long (in seconds) an operation waits for the lock of a connection held by another process (if `lock_timeout`
+# is not set)
+DEFAULT_LOCK_TIMEOUT = 600
+
+# how long database changes may wait for a quiet period before they get pushed anyway (if `push_max_delay` is not set)
+DEFAULT_PUSH_MAX_DELAY = 300
+
+# maximum number of commit timestamps of pushed rows observed in the push latency metric per push
+LATENCY_SAMPLES = 100
+
 
 class DbSyncError(Exception):
     default_print_password = "password='*****'"
@@ -74,6 +129,18 @@ class DbSyncError(Exception):
         super().__init__(message)
 
 
+class SyncErrors(DbSyncError):
+    """Errors of connections that failed (in pull or push of multiple connections)"""
+
+    def __init__(self, errors: typing.List[typing.Tuple[str, DbSyncError]]):
+        # list of (project name of the connection, error)
+        self.errors = errors
+        if len(errors) == 1:
+            super().__init__(str(errors[0][1]))
+        else:
+            super().__init__("\n\n".join(f"{name}: {error}" for name, error in errors))
+
+
 def _add_quotes_to_schema_name(
     schema: str,
 ) -> str:
@@ -176,20 +243,96 @@ def _check_has_password():
         )
 
 
+def _geodiff_log_level(line: str) -> typing.Optional[int]:
+    """Returns logging level of a line of geodiff output by its prefix (None for continuation lines)"""
+    for prefix, level in GEODIFF_LOG_PREFIXES.items():
+        if line.startswith(prefix):
+            return level
+    return None
+
+
+def _log_geodiff_output(stream, errors: list) -> None:
+    """Logs output of geodiff line by line (with severity of each line and up to GEODIFF_LOG_LIMIT bytes,
+    except errors) and collects error lines. Lines without a prefix continue the previous message."""
+    logged_size = skipped_size = 0
+    level = logging.DEBUG
+    for raw_line in stream:
+        line = raw_line.decode(errors="replace").rstrip()
+        if not line:
+            continue
+        level = _geodiff_log_level(line) or level
+        if level >= logging.ERROR:
+            errors.append(line)
+        elif logged_size + len(raw_line) > GEODIFF_LOG_LIMIT:
+            skipped_size += len(raw_line)
+            continue
+        else:
+            logged_size += len(raw_line)
+        logging.log(level, "GEODIFF: " + line)
+    if skipped_size:
+        logging.debug(f"GEODIFF: {skipped_size} more bytes of output not logged")
+
+
+def _terminate_process(proc: subprocess.Popen) -> None:
+    """Stops the process with SIGTERM, or with SIGKILL if it does not exit in time"""
+    proc.terminate()
+    try:
+        proc.wait(GEODIFF_TERMINATE_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def _terminate_db_sessions(conn_info, application_name) -> None:
+    """Terminates database sessions (and their running statements) with the given application name"""
+    try:
+        with contextlib.closing(psycopg2.connect(conn_info)) as conn:
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE application_name = %s",
+                (application_name,),
+            )
+    except psycopg2.Error as e:
+        logging.warning(f"Unable to terminate database sessions of geodiff: {e}")
+
+
+def _geodiff_logger_level() -> str:
+    """Returns value of GEODIFF_LOGGER_LEVEL environment variable for geodiff by `geodiff_log_level` setting"""
+    return str(config.get("geodiff_log_level", DEFAULT_GEODIFF_LOG_LEVEL))
+
+
 def _run_geodiff(
     cmd,
 ):
-    """will run a command (with geodiff) and report what got to stderr and raise exception
-    if the command returns non-zero exit code"""
-    res = subprocess.run(
-        cmd,
-        stderr=subprocess.PIPE,
-    )
-    geodiff_stderr = res.stderr.decode()
-    if geodiff_stderr:
-        logging.error("GEODIFF: " + geodiff_stderr)
-    if res.returncode != 0:
-        raise DbSyncError("geodiff failed!\n" + str(cmd))
+    """will run a command (with geodiff) and log its output and raise exception if the command returns non-zero
+    exit code or if it does not finish within `geodiff_timeout` of the connection being processed"""
+    env = dict(os.environ, GEODIFF_LOGGER_LEVEL=_geodiff_logger_level())
+    conn_cfg = getattr(_current_operation, "conn_cfg", None)
+    timeout = conn_cfg.get("geodiff_timeout", None) if conn_cfg is not None else None
+    if timeout:
+        # used by libpq in geodiff, so that its database sessions can be found if it needs to be stopped
+        env["PGAPPNAME"] = f"dbsync-geodiff-{uuid.uuid4().hex[:12]}"
+
+    errors = []
+    with timing_functions.span("geodiff " + cmd[1]):
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env) as proc:
+            reader = threading.Thread(target=_log_geodiff_output, args=(proc.stdout, errors), daemon=True)
+            reader.start()
+            try:
+                returncode = proc.wait(timeout or None)
+            except subprocess.TimeoutExpired:
+                _terminate_process(proc)
+                _terminate_db_sessions(conn_cfg.conn_info, env["PGAPPNAME"])
+                reader.join(GEODIFF_TERMINATE_TIMEOUT)
+                raise DbSyncError(f"geodiff did not finish within {timeout} seconds!\n" + str(cmd))
+            except BaseException:
+                # e.g. interrupted on shutdown - geodiff must not be left running
+                _terminate_process(proc)
+                raise
+            reader.join()
+    if returncode != 0:
+        raise DbSyncError("geodiff failed!\n" + str(cmd) + "".join("\n" + error for error in errors[-5:]))
 
 
 def _geodiff_create_changeset(
@@ -230,6 +373,90 @@ def _geodiff_create_changeset(
         )
 
 
+def _split_tables(table_sizes: dict, groups: int) -> list:
+    """Splits tables to the given number of groups with similar total size of their tables"""
+    result = [[] for _ in range(groups)]
+    totals = [0] * groups
+    for table, size in sorted(table_sizes.items(), key=lambda item: (-item[1], item[0])):
+        smallest = totals.index(min(totals))
+        result[smallest].append(table)
+        totals[smallest] += size
+    return result
+
+
+def _group_db_tables(schema_tables: list, ignored_tables, groups: int) -> list:
+    """
+    Splits tables of the base and the modified schema (as returned by _get_db_table_sizes() for each of them)
+    to at most the given number of groups with similar total size. Tables which exist only in one of the schemas
+    are included too and partitions end up in the same group as their partitioned table.
+    """
+    members = {}  # key = partitioned table (or table which is not a partition), value = set of its tables
+    sizes = {}
+    for tables in schema_tables:
+        schema_sizes = {}
+        for table, (size, root) in tables.items():
+            if table in ignored_tables:
+                continue
+            unit = root or table
+            members.setdefault(unit, set()).add(table)
+            schema_sizes[unit] = schema_sizes.get(unit, 0) + size
+        for unit, size in schema_sizes.items():
+            sizes[unit] = max(sizes.get(unit, 0), size)
+    if not sizes:
+        return []
+    return [
+        sorted(table for unit in group for table in members[unit])
+        for group in _split_tables(sizes, min(groups, len(sizes)))
+    ]
+
+
+def _geodiff_create_db_changeset(conn_cfg, changeset, ignored_tables):
+    """
+    Creates changeset with changes in the 'modified' schema against the base schema. With `diff_jobs` setting
+    of the connection greater than one, tables get split to groups compared by geodiff processes running
+    in parallel and their changesets get concatenated.
+    """
+    jobs = conn_cfg.get("diff_jobs", 1)
+    groups = []
+    if jobs > 1:
+        with contextlib.closing(psycopg2.connect(conn_cfg.conn_info)) as conn:
+            schema_tables = [_get_db_table_sizes(conn, schema) for schema in (conn_cfg.base, conn_cfg.modified)]
+        groups = _group_db_tables(schema_tables, ignored_tables, jobs)
+    if len(groups) <= 1:
+        _geodiff_create_changeset(
+            conn_cfg.driver, conn_cfg.conn_info, conn_cfg.base, conn_cfg.modified, changeset, ignored_tables
+        )
+        return
+
+    # each table gets compared by exactly one of the jobs, the others skip it
+    tables = [table for group in groups for table in group]
+    partial_changesets = [f"{changeset}-{i}" for i in range(len(groups))]
+    connection = timing_functions.current_connection()
+
+    def diff_group(group, partial_changeset):
+        _current_operation.conn_cfg = conn_cfg
+        with timing_functions.span("diff group", connection=connection):
+            _geodiff_create_changeset(
+                conn_cfg.driver,
+                conn_cfg.conn_info,
+                conn_cfg.base,
+                conn_cfg.modified,
+                partial_changeset,
+                list(ignored_tables) + [table for table in tables if table not in group],
+            )
+
+    logging.debug(f"Comparing {len(tables)} tables in {len(groups)} parallel jobs")
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            # raises the first error of the jobs (after all of them finish)
+            list(executor.map(diff_group, groups, partial_changesets))
+        changeset_functions.concat_changesets(partial_changesets, changeset)
+    finally:
+        for partial_changeset in partial_changesets:
+            if os.path.exists(partial_changeset):
+                os.remove(partial_changeset)
+
+
 def _geodiff_apply_changeset(
     driver,
     conn_info,
@@ -312,24 +539,21 @@ def _geodiff_list_changes_details(
     """Returns a list with changeset details:
     [ { 'table': 'foo', 'type': 'update', 'changes': [ ... old/new column values ... ] }, ... ]
     """
-    tmp_dir = tempfile.gettempdir()
-    tmp_output = os.path.join(
-        tmp_dir,
-        "dbsync-changeset-details",
-    )
-    if os.path.exists(tmp_output):
-        os.remove(tmp_output)
-    _run_geodiff(
-        [
-            config.geodiff_exe,
-            "as-json",
-            changeset,
-            tmp_output,
-        ]
-    )
-    with open(tmp_output) as f:
-        out = json.load(f)
-    os.remove(tmp_output)
+    with tempfile.TemporaryDirectory(prefix="dbsync-") as tmp_dir:
+        tmp_output = os.path.join(
+            tmp_dir,
+            "changeset-details",
+        )
+        _run_geodiff(
+            [
+                config.geodiff_exe,
+                "as-json",
+                changeset,
+                tmp_output,
+            ]
+        )
+        with open(tmp_output) as f:
+            out = json.load(f)
     return out["geodiff"]
 
 
@@ -339,24 +563,21 @@ def _geodiff_list_changes_summary(
     """Returns a list with changeset summary:
     [ { 'table': 'foo', 'insert': 1, 'update': 2, 'delete': 3 }, ... ]
     """
-    tmp_dir = tempfile.gettempdir()
-    tmp_output = os.path.join(
-        tmp_dir,
-        "dbsync-changeset-summary",
-    )
-    if os.path.exists(tmp_output):
-        os.remove(tmp_output)
-    _run_geodiff(
-        [
-            config.geodiff_exe,
-            "as-summary",
-            changeset,
-            tmp_output,
-        ]
-    )
-    with open(tmp_output) as f:
-        out = json.load(f)
-    os.remove(tmp_output)
+    with tempfile.TemporaryDirectory(prefix="dbsync-") as tmp_dir:
+        tmp_output = os.path.join(
+            tmp_dir,
+            "changeset-summary",
+        )
+        _run_geodiff(
+            [
+                config.geodiff_exe,
+                "as-summary",
+                changeset,
+                tmp_output,
+            ]
+        )
+        with open(tmp_output) as f:
+            out = json.load(f)
     return out["geodiff_summary"]
 
 
@@ -460,31 +681,26 @@ def _compare_datasets(
     summary_only=True,
 ):
     """Compare content of two datasets (from various drivers) and return geodiff JSON summary of changes"""
-    tmp_dir = tempfile.gettempdir()
-    tmp_changeset = os.path.join(
-        tmp_dir,
-        "".join(
-            random.choices(
-                string.ascii_letters,
-                k=8,
-            )
-        ),
-    )
+    with tempfile.TemporaryDirectory(prefix="dbsync-") as tmp_dir:
+        tmp_changeset = os.path.join(
+            tmp_dir,
+            "changeset",
+        )
 
-    _geodiff_create_changeset_dr(
-        src_driver,
-        src_conn_info,
-        src,
-        dst_driver,
-        dst_conn_info,
-        dst,
-        tmp_changeset,
-        ignored_tables,
-    )
-    if summary_only:
-        return _geodiff_list_changes_summary(tmp_changeset)
-    else:
-        return _geodiff_list_changes_details(tmp_changeset)
+        _geodiff_create_changeset_dr(
+            src_driver,
+            src_conn_info,
+            src,
+            dst_driver,
+            dst_conn_info,
+            dst,
+            tmp_changeset,
+            ignored_tables,
+        )
+        if summary_only:
+            return _geodiff_list_changes_summary(tmp_changeset)
+        else:
+            return _geodiff_list_changes_details(tmp_changeset)
 
 
 def _print_changes_summary(
@@ -520,9 +736,106 @@ def _print_mergin_changes(
         logging.debug("  removed: " + item["path"])
 
 
-# Dictionary used by _get_mergin_project() function below.
+# Ordered dictionary used by _get_mergin_project() function below as LRU cache (least recently used first).
 # key = path to a local dir with Mergin project, value = cached MerginProject object
-cached_mergin_project_objects = {}
+cached_mergin_project_objects = collections.OrderedDict()
+
+# key = path to a local dir with Mergin project, value = (mtime, size) of its metadata file when last read
+cached_mergin_project_metadata_stats = {}
+
+# guards the cache of MerginProject objects, which is used by multiple threads (e.g. init workers)
+mergin_projects_lock = threading.RLock()
+
+# key = path to a local dir with Mergin project, value = number of operations using its MerginProject object
+# (such objects do not get closed when evicted from the cache - see _use_mergin_project())
+mergin_project_users = collections.Counter()
+
+# MerginProject objects evicted from the cache while being used, to be closed when they are no longer used
+evicted_mergin_projects = {}
+
+# key = project name of a connection, value = statistics of tables in its 'modified' schema (see _get_db_table_stats())
+# from the last time when the schema had no changes against the base schema
+clean_table_stats = {}
+
+# key = project name of a connection, value = time (time.monotonic()) when the push compared all tables of the
+# 'modified' schema - statistics of tables are not reliable enough to skip the comparison of unchanged tables forever
+full_compare_times = {}
+
+# how often (in seconds) all tables get compared even if their statistics did not change (if `full_compare_interval`
+# of the connection is not set)
+DEFAULT_FULL_COMPARE_INTERVAL = 3600
+
+# project names of connections with the "logical" change source whose replication slot was confirmed after comparing
+# all tables by this process - until then, changes made before the slot was created could be missing in the slot
+confirmed_logical_changes = set()
+
+# project names of connections whose publication and logical replication slot were set up by this process
+ready_change_capture = set()
+
+# size (in bytes) of write-ahead log kept by a logical replication slot that gets reported as a warning
+CHANGE_CAPTURE_RETAINED_WAL_WARNING = 1024**3
+
+# key = project name of a connection, value = (digest, time first seen, time last changed) of its DB changes
+# waiting for a quiet period before being pushed - see _should_defer_push()
+pending_push_changes = {}
+
+
+def _close_mergin_project(mp: MerginProject) -> None:
+    """Releases resources held by MerginProject object - its geodiff instance and log file handler"""
+    if mp.geodiff is not None:
+        # break the cycle of refs between GeoDiff and MerginProject objects (logger callback)
+        mp.geodiff.set_logger_callback(None)
+        mp.geodiff = None
+    _close_file_handlers(mp.log)
+
+
+def _forget_mergin_project(work_path) -> None:
+    """Removes MerginProject object from the cache (e.g. when its working directory gets removed)"""
+    with mergin_projects_lock:
+        mp = cached_mergin_project_objects.pop(work_path, None)
+        cached_mergin_project_metadata_stats.pop(work_path, None)
+        evicted_mergin_projects.pop(work_path, None)
+        if mp is not None:
+            validated_project_ids.pop(mp.dir, None)
+            _close_mergin_project(mp)
+
+
+def _evict_mergin_projects() -> None:
+    """Removes the least recently used MerginProject objects if there are more of them than `project_cache_size`.
+    Objects that are being used are closed only once they are no longer used."""
+    with mergin_projects_lock:
+        excess = len(cached_mergin_project_objects) - config.get("mergin.project_cache_size", 100)
+        for work_path in list(cached_mergin_project_objects)[: max(excess, 0)]:
+            if mergin_project_users[work_path]:
+                evicted_mergin_projects[work_path] = cached_mergin_project_objects.pop(work_path)
+                cached_mergin_project_metadata_stats.pop(work_path, None)
+            else:
+                _forget_mergin_project(work_path)
+
+
+def _reload_mergin_project_metadata(work_path) -> None:
+    """Makes the next _get_mergin_project() call read metadata of the project again - to be used after the client
+    changed them (a rewrite of the file may not change its modification time and size)"""
+    with mergin_projects_lock:
+        cached_mergin_project_metadata_stats.pop(work_path, None)
+
+
+@contextlib.contextmanager
+def _use_mergin_project(work_path):
+    """Marks MerginProject object of the project as used in the `with` block, so it does not get closed meanwhile"""
+    with mergin_projects_lock:
+        mergin_project_users[work_path] += 1
+    try:
+        yield
+    finally:
+        with mergin_projects_lock:
+            mergin_project_users[work_path] -= 1
+            if not mergin_project_users[work_path]:
+                del mergin_project_users[work_path]
+                mp = evicted_mergin_projects.pop(work_path, None)
+                if mp is not None:
+                    validated_project_ids.pop(mp.dir, None)
+                    _close_mergin_project(mp)
 
 
 def _get_mergin_project(work_path) -> MerginProject:
@@ -533,15 +846,34 @@ def _get_mergin_project(work_path) -> MerginProject:
     (Safer because we are having a cycle of refs between GeoDiff and MerginProject objects
     related to logging - and untangling those would need some extra calls when we are done
     with MerginProject. But since we use the object all the time, it's better to cache it anyway.)
+    The number of cached objects is limited by `mergin.project_cache_size` setting, the least
+    recently used objects get closed and removed from the cache (once they are not used - see _use_mergin_project()).
     """
-    if work_path not in cached_mergin_project_objects:
-        cached_mergin_project_objects[work_path] = MerginProject(work_path)
-    # Clear metadata so we re-read the state.
-    # This is needed since otherwise we can have multiple MerginProject
-    # instances of the same workpath with different state.
-    cached_mergin_project_objects[work_path]._metadata = None
-    cached_mergin_project_objects[work_path]._read_metadata()
-    return cached_mergin_project_objects[work_path]
+    with mergin_projects_lock:
+        if work_path in cached_mergin_project_objects:
+            cached_mergin_project_objects.move_to_end(work_path)
+        elif work_path in evicted_mergin_projects:
+            # still being used - back to the cache
+            cached_mergin_project_objects[work_path] = evicted_mergin_projects.pop(work_path)
+        else:
+            cached_mergin_project_objects[work_path] = MerginProject(work_path)
+        mp = cached_mergin_project_objects[work_path]
+        _evict_mergin_projects()
+
+        # Re-read metadata if they have changed since we read them the last time.
+        # This is needed since otherwise we can have multiple MerginProject
+        # instances of the same workpath with different state (e.g. the ones created by the client on pull).
+        try:
+            stat = os.stat(mp.fpath_meta("mergin.json"))
+            metadata_stat = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            metadata_stat = None
+        if metadata_stat is None or cached_mergin_project_metadata_stats.get(work_path) != metadata_stat:
+            mp._metadata = None
+            mp._read_metadata()
+            if work_path in cached_mergin_project_objects:
+                cached_mergin_project_metadata_stats[work_path] = metadata_stat
+    return mp
 
 
 def _get_project_version(work_path) -> str:
@@ -569,9 +901,10 @@ def _set_db_project_comment(
     version,
     project_id=None,
     error=None,
+    fingerprint=None,
 ):
     """Set postgres COMMENT on SCHEMA with Mergin Maps project name and version
-    or eventually error message if initialisation failed
+    or eventually error message if initialisation failed (and fingerprint of data verified by init)
     """
     comment = {
         "name": project_name,
@@ -581,6 +914,8 @@ def _set_db_project_comment(
         comment["project_id"] = project_id
     if error:
         comment["error"] = error
+    if fingerprint:
+        comment["fingerprint"] = fingerprint
     cur = conn.cursor()
     query = sql.SQL("COMMENT ON SCHEMA {} IS %s").format(sql.Identifier(schema))
     cur.execute(
@@ -609,8 +944,362 @@ def _get_db_project_comment(conn, schema):
     return comment
 
 
+def _check_track_commit_timestamp(conn) -> bool:
+    """Checks whether the database server records commit timestamps of transactions"""
+    cur = conn.cursor()
+    cur.execute("SHOW track_commit_timestamp")
+    enabled = cur.fetchone()[0] == "on"
+    conn.commit()
+    return enabled
+
+
+def _get_db_clock(conn) -> datetime.datetime:
+    """Returns current time of the database server (so that it can be compared with commit timestamps)"""
+    cur = conn.cursor()
+    cur.execute("SELECT clock_timestamp()")
+    now = cur.fetchone()[0]
+    conn.commit()
+    return now
+
+
+def _get_db_last_sync_time(conn, schema):
+    """Returns commit timestamp of the last change of the db schema comment - which is updated
+    after each successful pull/push - or None if it is not available"""
+    cur = conn.cursor()
+    schema = _add_quotes_to_schema_name(schema)
+    cur.execute(
+        "SELECT pg_xact_commit_timestamp(xmin) FROM pg_description "
+        "WHERE objoid = %s::regnamespace AND classoid = 'pg_namespace'::regclass",
+        (schema,),
+    )
+    res = cur.fetchone()
+    conn.commit()
+    return res[0] if res else None
+
+
+def _get_db_commit_timestamps(conn, schema, tables, since):
+    """
+    Returns commit timestamps of rows in the given tables committed after 'since' timestamp - all of them,
+    or evenly spaced percentiles of them if there are more than LATENCY_SAMPLES such rows. The timestamps
+    get aggregated in the database, but it still has to read all rows of the tables (they are not indexed).
+    """
+    if not tables:
+        return []
+    rows = sql.SQL(" UNION ALL ").join(
+        sql.SQL("SELECT pg_xact_commit_timestamp(xmin) AS committed FROM {}").format(sql.Identifier(schema, table))
+        for table in tables
+    )
+    quantiles = [(i + 0.5) / LATENCY_SAMPLES for i in range(LATENCY_SAMPLES)]
+    cur = conn.cursor()
+    cur.execute(
+        sql.SQL(
+            "SELECT count(*), percentile_disc(%s::float8[]) WITHIN GROUP (ORDER BY committed) "
+            "FROM ({}) AS changed WHERE committed > %s"
+        ).format(rows),
+        (quantiles, since),
+    )
+    count, percentiles = cur.fetchone()
+    conn.commit()
+    samples = min(count, LATENCY_SAMPLES)
+    return [percentiles[int((i + 0.5) * LATENCY_SAMPLES / samples)] for i in range(samples)]
+
+
+def _get_db_table_sizes(conn, schema) -> dict:
+    """
+    Returns sizes (in bytes, including indexes and TOAST) of tables in the schema together with names
+    of partitioned tables they are partitions of (None for other tables), as dict: table -> (size, root table)
+    """
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT c.relname, pg_total_relation_size(c.oid), r.relname FROM pg_class c "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "LEFT JOIN pg_class r ON r.oid = pg_partition_root(c.oid) AND r.oid <> c.oid "
+        "WHERE n.nspname = %s AND c.relkind IN ('r', 'p')",
+        (schema,),
+    )
+    sizes = {table: (size, root) for table, size, root in cur.fetchall()}
+    conn.commit()
+    return sizes
+
+
+def _get_db_table_stats(conn, schema):
+    """
+    Returns statistics of tables in the schema that change whenever rows of a table change (table OID, counters
+    of inserted, updated, deleted and live rows and time of the last reset of statistics of the database, so that
+    all tables look changed when the counters get reset), or None if PostgreSQL does not collect them
+    (`track_counts` is off)
+    """
+    cur = conn.cursor()
+    cur.execute("SHOW track_counts")
+    if cur.fetchone()[0] != "on":
+        conn.commit()
+        return None
+    cur.execute(
+        "SELECT relname, relid, n_tup_ins, n_tup_upd, n_tup_del, n_live_tup, "
+        "(SELECT stats_reset FROM pg_stat_database WHERE datname = current_database()) "
+        "FROM pg_stat_user_tables WHERE schemaname = %s",
+        (schema,),
+    )
+    stats = {row[0]: tuple(row[1:]) for row in cur.fetchall()}
+    conn.commit()
+    return stats
+
+
+def _get_unchanged_tables(conn_cfg, table_stats) -> list:
+    """
+    Returns tables of the 'modified' schema that did not change since they were the same as in the base schema.
+    Statistics are updated asynchronously and may get lost (e.g. after a crash of PostgreSQL older than 15),
+    so every `full_compare_interval` seconds no table is returned to make the push compare all of them.
+    """
+    interval = conn_cfg.get("full_compare_interval", DEFAULT_FULL_COMPARE_INTERVAL)
+    last_full_compare = full_compare_times.get(conn_cfg.mergin_project)
+    if last_full_compare is None or (interval and time.monotonic() - last_full_compare >= interval):
+        return []
+    clean_stats = clean_table_stats.get(conn_cfg.mergin_project, {})
+    return sorted(table for table, stats in table_stats.items() if clean_stats.get(table) == stats)
+
+
+def _store_clean_table_stats(conn_cfg, table_stats, stats_time, full_compare) -> None:
+    """Stores statistics of tables of the 'modified' schema read at `stats_time` when it got in sync with the base
+    schema (and the time if all tables were compared)"""
+    clean_table_stats[conn_cfg.mergin_project] = table_stats
+    if full_compare:
+        full_compare_times[conn_cfg.mergin_project] = stats_time
+
+
+def _get_db_schema_fingerprint(conn, schema, ignored_tables) -> typing.Optional[dict]:
+    """
+    Returns fingerprints of tables in the schema - checksum of column definitions, file node (changes when the table
+    gets rewritten or truncated) and counters of inserted, updated and deleted rows. These come from the system
+    catalogs, so no table gets scanned. Returns None if PostgreSQL does not collect the counters (`track_counts` is off)
+    """
+    cur = conn.cursor()
+    cur.execute("SHOW track_counts")
+    if cur.fetchone()[0] != "on":
+        conn.commit()
+        return None
+    cur.execute(
+        "SELECT c.relname, md5(string_agg(a.attname || ' ' || format_type(a.atttypid, a.atttypmod) "
+        "|| ' ' || a.attnotnull::text, ',' ORDER BY a.attnum)), c.relfilenode, s.n_tup_ins, s.n_tup_upd, s.n_tup_del "
+        "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace JOIN pg_attribute a ON a.attrelid = c.oid "
+        "LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid "
+        "WHERE n.nspname = %s AND c.relkind IN ('r', 'p') AND a.attnum > 0 AND NOT a.attisdropped "
+        "GROUP BY c.relname, c.relfilenode, s.n_tup_ins, s.n_tup_upd, s.n_tup_del ORDER BY c.relname",
+        (schema,),
+    )
+    fingerprint = {row[0]: list(row[1:]) for row in cur.fetchall() if row[0] not in ignored_tables}
+    conn.commit()
+    return fingerprint
+
+
+def _get_file_fingerprint(path) -> list:
+    """Returns size and modification time of the file (which change whenever it gets written)"""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _get_init_fingerprint(conn, conn_cfg, gpkg_path, version, ignored_tables) -> dict:
+    """Returns fingerprint of data compared by init (the project version, size and modification time
+    of the GeoPackage and fingerprints of tables in the base and modified schemas)"""
+    with timing_functions.span("init fingerprint"):
+        return {
+            "version": version,
+            "gpkg": _get_file_fingerprint(gpkg_path),
+            "base": _get_db_schema_fingerprint(conn, conn_cfg.base, ignored_tables),
+            "modified": _get_db_schema_fingerprint(conn, conn_cfg.modified, ignored_tables),
+        }
+
+
+def _get_unchanged_init_data(db_proj_info, fingerprint) -> typing.Tuple[bool, bool]:
+    """Returns whether the base schema and the modified schema did not change since init last verified them
+    (base schema was the same as the GeoPackage, modified schema had no pending changes)"""
+    stored = db_proj_info.get("fingerprint") or {}
+    if fingerprint["base"] is None:
+        return False, False
+    base_unchanged = all(stored.get(key) == fingerprint[key] for key in ("version", "gpkg", "base"))
+    return base_unchanged, base_unchanged and stored.get("modified") == fingerprint["modified"]
+
+
+def _store_init_fingerprint(conn, conn_cfg, db_proj_info, fingerprint, modified_in_sync) -> None:
+    """Stores fingerprint of data verified by init to the base schema comment"""
+    if not modified_in_sync:
+        # pending changes of the modified schema must be checked next time again
+        fingerprint = {**fingerprint, "modified": None}
+    _set_db_project_comment(
+        conn,
+        conn_cfg.base,
+        conn_cfg.mergin_project,
+        db_proj_info["version"],
+        db_proj_info.get("project_id"),
+        fingerprint=fingerprint,
+    )
+
+
+def _get_change_capture_names(conn_cfg) -> typing.Tuple[str, str]:
+    """Returns names of the logical replication slot and publication of the connection"""
+    name = re.sub(r"[^a-z0-9_]", "_", conn_cfg.base.lower())[:40]
+    name = f"dbsync_{name}_{lock_functions.advisory_lock_key(conn_cfg.base) & 0xFFFFFFFF:08x}"
+    return name, name
+
+
+def _ensure_change_capture(conn_cfg) -> None:
+    """
+    Creates publication of tables in the 'modified' schema and logical replication slot decoding their changes
+    (only once per process, unless reading of the slot fails)
+    """
+    if conn_cfg.mergin_project in ready_change_capture:
+        return
+    slot, publication = _get_change_capture_names(conn_cfg)
+    try:
+        with contextlib.closing(psycopg2.connect(conn_cfg.conn_info)) as conn:
+            conn.autocommit = True
+            cur = conn.cursor()
+            if conn.server_version < 150000:
+                raise DbSyncError("The `logical` change source requires PostgreSQL 15 or newer")
+            cur.execute("SHOW wal_level")
+            if cur.fetchone()[0] != "logical":
+                raise DbSyncError("The `logical` change source requires `wal_level = logical` in the database server")
+            cur.execute("SELECT rolsuper, rolreplication FROM pg_roles WHERE rolname = current_user")
+            superuser, replication = cur.fetchone()
+            cur.execute("SELECT 1 FROM pg_publication WHERE pubname = %s", (publication,))
+            if cur.fetchone() is None:
+                if not superuser:
+                    raise DbSyncError(
+                        "The `logical` change source requires a superuser to create publication "
+                        f"{publication} of all tables in schema {conn_cfg.modified} (or it can be created upfront)"
+                    )
+                cur.execute(
+                    sql.SQL("CREATE PUBLICATION {} FOR TABLES IN SCHEMA {}").format(
+                        sql.Identifier(publication), sql.Identifier(conn_cfg.modified)
+                    )
+                )
+            cur.execute("SELECT 1 FROM pg_replication_slots WHERE slot_name = %s", (slot,))
+            if cur.fetchone() is None:
+                if not (superuser or replication):
+                    raise DbSyncError(
+                        "The `logical` change source requires the database user to have the `REPLICATION` attribute"
+                    )
+                logging.debug(f"Creating logical replication slot {slot}")
+                cur.execute("SELECT pg_create_logical_replication_slot(%s, 'pgoutput')", (slot,))
+                confirmed_logical_changes.discard(conn_cfg.mergin_project)
+    except psycopg2.Error as e:
+        raise DbSyncError("Unable to set up logical replication slot: " + str(e))
+    ready_change_capture.add(conn_cfg.mergin_project)
+
+
+def _drop_unused_change_capture(conn_cfg) -> None:
+    """
+    Drops logical replication slot and publication of a connection which does not use the `logical` change source
+    (anymore) - the slot would keep the write-ahead log forever
+    """
+    slot, _ = _get_change_capture_names(conn_cfg)
+    try:
+        with contextlib.closing(psycopg2.connect(conn_cfg.conn_info)) as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT 1 FROM pg_replication_slots WHERE slot_name = %s", (slot,))
+            if cur.fetchone() is None:
+                return
+    except psycopg2.Error as e:
+        logging.warning(f"Unable to check logical replication slot {slot}: {e}")
+        return
+    logging.info(f"Dropping logical replication slot {slot}, connection {conn_cfg.mergin_project} does not use it")
+    try:
+        _drop_change_capture(conn_cfg)
+    except DbSyncError as e:
+        logging.warning(str(e))
+
+
+def _check_retained_wal(cur, conn_cfg, slot) -> None:
+    """Warns if the logical replication slot keeps too much write-ahead log (e.g. when pushes keep failing)"""
+    cur.execute(
+        "SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), restart_lsn) FROM pg_replication_slots WHERE slot_name = %s",
+        (slot,),
+    )
+    row = cur.fetchone()
+    if row and row[0] is not None and row[0] > CHANGE_CAPTURE_RETAINED_WAL_WARNING:
+        logging.warning(
+            f"Logical replication slot {slot} of connection {conn_cfg.mergin_project} keeps "
+            f"{int(row[0]) // 1024**2} MB of write-ahead log - it gets released once the changes get pushed"
+        )
+
+
+def _drop_change_capture(conn_cfg) -> None:
+    """Drops logical replication slot and publication of the connection"""
+    slot, publication = _get_change_capture_names(conn_cfg)
+    try:
+        with contextlib.closing(psycopg2.connect(conn_cfg.conn_info)) as conn:
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT pg_drop_replication_slot(slot_name) FROM pg_replication_slots WHERE slot_name = %s", (slot,)
+            )
+            cur.execute(sql.SQL("DROP PUBLICATION IF EXISTS {}").format(sql.Identifier(publication)))
+    except psycopg2.Error as e:
+        raise DbSyncError("Unable to drop logical replication slot: " + str(e))
+    confirmed_logical_changes.discard(conn_cfg.mergin_project)
+    ready_change_capture.discard(conn_cfg.mergin_project)
+
+
+def _get_logical_changes(conn_cfg) -> typing.Tuple[typing.Optional[typing.Set[str]], str]:
+    """
+    Returns tables of the 'modified' schema with changes in the logical replication slot (since the last confirmed
+    position) and the current WAL position, up to which the changes were read. Tables are None if the slot was
+    not confirmed by this process yet, so all tables need to be compared.
+    """
+    _ensure_change_capture(conn_cfg)
+    slot, publication = _get_change_capture_names(conn_cfg)
+    tables = set()
+    try:
+        with contextlib.closing(psycopg2.connect(conn_cfg.conn_info)) as conn:
+            conn.autocommit = True
+            cur = conn.cursor()
+            _check_retained_wal(cur, conn_cfg, slot)
+            cur.execute("SELECT pg_current_wal_lsn()")
+            lsn = cur.fetchone()[0]
+            if conn_cfg.mergin_project not in confirmed_logical_changes:
+                return None, lsn
+            # pgoutput sends a relation message ('R') before changes of each table - only those get transferred
+            cur.execute(
+                "SELECT data FROM pg_logical_slot_peek_binary_changes(%s, %s, NULL, "
+                "'proto_version', '1', 'publication_names', %s) WHERE get_byte(data, 0) = 82",
+                (slot, lsn, publication),
+            )
+            for (data,) in cur.fetchall():
+                # 'R', relation OID (4 bytes), namespace and relation name (nul-terminated), ...
+                namespace, table = bytes(data)[5:].split(b"\0")[:2]
+                if namespace.decode("utf-8") == conn_cfg.modified:
+                    tables.add(table.decode("utf-8"))
+    except psycopg2.Error as e:
+        # the slot or publication may have been dropped in the meantime
+        ready_change_capture.discard(conn_cfg.mergin_project)
+        raise DbSyncError("Unable to read changes from logical replication slot: " + str(e))
+    return tables, lsn
+
+
+def _confirm_logical_changes(conn_cfg, lsn: str) -> None:
+    """Moves the logical replication slot to the given WAL position once its changes got synced"""
+    slot, _ = _get_change_capture_names(conn_cfg)
+    try:
+        with contextlib.closing(psycopg2.connect(conn_cfg.conn_info)) as conn:
+            conn.autocommit = True
+            conn.cursor().execute("SELECT pg_replication_slot_advance(%s, %s::pg_lsn)", (slot, lsn))
+    except psycopg2.Error as e:
+        raise DbSyncError("Unable to confirm changes in logical replication slot: " + str(e))
+    confirmed_logical_changes.add(conn_cfg.mergin_project)
+
+
+def _get_mergin_versions_created(mc, project_path, since, to):
+    """Returns creation times of project versions between 'since' and 'to' (both including)"""
+    try:
+        versions = mc.project_versions(project_path, since, to)
+    except ClientError as e:
+        raise DbSyncError("Mergin Maps client error: " + str(e))
+    return [datetime.datetime.fromisoformat(v["created"].replace("Z", "+00:00")) for v in versions]
+
+
 def _redownload_project(conn_cfg, mc, work_dir, db_proj_info):
     logging.debug(f"Removing local working directory {work_dir}")
+    _forget_mergin_project(work_dir)
     shutil.rmtree(work_dir)
     logging.debug(
         f"Downloading version {db_proj_info['version']} of Mergin Maps project {conn_cfg.mergin_project} "
@@ -626,16 +1315,26 @@ def _redownload_project(conn_cfg, mc, work_dir, db_proj_info):
         raise DbSyncError("Mergin Maps client error: " + str(e))
 
 
+# Dictionary used by _validate_local_project_id() function below.
+# key = path to a local dir with Mergin project, value = (validated project ID, time when validation expires)
+validated_project_ids = {}
+
+
 def _validate_local_project_id(
     mp,
     mc,
     server_info=None,
 ):
-    """Compare local project ID with remote version on the server."""
+    """Compare local project ID with remote version on the server.
+    If server_info does not contain project ID, it is requested from the server - but only
+    if the local project ID has not been validated in the last `mergin.project_id_check_interval` seconds."""
     local_project_id = _get_project_id(mp)
     if local_project_id is None:
         return
-    if server_info is None:
+    if server_info is None or "id" not in server_info:
+        validated_project_id, expires = validated_project_ids.get(mp.dir, (None, 0))
+        if validated_project_id == local_project_id and time.monotonic() < expires:
+            return
         try:
             server_info = mc.project_info(mp.project_full_name())
         except ClientError as e:
@@ -646,18 +1345,61 @@ def _validate_local_project_id(
         raise DbSyncError(
             f"The local project ID ({local_project_id}) does not match the server project ID ({remote_project_id})"
         )
+    validated_project_ids[mp.dir] = (
+        local_project_id,
+        time.monotonic() + config.get("mergin.project_id_check_interval", 3600),
+    )
+
+
+class _TimeoutOpener:
+    """Wraps URL opener of MerginClient to use a timeout for blocking operations (connect, read) of its requests"""
+
+    def __init__(self, opener):
+        self.opener = opener
+        self.timeout = None  # seconds, None = no timeout
+        self._timeouts = []  # timeouts of operations in progress
+        self._lock = threading.Lock()
+
+    def open(self, request, data=None, timeout=None):
+        return self.opener.open(request, data, self.timeout if timeout is None else timeout)
+
+    @contextlib.contextmanager
+    def limit(self, timeout):
+        """Applies the timeout in the `with` block - the client is shared by threads (e.g. its downloads),
+        so when operations with different timeouts run at the same time, the longest of them applies"""
+        with self._lock:
+            self._timeouts.append(timeout)
+            self._update_timeout()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._timeouts.remove(timeout)
+                self._update_timeout()
+
+    def _update_timeout(self):
+        self.timeout = None if not self._timeouts or None in self._timeouts else max(self._timeouts)
+
+    def __getattr__(self, name):
+        return getattr(self.opener, name)
 
 
-def create_mergin_client():
-    """Create instance of MerginClient"""
+def create_mergin_client(auth_token=None):
+    """Create instance of MerginClient (using the auth token if given, instead of logging in)"""
     _check_has_password()
+    # geodiff of the client reads its logging level from the environment of this process
+    os.environ["GEODIFF_LOGGER_LEVEL"] = _geodiff_logger_level()
     try:
-        return MerginClient(
+        mc = MerginClient(
             config.mergin.url,
+            auth_token=auth_token,
             login=config.mergin.username,
             password=config.mergin.password,
             plugin_version=f"DB-sync/{__version__}",
         )
+        # time limits of connections get applied to server requests (see _time_limits())
+        mc.opener = _TimeoutOpener(mc.opener)
+        return mc
     except LoginError as e:
         # this could be auth failure, but could be also server problem (e.g. worker crash)
         raise DbSyncError(
@@ -669,6 +1411,76 @@ def create_mergin_client():
         raise DbSyncError("Mergin Maps client error: " + str(e))
 
 
+def _download_files(
+    mc,
+    mp,
+    files,
+    version,
+):
+    """Download given files (list of file metadata dictionaries with 'path' and 'size' as stored
+    in project metadata) of the project at the given version. All chunks of all files are downloaded
+    by a single pool of workers (size given by `mergin.download_workers` setting) and then merged
+    into the files in the project directory."""
+    if not files:
+        return
+    workers = config.get("mergin.download_workers", 4)
+    project_path = mp.project_full_name()
+    tmp_dir = tempfile.mkdtemp(prefix="dbsync-download-")
+    try:
+        update_tasks = []
+        download_items = []
+        for file in files:
+            items = []
+            for part_index in range(math.ceil(file["size"] / CHUNK_SIZE)):
+                items.append(
+                    DownloadQueueItem(
+                        file["path"],
+                        min(CHUNK_SIZE, file["size"] - part_index * CHUNK_SIZE),
+                        version,
+                        False,
+                        part_index,
+                        os.path.join(tmp_dir, f"{file['path']}.{part_index}"),
+                    )
+                )
+            update_tasks.append(UpdateTask(file["path"], items, mp.fpath(file["path"]), latest_version=False))
+            download_items.extend(items)
+
+        total_size = sum(item.size for item in download_items)
+        logging.debug(
+            f"Downloading {len(files)} file(s) at version {version} "
+            f"in {len(download_items)} chunk(s), total size {total_size} bytes, using {workers} worker(s)"
+        )
+        transferred_size = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    item.download_blocking,
+                    mc,
+                    mp,
+                    project_path,
+                ): item
+                for item in download_items
+            }
+            try:
+                for done, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+                    future.result()
+                    transferred_size += futures[future].size
+                    logging.debug(
+                        f"Downloaded {done}/{len(download_items)} chunk(s), {transferred_size}/{total_size} bytes"
+                    )
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        for task in update_tasks:
+            task.apply(mp.dir, mp)
+    except ClientError as e:
+        raise DbSyncError("Mergin Maps client error: " + str(e))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
 def revert_local_changes(
     mc,
     mp,
@@ -687,6 +1499,10 @@ def revert_local_changes(
             added_file,
         )
         os.remove(added_filepath)
+    # metadata of files at the current local version - sizes of updated files in local changes
+    # are the sizes of the modified files, we need the ones we are going to download
+    version_files = {f["path"]: f for f in mp.files()}
+    files_to_download = []
     for update_delete_change in chain(
         local_changes["updated"],
         local_changes["removed"],
@@ -711,23 +1527,50 @@ def revert_local_changes(
         else:
             if delete_file:
                 os.remove(update_delete_filepath)
-            try:
-                mc.download_file(
-                    mp.dir,
-                    update_delete_file,
-                    update_delete_filepath,
-                    mp.version(),
-                )
-            except ClientError as e:
-                raise DbSyncError("Mergin Maps client error: " + str(e))
+            files_to_download.append(version_files[update_delete_file])
+    _download_files(
+        mc,
+        mp,
+        files_to_download,
+        mp.version(),
+    )
     leftovers = mp.get_push_changes()
     logging.debug("LEFTOVERS: " + str(leftovers))
     return leftovers
 
 
+def _should_defer_push(conn_cfg, changeset) -> bool:
+    """
+    Returns True if push of the changeset with DB changes should wait because the changes are still being made -
+    they changed within the last `push_quiet_time` seconds and are pending for less than `push_max_delay` seconds
+    """
+    quiet_time = conn_cfg.get("push_quiet_time", 0)
+    if not quiet_time:
+        return False
+    max_delay = conn_cfg.get("push_max_delay", DEFAULT_PUSH_MAX_DELAY)
+
+    now = time.monotonic()
+    try:
+        digest = changeset_functions.changeset_digest(changeset)
+    except changeset_functions.ChangesetFormatError as e:
+        raise DbSyncError("Unable to read changeset: " + str(e))
+    first_seen, last_changed = now, now
+    if conn_cfg.mergin_project in pending_push_changes:
+        previous_digest, first_seen, last_changed = pending_push_changes[conn_cfg.mergin_project]
+        if previous_digest != digest:
+            last_changed = now
+    pending_push_changes[conn_cfg.mergin_project] = (digest, first_seen, last_changed)
+
+    return now - last_changed < quiet_time and now - first_seen < max_delay
+
+
 def pull(conn_cfg, mc):
     """Downloads any changes from Mergin Maps and applies them to the database"""
+    with tempfile.TemporaryDirectory(prefix="dbsync-pull-") as tmp_dir:
+        _pull(conn_cfg, mc, tmp_dir)
+
 
+def _pull(conn_cfg, mc, tmp_dir):
     logging.debug(f"Processing Mergin Maps project '{conn_cfg.mergin_project}'")
     ignored_tables = get_ignored_tables(conn_cfg)
 
@@ -749,9 +1592,6 @@ def pull(conn_cfg, mc):
     if mp.geodiff is None:
         raise DbSyncError("Mergin Maps client installation problem: geodiff not available")
 
-    # Make sure that local project ID (if available) is the same as on  the server
-    _validate_local_project_id(mp, mc)
-
     local_version = mp.version()
 
     try:
@@ -761,6 +1601,15 @@ def pull(conn_cfg, mc):
         # this could be e.g. DNS error
         raise DbSyncError("Mergin Maps client error: " + str(e))
 
+    # Make sure that local project ID (if available) is the same as on  the server
+    _validate_local_project_id(mp, mc, projects[mp.project_full_name()])
+
+    if int_version(server_version) is not None and int_version(local_version) is not None:
+        metrics_functions.SERVER_VERSIONS_BEHIND.set(
+            int_version(server_version) - int_version(local_version),
+            connection=conn_cfg.mergin_project,
+        )
+
     local_changes = mp.get_push_changes()
     if any(local_changes.values()):
         local_changes = revert_local_changes(
@@ -784,30 +1633,23 @@ def pull(conn_cfg, mc):
     gpkg_basefile_old = gpkg_basefile + "-old"
 
     # make a copy of the basefile in the current version (base) - because after pull it will be set to "their"
-    shutil.copy(
-        gpkg_basefile,
-        gpkg_basefile_old,
-    )
+    with timing_functions.span("copy base file"):
+        shutil.copy(
+            gpkg_basefile,
+            gpkg_basefile_old,
+        )
 
-    tmp_dir = tempfile.gettempdir()
     tmp_base2our = os.path.join(
         tmp_dir,
-        f"{project_name}-dbsync-pull-base2our",
+        "base2our",
     )
     tmp_base2their = os.path.join(
         tmp_dir,
-        f"{project_name}-dbsync-pull-base2their",
+        "base2their",
     )
 
     # find out our local changes in the database (base2our)
-    _geodiff_create_changeset(
-        conn_cfg.driver,
-        conn_cfg.conn_info,
-        conn_cfg.base,
-        conn_cfg.modified,
-        tmp_base2our,
-        ignored_tables,
-    )
+    _geodiff_create_db_changeset(conn_cfg, tmp_base2our, ignored_tables)
 
     needs_rebase = False
     if os.path.getsize(tmp_base2our) != 0:
@@ -819,10 +1661,13 @@ def pull(conn_cfg, mc):
         )
 
     try:
-        mc.pull_project(work_dir)  # will do rebase as needed
+        with timing_functions.span("mergin pull"):
+            mc.pull_project(work_dir)  # will do rebase as needed
     except ClientError as e:
         # TODO: do we need some cleanup here?
         raise DbSyncError("Mergin Maps client error on pull: " + str(e))
+    finally:
+        _reload_mergin_project_metadata(work_dir)
 
     logging.debug("Pulled new version from Mergin Maps: " + _get_project_version(work_dir))
 
@@ -842,6 +1687,13 @@ def pull(conn_cfg, mc):
         summary,
         "Mergin Maps Changes:",
     )
+    if summary:
+        metrics_functions.observe_changeset(
+            conn_cfg.mergin_project,
+            "pull",
+            os.path.getsize(tmp_base2their),
+            summary,
+        )
 
     if not needs_rebase:
         logging.debug("Applying new version [no rebase]")
@@ -849,7 +1701,8 @@ def pull(conn_cfg, mc):
         _geodiff_apply_changeset(conn_cfg.driver, conn_cfg.conn_info, conn_cfg.modified, tmp_base2their, ignored_tables)
     else:
         logging.debug("Applying new version [WITH rebase]")
-        tmp_conflicts = os.path.join(tmp_dir, f"{project_name}-dbsync-pull-conflicts")
+        metrics_functions.REBASES.inc(connection=conn_cfg.mergin_project)
+        tmp_conflicts = os.path.join(tmp_dir, "conflicts")
         _geodiff_rebase(
             conn_cfg.driver,
             conn_cfg.conn_info,
@@ -861,20 +1714,52 @@ def pull(conn_cfg, mc):
         )
         _geodiff_apply_changeset(conn_cfg.driver, conn_cfg.conn_info, conn_cfg.base, tmp_base2their, ignored_tables)
 
+    applied_time = datetime.datetime.now(datetime.timezone.utc)
     os.remove(gpkg_basefile_old)
-    conn = psycopg2.connect(conn_cfg.conn_info)
+    with timing_functions.span("db connect"):
+        conn = psycopg2.connect(conn_cfg.conn_info)
     version = _get_project_version(work_dir)
+    # base schema got the same changes as the GeoPackage - init does not need to compare them again
+    fingerprint = _get_init_fingerprint(conn, conn_cfg, gpkg_full_path, version, ignored_tables)
     _set_db_project_comment(
         conn,
         conn_cfg.base,
         conn_cfg.mergin_project,
         version,
+        fingerprint={**fingerprint, "modified": None},
     )
 
+    if conn_cfg.get("measure_latency", False):
+        _observe_pull_latency(conn_cfg, mc, mp.project_full_name(), local_version, version, applied_time)
+
+
+def _observe_pull_latency(conn_cfg, mc, project_path, local_version, version, applied_time) -> None:
+    """
+    Records latency of each pulled version: from its creation on the server to being applied to the database.
+    The pull is done at this point already, so a failure to get the versions only skips the metric.
+    """
+    try:
+        versions_created = _get_mergin_versions_created(
+            mc, project_path, int_version(local_version) + 1, int_version(version)
+        )
+    except DbSyncError as e:
+        logging.warning(f"Unable to measure sync latency of pulled versions: {e}")
+        return
+    for created in versions_created:
+        metrics_functions.SYNC_LATENCY.observe(
+            (applied_time - created).total_seconds(),
+            connection=conn_cfg.mergin_project,
+            direction="pull",
+        )
+
 
 def status(conn_cfg, mc):
     """Figure out if there are any pending changes in the database or in Mergin Maps"""
+    with tempfile.TemporaryDirectory(prefix="dbsync-status-") as tmp_dir:
+        _status(conn_cfg, mc, tmp_dir)
+
 
+def _status(conn_cfg, mc, tmp_dir):
     logging.debug(f"Processing Mergin Maps project '{conn_cfg.mergin_project}'")
     ignored_tables = get_ignored_tables(conn_cfg)
 
@@ -946,13 +1831,10 @@ def status(conn_cfg, mc):
         raise DbSyncError("The 'modified' schema does not exist: " + conn_cfg.modified)
 
     # get changes in the DB
-    tmp_dir = tempfile.gettempdir()
     tmp_changeset_file = os.path.join(
         tmp_dir,
-        f"{project_name}-dbsync-status-base2our",
+        "base2our",
     )
-    if os.path.exists(tmp_changeset_file):
-        os.remove(tmp_changeset_file)
     _geodiff_create_changeset(
         conn_cfg.driver,
         conn_cfg.conn_info,
@@ -971,21 +1853,54 @@ def status(conn_cfg, mc):
         _print_changes_summary(summary)
 
 
-def push(conn_cfg, mc):
-    """Take changes in the 'modified' schema in the database and push them to Mergin Maps"""
+def push(conn_cfg, mc, debounce=False):
+    """
+    Take changes in the 'modified' schema in the database and push them to Mergin Maps.
+    With debounce, the push waits until the changes are quiet for `push_quiet_time` seconds (if set).
+    """
+    with tempfile.TemporaryDirectory(prefix="dbsync-push-") as tmp_dir:
+        _push(conn_cfg, mc, tmp_dir, debounce)
+
 
+def _store_modified_fingerprint(conn, conn_cfg, modified_fingerprint) -> None:
+    """Stores fingerprint of the 'modified' schema found in sync with the base schema, so that init does not need
+    to compare them (only if the stored fingerprint of the base schema is known and the fingerprint changed)"""
+    db_proj_info = _get_db_project_comment(conn, conn_cfg.base)
+    stored = (db_proj_info or {}).get("fingerprint")
+    if not stored or stored.get("modified") == modified_fingerprint:
+        return
+    _set_db_project_comment(
+        conn,
+        conn_cfg.base,
+        conn_cfg.mergin_project,
+        db_proj_info["version"],
+        db_proj_info.get("project_id"),
+        fingerprint={**stored, "modified": modified_fingerprint},
+    )
+
+
+def _finish_push(conn_cfg, table_stats, stats_time, all_compared, change_lsn) -> None:
+    """Forgets state of changes waiting for push once the 'modified' schema is in sync with the base schema
+    (its changes got pushed or there were none)"""
+    pending_push_changes.pop(conn_cfg.mergin_project, None)
+    if table_stats is not None:
+        # statistics were read before the diff, so changes made since then make the tables look changed next time
+        _store_clean_table_stats(conn_cfg, table_stats, stats_time, all_compared)
+    if change_lsn is not None:
+        # changes made after the position was read stay in the replication slot
+        _confirm_logical_changes(conn_cfg, change_lsn)
+
+
+def _push(conn_cfg, mc, tmp_dir, debounce):
     logging.debug(f"Processing Mergin Maps project '{conn_cfg.mergin_project}'")
     ignored_tables = get_ignored_tables(conn_cfg)
 
     project_name = conn_cfg.mergin_project.split("/")[1]
 
-    tmp_dir = tempfile.gettempdir()
     tmp_changeset_file = os.path.join(
         tmp_dir,
-        f"{project_name}-dbsync-push-base2our",
+        "base2our",
     )
-    if os.path.exists(tmp_changeset_file):
-        os.remove(tmp_changeset_file)
 
     work_dir = os.path.join(
         config.working_dir,
@@ -1003,9 +1918,6 @@ def push(conn_cfg, mc):
     if mp.geodiff is None:
         raise DbSyncError("Mergin Maps client installation problem: geodiff not available")
 
-    # Make sure that local project ID (if available) is the same as on  the server
-    _validate_local_project_id(mp, mc)
-
     local_version = mp.version()
 
     try:
@@ -1015,6 +1927,9 @@ def push(conn_cfg, mc):
         # this could be e.g. DNS error
         raise DbSyncError("Mergin Maps client error: " + str(e))
 
+    # Make sure that local project ID (if available) is the same as on  the server
+    _validate_local_project_id(mp, mc, projects[mp.project_full_name()])
+
     status_push = mp.get_push_changes()
     if status_push["added"] or status_push["updated"] or status_push["removed"]:
         raise DbSyncError(
@@ -1025,7 +1940,8 @@ def push(conn_cfg, mc):
     if server_version != local_version:
         raise DbSyncError("There are pending changes on server - need to pull them first.")
 
-    conn = psycopg2.connect(conn_cfg.conn_info)
+    with timing_functions.span("db connect"):
+        conn = psycopg2.connect(conn_cfg.conn_info)
 
     if not _check_schema_exists(
         conn,
@@ -1038,42 +1954,128 @@ def push(conn_cfg, mc):
     ):
         raise DbSyncError("The 'modified' schema does not exist: " + conn_cfg.modified)
 
+    # read before looking for changes, so that changes made during the push make the schema look changed to the next init
+    modified_fingerprint = _get_db_schema_fingerprint(conn, conn_cfg.modified, ignored_tables)
+
+    # tables that did not change since the last sync do not need to be compared
+    table_stats = None
+    stats_time = None
+    change_lsn = None
+    all_tables = unchanged_tables = None
+    if conn_cfg.get("change_source", "diff") == "logical":
+        changed_tables, change_lsn = _get_logical_changes(conn_cfg)
+        if changed_tables is not None:
+            all_tables = list(_get_db_table_sizes(conn, conn_cfg.modified))
+            unchanged_tables = [t for t in all_tables if t not in changed_tables]
+    elif conn_cfg.get("skip_unchanged_tables", False):
+        table_stats = _get_db_table_stats(conn, conn_cfg.modified)
+        if table_stats is None:
+            logging.warning("Unable to detect changed tables - `track_counts` is not enabled in the database server")
+        else:
+            stats_time = time.monotonic()
+            all_tables = list(table_stats)
+            unchanged_tables = _get_unchanged_tables(conn_cfg, table_stats)
+
+    diff_ignored_tables = ignored_tables
+    if unchanged_tables is not None:
+        diff_ignored_tables = ignored_tables + [t for t in unchanged_tables if t not in ignored_tables]
+        if set(all_tables) <= set(diff_ignored_tables):
+            logging.debug("No changes in the database.")
+            _store_modified_fingerprint(conn, conn_cfg, modified_fingerprint)
+            _finish_push(conn_cfg, table_stats, stats_time, False, change_lsn)
+            return
+
     # get changes in the DB
-    _geodiff_create_changeset(
-        conn_cfg.driver,
-        conn_cfg.conn_info,
-        conn_cfg.base,
-        conn_cfg.modified,
-        tmp_changeset_file,
-        ignored_tables,
-    )
+    _geodiff_create_db_changeset(conn_cfg, tmp_changeset_file, diff_ignored_tables)
 
     if os.path.getsize(tmp_changeset_file) == 0:
         logging.debug("No changes in the database.")
+        _store_modified_fingerprint(conn, conn_cfg, modified_fingerprint)
+        _finish_push(conn_cfg, table_stats, stats_time, diff_ignored_tables == ignored_tables, change_lsn)
+        return
+
+    if debounce and _should_defer_push(conn_cfg, tmp_changeset_file):
+        logging.debug("Changes in the database are not quiet yet, deferring push.")
         return
 
     # summarize changes
     summary = _geodiff_list_changes_summary(tmp_changeset_file)
     _print_changes_summary(summary)
+    metrics_functions.observe_changeset(
+        conn_cfg.mergin_project,
+        "push",
+        os.path.getsize(tmp_changeset_file),
+        summary,
+    )
 
-    # write changes to the local geopackage
-    logging.debug("Writing DB changes to working dir...")
-    _geodiff_apply_changeset("sqlite", "", gpkg_full_path, tmp_changeset_file, ignored_tables)
-
-    # write to the server
-    try:
-        mc.push_project(work_dir)
-    except ClientError as e:
-        # TODO: should we do some cleanup here? (undo changes in the local geopackage?)
-        raise DbSyncError("Mergin Maps client error on push: " + str(e))
+    commit_timestamps = []
+    if conn_cfg.get("measure_latency", False):
+        if _check_track_commit_timestamp(conn):
+            # rows changed in the 'modified' schema since the last sync (deleted rows can not be tracked)
+            last_sync_time = _get_db_last_sync_time(conn, conn_cfg.base)
+            if last_sync_time is not None:
+                commit_timestamps = _get_db_commit_timestamps(
+                    conn,
+                    conn_cfg.modified,
+                    [item["table"] for item in summary if item["insert"] or item["update"]],
+                    last_sync_time,
+                )
+        else:
+            logging.warning(
+                "Unable to measure sync latency - `track_commit_timestamp` is not enabled in the database server"
+            )
 
-    version = _get_project_version(work_dir)
-    logging.debug("Pushed new version to Mergin Maps: " + version)
+    chunks = [tmp_changeset_file]
+    max_rows = conn_cfg.get("push_chunk_rows", None)
+    max_bytes = conn_cfg.get("push_chunk_bytes", None)
+    rows = sum(item["insert"] + item["update"] + item["delete"] for item in summary)
+    if (max_rows and rows > max_rows) or (max_bytes and os.path.getsize(tmp_changeset_file) > max_bytes):
+        try:
+            chunks = changeset_functions.split_changeset(
+                tmp_changeset_file, os.path.join(tmp_dir, "chunks"), max_rows, max_bytes
+            )
+        except changeset_functions.ChangesetFormatError as e:
+            raise DbSyncError("Unable to split changeset: " + str(e))
+        logging.debug(f"Pushing DB changes in {len(chunks)} chunks...")
+
+    # each chunk is pushed and written to the base schema before the next one, so that a failure
+    # does not lose the progress - the remaining changes are pushed again next time
+    for chunk in chunks:
+        # write changes to the local geopackage
+        logging.debug("Writing DB changes to working dir...")
+        _geodiff_apply_changeset("sqlite", "", gpkg_full_path, chunk, ignored_tables)
+
+        # write to the server
+        try:
+            with timing_functions.span("mergin push"):
+                mc.push_project(work_dir)
+        except ClientError as e:
+            # TODO: should we do some cleanup here? (undo changes in the local geopackage?)
+            raise DbSyncError("Mergin Maps client error on push: " + str(e))
+        finally:
+            _reload_mergin_project_metadata(work_dir)
 
-    # update base schema in the DB
-    logging.debug("Updating DB base schema...")
-    _geodiff_apply_changeset(conn_cfg.driver, conn_cfg.conn_info, conn_cfg.base, tmp_changeset_file, ignored_tables)
-    _set_db_project_comment(conn, conn_cfg.base, conn_cfg.mergin_project, version)
+        version = _get_project_version(work_dir)
+        logging.debug("Pushed new version to Mergin Maps: " + version)
+
+        # update base schema in the DB
+        logging.debug("Updating DB base schema...")
+        _geodiff_apply_changeset(conn_cfg.driver, conn_cfg.conn_info, conn_cfg.base, chunk, ignored_tables)
+        # the 'modified' schema is in sync once all chunks are pushed, unless it changed after it was compared
+        fingerprint = _get_init_fingerprint(conn, conn_cfg, gpkg_full_path, version, ignored_tables)
+        fingerprint["modified"] = modified_fingerprint if chunk == chunks[-1] else None
+        _set_db_project_comment(conn, conn_cfg.base, conn_cfg.mergin_project, version, fingerprint=fingerprint)
+
+    _finish_push(conn_cfg, table_stats, stats_time, diff_ignored_tables == ignored_tables, change_lsn)
+
+    if commit_timestamps:
+        pushed_time = _get_db_clock(conn)
+        for commit_timestamp in commit_timestamps:
+            metrics_functions.SYNC_LATENCY.observe(
+                (pushed_time - commit_timestamp).total_seconds(),
+                connection=conn_cfg.mergin_project,
+                direction="push",
+            )
 
 
 def init(
@@ -1092,7 +2094,8 @@ def init(
     # the environment is set up correctly before doing any work
     logging.debug("Connecting to the database...")
     try:
-        conn = psycopg2.connect(conn_cfg.conn_info)
+        with timing_functions.span("db connect"):
+            conn = psycopg2.connect(conn_cfg.conn_info)
     except psycopg2.Error as e:
         raise DbSyncError("Unable to connect to the database: " + str(e))
 
@@ -1212,26 +2215,36 @@ def init(
 
         if modified_schema_exists and base_schema_exists:
             # if db schema already exists make sure it is already synchronized with source gpkg or fail
-            logging.debug("Checking 'modified' schema content...")
-            summary_modified = _compare_datasets(
-                "sqlite",
-                "",
-                gpkg_full_path,
-                conn_cfg.driver,
-                conn_cfg.conn_info,
-                conn_cfg.modified,
-                ignored_tables,
-            )
-            logging.debug("Checking 'base' schema content...")
-            summary_base = _compare_datasets(
-                "sqlite",
-                "",
-                gpkg_full_path,
-                conn_cfg.driver,
-                conn_cfg.conn_info,
-                conn_cfg.base,
-                ignored_tables,
-            )
+            # (unless nothing changed since the last init, which is much cheaper to find out)
+            fingerprint = _get_init_fingerprint(conn, conn_cfg, gpkg_full_path, local_version, ignored_tables)
+            base_unchanged, modified_unchanged = _get_unchanged_init_data(db_proj_info, fingerprint)
+            summary_modified = summary_base = []
+            if modified_unchanged:
+                logging.debug("The 'modified' schema did not change since the last init")
+            else:
+                logging.debug("Checking 'modified' schema content...")
+                summary_modified = _compare_datasets(
+                    "sqlite",
+                    "",
+                    gpkg_full_path,
+                    conn_cfg.driver,
+                    conn_cfg.conn_info,
+                    conn_cfg.modified,
+                    ignored_tables,
+                )
+            if base_unchanged:
+                logging.debug("The GPKG file and 'base' schema did not change since the last init")
+            else:
+                logging.debug("Checking 'base' schema content...")
+                summary_base = _compare_datasets(
+                    "sqlite",
+                    "",
+                    gpkg_full_path,
+                    conn_cfg.driver,
+                    conn_cfg.conn_info,
+                    conn_cfg.base,
+                    ignored_tables,
+                )
             if len(summary_base):
                 # seems someone modified base schema manually - this should never happen!
                 logging.debug(f"Local project version at {local_version} and base schema at {db_proj_info['version']}")
@@ -1240,7 +2253,9 @@ def init(
                     "The db schemas already exist but 'base' schema is not synchronized with source GPKG. "
                     f"{FORCE_INIT_MESSAGE}"
                 )
-            elif len(summary_modified):
+            if not modified_unchanged:
+                _store_init_fingerprint(conn, conn_cfg, db_proj_info, fingerprint, not len(summary_modified))
+            if len(summary_modified):
                 logging.debug(
                     "Modified schema is not synchronised with source GPKG, please run pull/push commands to fix it"
                 )
@@ -1316,11 +2331,14 @@ def init(
             _drop_schema(conn, conn_cfg.modified)
             raise
 
+        # base schema got verified to be the same as the GPKG file - no need to compare them again on next init
+        fingerprint = _get_init_fingerprint(conn, conn_cfg, gpkg_full_path, local_version, ignored_tables)
         _set_db_project_comment(
             conn,
             conn_cfg.base,
             conn_cfg.mergin_project,
             local_version,
+            fingerprint={**fingerprint, "modified": None},
         )
     else:
         if not modified_schema_exists:
@@ -1331,26 +2349,36 @@ def init(
 
         if os.path.exists(gpkg_full_path) and base_schema_exists:
             # make sure output gpkg is in sync with db or fail
-            logging.debug("Checking GeoPackage content...")
-            summary_modified = _compare_datasets(
-                conn_cfg.driver,
-                conn_cfg.conn_info,
-                conn_cfg.modified,
-                "sqlite",
-                "",
-                gpkg_full_path,
-                ignored_tables,
-            )
-            logging.debug("Checking 'base' schema content...")
-            summary_base = _compare_datasets(
-                conn_cfg.driver,
-                conn_cfg.conn_info,
-                conn_cfg.base,
-                "sqlite",
-                "",
-                gpkg_full_path,
-                ignored_tables,
-            )
+            # (unless nothing changed since the last init, which is much cheaper to find out)
+            fingerprint = _get_init_fingerprint(conn, conn_cfg, gpkg_full_path, local_version, ignored_tables)
+            base_unchanged, modified_unchanged = _get_unchanged_init_data(db_proj_info, fingerprint)
+            summary_modified = summary_base = []
+            if modified_unchanged:
+                logging.debug("The 'modified' schema did not change since the last init")
+            else:
+                logging.debug("Checking GeoPackage content...")
+                summary_modified = _compare_datasets(
+                    conn_cfg.driver,
+                    conn_cfg.conn_info,
+                    conn_cfg.modified,
+                    "sqlite",
+                    "",
+                    gpkg_full_path,
+                    ignored_tables,
+                )
+            if base_unchanged:
+                logging.debug("The GPKG file and 'base' schema did not change since the last init")
+            else:
+                logging.debug("Checking 'base' schema content...")
+                summary_base = _compare_datasets(
+                    conn_cfg.driver,
+                    conn_cfg.conn_info,
+                    conn_cfg.base,
+                    "sqlite",
+                    "",
+                    gpkg_full_path,
+                    ignored_tables,
+                )
             if len(summary_base):
                 logging.debug(
                     f"Local project version at {_get_project_version(work_dir)} and base schema at {db_proj_info['version']}"
@@ -1360,7 +2388,9 @@ def init(
                     "The output GPKG file exists already but is not synchronized with db 'base' schema."
                     f"{FORCE_INIT_MESSAGE}"
                 )
-            elif len(summary_modified):
+            if not modified_unchanged:
+                _store_init_fingerprint(conn, conn_cfg, db_proj_info, fingerprint, not len(summary_modified))
+            if len(summary_modified):
                 logging.debug(
                     "The output GPKG file exists already but it is not synchronised with modified schema, "
                     "please run pull/push commands to fix it"
@@ -1432,40 +2462,171 @@ def init(
             raise
 
         # upload gpkg to Mergin Maps (client takes care of storing metadata)
-        mc.push_project(work_dir)
+        try:
+            mc.push_project(work_dir)
+        finally:
+            _reload_mergin_project_metadata(work_dir)
 
         # mark project version into db schema
         version = _get_project_version(work_dir)
+        fingerprint = _get_init_fingerprint(conn, conn_cfg, gpkg_full_path, version, ignored_tables)
         _set_db_project_comment(
             conn,
             conn_cfg.base,
             conn_cfg.mergin_project,
             version,
+            fingerprint={**fingerprint, "modified": None},
         )
 
 
-def dbsync_init(mc):
-    from_gpkg = config.init_from.lower() == "gpkg"
-    for conn in config.connections:
-        init(
-            conn,
-            mc,
-            from_gpkg=from_gpkg,
+@contextlib.contextmanager
+def _track_operation(operation, conn_cfg):
+    """Records timing and metrics of an operation (init/pull/push) on a connection"""
+    with timing_functions.span(operation, connection=conn_cfg.mergin_project):
+        with metrics_functions.track_operation(operation, conn_cfg.mergin_project):
+            yield
+
+
+@contextlib.contextmanager
+def _time_limits(conn_cfg, mc):
+    """
+    Applies time limits of the connection in the `with` block: `geodiff_timeout` to each geodiff call and
+    `server_timeout` to each blocking operation of requests to Mergin Maps server (if the client supports it)
+    """
+    server_timeout = conn_cfg.get("server_timeout", None) or None
+    _current_operation.conn_cfg = conn_cfg
+    try:
+        with mc.opener.limit(server_timeout) if isinstance(mc.opener, _TimeoutOpener) else contextlib.nullcontext():
+            yield
+    except socket.timeout as e:
+        raise DbSyncError(f"Mergin Maps server did not respond within {server_timeout} seconds: {e}")
+    finally:
+        _current_operation.conn_cfg = None
+
+
+def _raise_errors(errors: list) -> None:
+    """Raises SyncErrors if some connections failed"""
+    if errors:
+        raise SyncErrors(errors) from errors[-1][1]
+
+
+@contextlib.contextmanager
+def _lock_connection(conn_cfg):
+    """
+    Makes sure no other DB Sync process works with the connection inside the `with` block.
+    Yields False if the connection is locked by another process and the lock policy is to skip it.
+    """
+    policy = config.get("daemon.lock_policy", "wait")
+    timeout = config.get("daemon.lock_timeout", DEFAULT_LOCK_TIMEOUT) if policy == "wait" else 0
+    project_name = conn_cfg.mergin_project.split("/")[1]
+    # the lock file must not be in the project directory - it would be seen as a change of the project
+    lock_file = os.path.join(config.working_dir, f".{project_name}.lock")
+
+    lock = lock_functions.ConnectionLock(lock_file, conn_cfg.conn_info, conn_cfg.base)
+    try:
+        os.makedirs(config.working_dir, exist_ok=True)
+        with timing_functions.span("lock", connection=conn_cfg.mergin_project):
+            locked = lock.acquire(timeout, cancel=stop_requested)
+    except (OSError, psycopg2.Error) as e:
+        raise DbSyncError(f"Unable to lock connection {conn_cfg.mergin_project}: {e}")
+
+    if not locked and stop_requested.is_set():
+        logging.info(f"Stopping, no longer waiting for lock of connection {conn_cfg.mergin_project}")
+        yield False
+        return
+    if not locked:
+        if policy == "skip":
+            logging.info(f"Connection {conn_cfg.mergin_project} is locked by another process, skipping it")
+            yield False
+            return
+        raise DbSyncError(f"Timeout waiting for lock of connection {conn_cfg.mergin_project} held by another process")
+
+    try:
+        # MerginProject object of the connection must not get closed by other threads while working with it
+        with _use_mergin_project(os.path.join(config.working_dir, project_name)):
+            yield True
+    finally:
+        lock.release()
+
+
+def is_init_current(conn_cfg) -> bool:
+    """
+    Returns whether the working directory of the connection is still at the version stored in the base schema,
+    i.e. nobody else synced the connection since our init (a cheap check, not verifying the data like init does)
+    """
+    work_dir = os.path.join(config.working_dir, conn_cfg.mergin_project.split("/")[1])
+    try:
+        with contextlib.closing(psycopg2.connect(conn_cfg.conn_info)) as conn:
+            if not _check_schema_exists(conn, conn_cfg.base):
+                return False
+            db_proj_info = _get_db_project_comment(conn, conn_cfg.base)
+        return (
+            bool(db_proj_info)
+            and "error" not in db_proj_info
+            and db_proj_info.get("version") == _get_project_version(work_dir)
         )
+    except (psycopg2.Error, InvalidProject, OSError) as e:
+        logging.debug(f"Unable to check init state of connection {conn_cfg.mergin_project}: {e}")
+        return False
+
+
+def dbsync_init(mc, connections=None):
+    from_gpkg = config.init_from.lower() == "gpkg"
+    for conn in config.connections if connections is None else connections:
+        if stop_requested.is_set():
+            break
+        with _lock_connection(conn) as locked:
+            if not locked:
+                continue
+            with _track_operation("init", conn), _time_limits(conn, mc):
+                init(
+                    conn,
+                    mc,
+                    from_gpkg=from_gpkg,
+                )
+                if conn.get("change_source", "diff") == "logical":
+                    _ensure_change_capture(conn)
+                else:
+                    _drop_unused_change_capture(conn)
 
     logging.debug("Init done!")
 
 
-def dbsync_pull(mc):
-    for conn in config.connections:
-        pull(conn, mc)
+def dbsync_pull(mc, connections=None):
+    # a failure of one connection (e.g. a timeout) does not stop processing of the others
+    errors = []
+    for conn in config.connections if connections is None else connections:
+        if stop_requested.is_set():
+            break
+        try:
+            with _lock_connection(conn) as locked:
+                if not locked:
+                    continue
+                with _track_operation("pull", conn), _time_limits(conn, mc):
+                    with profiling_functions.profile(conn.mergin_project):
+                        pull(conn, mc)
+        except DbSyncError as e:
+            errors.append((conn.mergin_project, e))
+    _raise_errors(errors)
 
     logging.debug("Pull done!")
 
 
-def dbsync_push(mc):
-    for conn in config.connections:
-        push(conn, mc)
+def dbsync_push(mc, connections=None, debounce=False):
+    errors = []
+    for conn in config.connections if connections is None else connections:
+        if stop_requested.is_set():
+            break
+        try:
+            with _lock_connection(conn) as locked:
+                if not locked:
+                    continue
+                with _track_operation("push", conn), _time_limits(conn, mc):
+                    with profiling_functions.profile(conn.mergin_project):
+                        push(conn, mc, debounce)
+        except DbSyncError as e:
+            errors.append((conn.mergin_project, e))
+    _raise_errors(errors)
 
     logging.debug("Push done!")
 
@@ -1481,6 +2642,8 @@ def clean(conn_cfg, mc):
     from_db = config.init_from.lower() == "db"
 
     if pathlib.Path(config.working_dir).exists():
+        for work_path in list(cached_mergin_project_objects):
+            _forget_mergin_project(work_path)
         try:
             shutil.rmtree(config.working_dir)
         except FileNotFoundError as e:
@@ -1512,6 +2675,8 @@ def clean(conn_cfg, mc):
     except psycopg2.Error as e:
         raise DbSyncError("Unable to connect to the database: " + str(e))
 
+    _drop_change_capture(conn_cfg)
+
     try:
         _drop_schema(
             conn_db,
@@ -1537,11 +2702,13 @@ def dbsync_clean(
     logging.debug("Cleaning done!")
 
 
-def close_mergin_project_file_logger(project_folder: pathlib.Path) -> None:
-    log = logging.getLogger("mergin.project." + str(project_folder))
-
-    for handler in log.handlers:
+def _close_file_handlers(log: logging.Logger) -> None:
+    for handler in list(log.handlers):
         if isinstance(handler, logging.FileHandler):
             log.removeHandler(handler)
             handler.flush()
             handler.close()
+
+
+def close_mergin_project_file_logger(project_folder: pathlib.Path) -> None:
+    _close_file_handlers(logging.getLogger("mergin.project." + str(project_folder)))
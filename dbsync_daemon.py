@@ -3,20 +3,31 @@
 # - pull
 # - push
 
+import _thread
 import argparse
+import concurrent.futures
 import datetime
 import logging
 import os
 import pathlib
 import platform
 import pprint
+import signal
 import sys
+import threading
 import time
+import typing
 
+import client_functions
+import control_functions
 import dbsync
-from config import ConfigError, config, update_config_path, validate_config
+import lock_functions
+import metrics_functions
+import profiling_functions
+import timing_functions
+from config import ConfigError, check_smtp_server, config, update_config_path, validate_config
 from log_functions import handle_error_and_exit, setup_logger
-from smtp_functions import send_email
+from smtp_functions import EmailNotifier, send_email
 from version import __version__
 
 
@@ -43,6 +54,158 @@ def pyinstaller_path_fix() -> None:
         pyinstaller_update_path()
 
 
+# how many seconds the connection being synced gets to finish on shutdown
+DEFAULT_SHUTDOWN_TIMEOUT = 25
+
+
+def _interrupt_main_thread() -> None:
+    """Sends SIGINT to the main thread, which interrupts also blocking calls (e.g. waiting for geodiff)"""
+    if hasattr(signal, "pthread_kill"):
+        signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+    else:
+        _thread.interrupt_main()
+
+
+def install_signal_handlers(scheduler: control_functions.SyncScheduler = None) -> None:
+    """
+    Makes SIGTERM and SIGINT stop the daemon gracefully: no further connections get processed and the one being
+    processed gets `shutdown_timeout` seconds to finish. Another signal, or the timeout, interrupts it.
+    """
+    timeout = config.get("daemon.shutdown_timeout", DEFAULT_SHUTDOWN_TIMEOUT)
+
+    def handle_signal(signum, frame):
+        if dbsync.stop_requested.is_set():
+            logging.warning("Sync interrupted, exiting")
+            sys.exit(1)
+        logging.info(f"Received {signal.Signals(signum).name}, stopping...")
+        dbsync.stop_requested.set()
+        if scheduler:
+            scheduler.stop()
+        timer = threading.Timer(timeout, _interrupt_main_thread)
+        timer.daemon = True
+        timer.start()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+
+# how many connections get initialized at the same time
+DEFAULT_INIT_WORKERS = 4
+
+
+def start_init(
+    mc, connections, scheduler: control_functions.SyncScheduler = None
+) -> typing.Dict[str, concurrent.futures.Future]:
+    """
+    Starts init of the connections in background threads, so that each connection can start syncing as soon as its own
+    init is done (the scheduler gets a sync request for it). Returns futures of inits by project names of connections.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(
+        config.get("daemon.init_workers", DEFAULT_INIT_WORKERS), thread_name_prefix="init"
+    )
+    futures = {}
+    for conn in connections:
+        future = executor.submit(dbsync.dbsync_init, mc, [conn])
+        if scheduler:
+
+            def request_sync(future, name=conn.mergin_project):
+                if not future.exception():
+                    scheduler.request("sync", name)
+
+            future.add_done_callback(request_sync)
+        futures[conn.mergin_project] = future
+    executor.shutdown(wait=False)
+    return futures
+
+
+def finish_init(futures: typing.Dict[str, concurrent.futures.Future]) -> None:
+    """
+    Waits for inits started by start_init(). When one of them fails, inits that did not start yet get cancelled
+    and the running ones get finished, then errors of all failed inits get raised together.
+    """
+    concurrent.futures.wait(futures.values(), return_when=concurrent.futures.FIRST_EXCEPTION)
+    for future in futures.values():
+        future.cancel()  # does nothing to inits that are running or done
+    concurrent.futures.wait(futures.values())
+    errors = []
+    for name, future in futures.items():
+        if future.cancelled() or future.exception() is None:
+            continue
+        if not isinstance(future.exception(), dbsync.DbSyncError):
+            raise future.exception()
+        errors.append((name, future.exception()))
+    if errors:
+        raise dbsync.SyncErrors(errors)
+
+
+def init_claimed(mc, connections, borrowed, initialized: set, current: set) -> typing.Tuple[list, list]:
+    """
+    Initializes connections claimed by this instance that need it - those never initialized by this instance get
+    a full init, the others only if another instance synced them in the meantime (their version changed).
+    Connections are initialized one by one, a failure of one does not stop init of the others.
+    Updates `initialized` (connections ever initialized by this instance) and `current` (connections claimed
+    since their init, nobody else could sync them). Returns connections ready to sync and errors of the others.
+    """
+    ready, errors = [], []
+    for conn in connections:
+        name = conn.mergin_project
+        if name in current:
+            ready.append(conn)
+            continue
+        try:
+            if name not in initialized or not dbsync.is_init_current(conn):
+                dbsync.dbsync_init(mc, [conn])
+        except dbsync.DbSyncError as e:
+            initialized.discard(name)
+            errors.append((name, e))
+            continue
+        initialized.add(name)
+        if name not in borrowed:
+            # borrowed connections get synced by their own instance again once it is back
+            current.add(name)
+        ready.append(conn)
+    return ready, errors
+
+
+def run_sync(mc, pull_connections=None, push_connections=None, debounce=False) -> None:
+    """
+    Pulls and then pushes the connections (all connections if None). Connections that failed to pull do not get
+    pushed, but the others do. Raises SyncErrors with errors of all connections that failed.
+    """
+    errors = []
+    logging.debug("Trying to pull")
+    try:
+        dbsync.dbsync_pull(mc, pull_connections)
+    except dbsync.SyncErrors as e:
+        errors.extend(e.errors)
+        failed = {name for name, _ in e.errors}
+        candidates = config.connections if push_connections is None else push_connections
+        push_connections = [conn for conn in candidates if conn.mergin_project not in failed]
+
+    logging.debug("Trying to push")
+    try:
+        dbsync.dbsync_push(mc, push_connections, debounce=debounce)
+    except dbsync.SyncErrors as e:
+        errors.extend(e.errors)
+
+    if errors:
+        raise dbsync.SyncErrors(errors)
+
+
+def run_in_background(function, *args) -> concurrent.futures.Future:
+    """Runs the function in a daemon thread (which does not keep the daemon running when it stops)"""
+    future = concurrent.futures.Future()
+
+    def run():
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name=function.__name__, daemon=True).start()
+    return future
+
+
 def main():
     pyinstaller_path_fix()
 
@@ -97,6 +260,31 @@ def main():
         action="store_true",
         help="Send test notification email using the `notification` settings. Should be used to validate settings.",
     )
+    parser.add_argument(
+        "--profile-cycles",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Profile pull and push of each connection in the first N sync cycles and write .pstats file for each connection.",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=".",
+        help="Directory to write profiles to when using `--profile-cycles`. Default value is current working directory.",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        type=int,
+        nargs="?",
+        const=10,
+        metavar="N",
+        help="Trace memory allocations and log the biggest differences between snapshots taken every N sync cycles (default 10).",
+    )
+    parser.add_argument(
+        "--shard",
+        metavar="i/N",
+        help="Process only connections of the i-th of N shards (zero-based), to split connections between N daemon instances.",
+    )
     parser.add_argument(
         "--show-config",
         action="store_true",
@@ -124,7 +312,8 @@ def main():
 
     sleep_time = config.as_int("daemon.sleep_time")
     try:
-        validate_config(config)
+        # connecting to the SMTP server may take a while - the daemon checks it in background
+        validate_config(config, check_smtp=args.single_run or args.test_notification_email)
     except ConfigError as e:
         handle_error_and_exit(e)
 
@@ -145,71 +334,185 @@ def main():
     if args.force_init and args.skip_init:
         handle_error_and_exit("Cannot use `--force-init` with `--skip-init` Initialization is required. ")
 
+    coordinator = None
+    if args.shard or config.get("daemon.coordination", False):
+        try:
+            shard, shards = lock_functions.parse_shard(args.shard) if args.shard else (0, 1)
+        except ValueError as e:
+            handle_error_and_exit(e)
+        coordinator = lock_functions.ConnectionCoordinator(
+            shard, shards, use_locks=config.get("daemon.coordination", False)
+        )
+
+    if args.profile_cycles > 0:
+        profiling_functions.start_profiling(args.profile_cycles, args.profile_dir)
+
+    if args.trace_memory is not None:
+        if args.trace_memory < 1:
+            handle_error_and_exit("The `--trace-memory` interval must be a positive number of cycles.")
+        profiling_functions.start_memory_tracing()
+
     logging.debug("Logging in to Mergin...")
 
-    mc = dbsync.create_mergin_client()
+    # the client is shared by all connections and its auth token gets refreshed in background
+    client_manager = client_functions.MerginClientManager(config, dbsync.create_mergin_client)
+    mc = client_manager.client()
 
     if args.force_init:
         dbsync.dbsync_clean(mc)
 
     if args.single_run:
+        install_signal_handlers()
+
+        # connections of this instance (all connections if there is no coordination)
+        connections = coordinator.claim(config.connections) if coordinator else None
+
         if not args.skip_init:
             try:
-                dbsync.dbsync_init(mc)
+                finish_init(start_init(mc, config.connections if connections is None else connections))
             except dbsync.DbSyncError as e:
+                dbsync.stop_requested.set()
                 handle_error_and_exit(e)
 
+        timing_functions.start_cycle()
         try:
-            logging.debug("Trying to pull")
-            dbsync.dbsync_pull(mc)
-
-            logging.debug("Trying to push")
-            dbsync.dbsync_push(mc)
-
+            run_sync(mc, connections, connections)
         except dbsync.DbSyncError as e:
             handle_error_and_exit(e)
+        finally:
+            if coordinator:
+                coordinator.close()
+            client_manager.close()
+            logging.debug(timing_functions.cycle_summary())
+            profiling_functions.end_cycle()
+            profiling_functions.log_memory_diff()
 
     else:
-        if not args.skip_init:
+        if "metrics_port" in config.daemon:
             try:
-                dbsync.dbsync_init(mc)
-            except dbsync.DbSyncError as e:
-                handle_error_and_exit(e)
-
-        last_email_sent = None
-
-        while True:
+                metrics_functions.start_http_server(
+                    config.daemon.metrics_port,
+                    config.daemon.get("metrics_host", "127.0.0.1"),
+                )
+            except OSError as e:
+                handle_error_and_exit(f"Unable to start metrics server: {e}")
+
+        smtp_check = None
+        if send_notifications:
+            smtp_check = run_in_background(check_smtp_server, config)
+
+        # waits for the next cycle, on-demand requests and connections that finished init
+        scheduler = control_functions.SyncScheduler([conn.mergin_project for conn in config.connections])
+        if "control_port" in config.daemon:
+            try:
+                control_functions.start_http_server(
+                    scheduler,
+                    config.daemon.control_port,
+                    config.daemon.get("control_host", "127.0.0.1"),
+                )
+            except OSError as e:
+                handle_error_and_exit(f"Unable to start control server: {e}")
+
+        install_signal_handlers(scheduler)
+
+        init_futures = {}  # connections being initialized (they do not get synced until init is done)
+        if not args.skip_init and not coordinator:
+            init_futures = start_init(mc, config.connections, scheduler)
+
+        # emails get sent in background, not to delay syncing
+        notifier = EmailNotifier(config) if send_notifications else None
+        cycle = 0
+        initialized = set()  # connections initialized by this instance
+        current = set()  # connections claimed by this instance since their init
+        requested = {}  # on-demand requests (project name -> operations) to run instead of a regular cycle
+
+        while not dbsync.stop_requested.is_set():
+            cycle += 1
             print(datetime.datetime.now())
 
+            for name, future in list(init_futures.items()):
+                if future.done():
+                    if future.exception():
+                        # the other inits get finished, so that all failures are reported
+                        try:
+                            finish_init(init_futures)
+                        except Exception as e:
+                            dbsync.stop_requested.set()
+                            handle_error_and_exit(e)
+                    del init_futures[name]
+
+            timing_functions.start_cycle()
             try:
-                logging.debug("Trying to pull")
-                dbsync.dbsync_pull(mc)
-
-                logging.debug("Trying to push")
-                dbsync.dbsync_push(mc)
-
-                # check mergin client token expiration
-                delta = mc._auth_session["expire"] - datetime.datetime.now(datetime.timezone.utc)
-                if delta.total_seconds() < 3600:
-                    mc = dbsync.create_mergin_client()
+                connections = None
+                init_errors = []
+                if init_futures:
+                    connections = [conn for conn in config.connections if conn.mergin_project not in init_futures]
+                if coordinator:
+                    connections = coordinator.claim(config.connections)
+                    # (re)claimed connections may have been synced by another instance - init updates working dir
+                    current &= {
+                        conn.mergin_project for conn in connections if conn.mergin_project not in coordinator.borrowed
+                    }
+                    if not args.skip_init:
+                        connections, init_errors = init_claimed(
+                            mc, connections, coordinator.borrowed, initialized, current
+                        )
+
+                pull_connections = push_connections = connections
+                if requested:
+                    logging.debug(f"Running on-demand sync: {requested}")
+                    candidates = config.connections if connections is None else connections
+                    pull_connections = [c for c in candidates if "pull" in requested.get(c.mergin_project, ())]
+                    push_connections = [c for c in candidates if "push" in requested.get(c.mergin_project, ())]
+
+                # pushes requested on demand are not deferred until the database changes are quiet
+                try:
+                    run_sync(mc, pull_connections, push_connections, debounce=not requested)
+                except dbsync.SyncErrors as e:
+                    init_errors.extend(e.errors)
+                if init_errors:
+                    raise dbsync.SyncErrors(init_errors)
 
             except dbsync.DbSyncError as e:
                 logging.error(str(e))
-                if send_notifications:
-                    if "minimal_email_interval" in config.notification:
-                        min_time_delta_hr = config.notification.minimal_email_interval
+                if notifier:
+                    if isinstance(e, dbsync.SyncErrors):
+                        for name, error in e.errors:
+                            notifier.notify(str(error), name)
                     else:
-                        min_time_delta_hr = 4
-
-                    if (
-                        last_email_sent is None
-                        or (datetime.datetime.now() - last_email_sent).total_seconds() > min_time_delta_hr * 3600
-                    ):
-                        send_email(str(e), config)
-                        last_email_sent = datetime.datetime.now()
-
+                        notifier.notify(str(e))
+
+            if coordinator:
+                coordinator.release_borrowed()
+
+            logging.debug(timing_functions.cycle_summary())
+            profiling_functions.end_cycle()
+            if args.trace_memory is not None and cycle % args.trace_memory == 0:
+                logging.info(f"Cached Mergin Maps projects: {len(dbsync.cached_mergin_project_objects)}")
+                profiling_functions.log_memory_diff()
+
+            if smtp_check is not None and smtp_check.done():
+                if smtp_check.exception():
+                    # syncing works without notifications - it does not get stopped
+                    logging.error(f"{smtp_check.exception()}\nEmail notifications are disabled.")
+                    notifier.stop(timeout=0)
+                    notifier = None
+                smtp_check = None
+
+            if dbsync.stop_requested.is_set():
+                break
+            if not requested:
+                next_cycle = time.monotonic() + sleep_time
             logging.debug("Going to sleep")
-            time.sleep(sleep_time)
+            # on-demand requests wake the daemon up (right away on shutdown), they do not postpone the next regular cycle
+            requested = scheduler.wait(next_cycle - time.monotonic())
+
+        if coordinator:
+            coordinator.close()
+        if notifier:
+            notifier.stop(timeout=5)
+        client_manager.close()
+        logging.info("Daemon stopped")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,393 @@
+"""
+Mergin Maps DB Sync - a tool for two-way synchronization between Mergin Maps and a PostGIS database
+
+Copyright (C) 2024 Lutra Consulting
+
+License: MIT
+
+Load generator for capacity planning. It creates a number of synthetic projects (using the
+Mergin Maps server and database from the config file), keeps editing rows in the database
+("office" edits) and in Mergin Maps ("field" edits pushed by another client) at a given rate
+in background threads, and meanwhile runs the sync loop like the daemon does. At the end it
+reports rows per second synced in each direction, how often a rebase was needed, and the first
+cycle that took longer than `daemon.sleep_time`. The edit rate can be increased after each
+cycle (`--ramp`) to find the rate that the given number of projects can sustain.
+
+    python3 dbsync_load_generator.py config.yaml --workspace test --projects 50 --rows 10000 --rate 5 --cycles 30
+"""
+
+import abc
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+import psycopg2
+from mergin import ClientError
+
+import dbsync
+import metrics_functions
+import timing_functions
+from benchmarks import dataset
+from config import ConfigError, config, update_config_path, validate_config
+from log_functions import handle_error_and_exit, setup_logger
+
+SYNC_FILE = "load.gpkg"
+
+# parity of fids of rows edited in the database and in Mergin Maps (so that edits do not conflict)
+DB_PARITY = 0
+FIELD_PARITY = 1
+
+
+class EditWriter(threading.Thread, abc.ABC):
+    """Background thread that edits rows of all projects at a rate (rows per second per project)"""
+
+    def __init__(self, name: str, projects: list, rate: float, interval: float, tables: int, seed: int):
+        super().__init__(name=name, daemon=True)
+        self.projects = projects
+        self.rate = rate
+        self.interval = interval
+        self.tables = tables
+        self.rng = random.Random(seed)
+        self.rows_written = 0
+        self.errors = 0
+        self.stopped = threading.Event()
+        self._pending = {project["name"]: 0.0 for project in projects}  # fractions of rows not yet written
+
+    def run(self):
+        last = time.monotonic()
+        while not self.stopped.wait(self.interval):
+            now = time.monotonic()
+            for project in self.projects:
+                self._pending[project["name"]] += self.rate * (now - last)
+                count = int(self._pending[project["name"]])
+                if count == 0:
+                    continue
+                try:
+                    self.rows_written += self.edit(project, count)
+                    self._pending[project["name"]] -= count
+                except Exception as e:
+                    self.errors += 1
+                    logging.warning(f"{self.name}: failed to edit {project['name']}: {e}")
+            last = now
+
+    @abc.abstractmethod
+    def edit(self, project: dict, count: int) -> int:
+        """Edits `count` rows of the project and returns how many rows got edited"""
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class DbWriter(EditWriter):
+    """Edits rows in the `modified` schema of each project"""
+
+    def __init__(self, conn_info: str, *args, **kwargs):
+        super().__init__("db-writer", *args, **kwargs)
+        self.conn_info = conn_info
+        self.conn = None
+
+    def run(self):
+        self.conn = psycopg2.connect(self.conn_info)
+        try:
+            super().run()
+        finally:
+            self.conn.close()
+
+    def edit(self, project: dict, count: int) -> int:
+        table = dataset.table_name(self.rng.randrange(self.tables))
+        return dataset.edit_db_rows(self.conn, project["modified"], table, count, DB_PARITY, self.rng)
+
+
+class FieldWriter(EditWriter):
+    """Edits rows in a separate copy of each Mergin Maps project and pushes them to the server"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__("field-writer", *args, **kwargs)
+        self.mc = dbsync.create_mergin_client()
+
+    def edit(self, project: dict, count: int) -> int:
+        table = dataset.table_name(self.rng.randrange(self.tables))
+        edits = dataset.edit_gpkg_rows(
+            os.path.join(project["field_dir"], SYNC_FILE), table, count, FIELD_PARITY, rng=self.rng
+        )
+        try:
+            self.mc.pull_project(project["field_dir"])
+            self.mc.push_project(project["field_dir"])
+        except ClientError as e:
+            # edits stay in the local copy and get pushed next time
+            logging.warning(f"{self.name}: failed to push {project['name']}: {e}")
+            self.errors += 1
+        return edits
+
+
+def find_leftovers(mc, project: dict, conn_info: str) -> list:
+    """Returns descriptions of existing data (e.g. from a previous run) that setup of the project would delete"""
+    name = project["name"].split("/")[1]
+    leftovers = []
+    try:
+        mc.project_info(project["name"])
+        leftovers.append(f"Mergin Maps project {project['name']}")
+    except ClientError:
+        pass
+    conn = psycopg2.connect(conn_info)
+    try:
+        leftovers.extend(
+            f"schema {schema}"
+            for schema in (project["base"], project["modified"])
+            if dbsync._check_schema_exists(conn, schema)
+        )
+    finally:
+        conn.close()
+    leftovers.extend(
+        f"directory {path}"
+        for path in (os.path.join(config.working_dir, name), project["field_dir"])
+        if os.path.exists(path)
+    )
+    return leftovers
+
+
+def setup_projects(mc, args, conn_info: str) -> list:
+    """
+    Creates synthetic Mergin Maps projects with their "field" copies and initializes the sync. Projects, schemas
+    and directories that already exist get deleted only with `--recreate`, otherwise DbSyncError is raised.
+    """
+    projects = []
+    connections = []
+    for i in range(args.projects):
+        name = f"dbsync_load_{i}"
+        projects.append(
+            {
+                "name": f"{args.workspace}/{name}",
+                "modified": f"{name}_main",
+                "base": f"{name}_base",
+                "field_dir": os.path.join(args.work_dir, f"{name}_field"),
+            }
+        )
+
+    if not args.recreate:
+        leftovers = [leftover for project in projects for leftover in find_leftovers(mc, project, conn_info)]
+        if leftovers:
+            raise dbsync.DbSyncError("These already exist (use --recreate to delete them): " + ", ".join(leftovers))
+
+    for project in projects:
+        name = project["name"].split("/")[1]
+        conn = psycopg2.connect(conn_info)
+        dbsync._drop_schema(conn, project["base"])
+        dbsync._drop_schema(conn, project["modified"])
+        conn.close()
+        shutil.rmtree(os.path.join(config.working_dir, name), ignore_errors=True)
+        shutil.rmtree(project["field_dir"], ignore_errors=True)
+        try:
+            mc.delete_project_now(project["name"])
+        except ClientError:
+            pass
+
+        mc.create_project(project["name"])
+        mc.download_project(project["name"], project["field_dir"])
+        dataset.create_gpkg(os.path.join(project["field_dir"], SYNC_FILE), args.rows, args.tables)
+        mc.push_project(project["field_dir"])
+
+        connections.append(
+            {
+                "driver": "postgres",
+                "conn_info": conn_info,
+                "modified": project["modified"],
+                "base": project["base"],
+                "mergin_project": project["name"],
+                "sync_file": SYNC_FILE,
+            }
+        )
+
+    config.update({"CONNECTIONS": connections, "init_from": "gpkg"})
+    validate_config(config)
+    logging.info(f"Initializing sync of {len(projects)} projects...")
+    dbsync.dbsync_init(mc)
+    return projects
+
+
+def cleanup_projects(mc, projects: list, conn_info: str) -> None:
+    conn = psycopg2.connect(conn_info)
+    for project in projects:
+        dbsync._forget_mergin_project(os.path.join(config.working_dir, project["name"].split("/")[1]))
+        shutil.rmtree(os.path.join(config.working_dir, project["name"].split("/")[1]), ignore_errors=True)
+        shutil.rmtree(project["field_dir"], ignore_errors=True)
+        dbsync._drop_schema(conn, project["base"])
+        dbsync._drop_schema(conn, project["modified"])
+        try:
+            mc.delete_project_now(project["name"])
+        except ClientError as e:
+            logging.warning(f"Unable to delete project {project['name']}: {e}")
+    conn.close()
+
+
+def synced_rows(projects: list, direction: str) -> int:
+    return sum(
+        metrics_functions.CHANGESET_ROWS.value(connection=project["name"], direction=direction, type=change_type)
+        for project in projects
+        for change_type in ("insert", "update", "delete")
+    )
+
+
+def run_load(mc, args, projects: list, conn_info: str, sleep_time: float) -> dict:
+    db_writer = DbWriter(conn_info, projects, args.rate, args.interval, args.tables, args.seed)
+    field_writer = FieldWriter(projects, args.rate, args.interval, args.tables, args.seed + 1)
+    db_writer.start()
+    field_writer.start()
+
+    cycles = []
+    overrun = None
+    start = time.monotonic()
+    try:
+        for cycle in range(1, args.cycles + 1):
+            timing_functions.start_cycle()
+            cycle_start = time.monotonic()
+            error = None
+            try:
+                dbsync.dbsync_pull(mc)
+                dbsync.dbsync_push(mc)
+            except dbsync.DbSyncError as e:
+                error = str(e)
+                logging.error(error)
+            duration = time.monotonic() - cycle_start
+            cycles.append({"cycle": cycle, "rate": db_writer.rate, "duration": duration, "error": error})
+            logging.info(f"Cycle {cycle}: {duration:.2f}s at {db_writer.rate:.1f} rows/s per project and side")
+            logging.debug(timing_functions.cycle_summary())
+
+            if overrun is None and duration > sleep_time:
+                overrun = cycles[-1]
+                logging.info(f"Cycle {cycle} took longer than sleep_time ({sleep_time}s)")
+                if args.stop_on_overrun:
+                    break
+
+            db_writer.rate *= args.ramp
+            field_writer.rate *= args.ramp
+            time.sleep(sleep_time)
+    finally:
+        db_writer.stop()
+        field_writer.stop()
+    elapsed = time.monotonic() - start
+
+    durations = [c["duration"] for c in cycles]
+    rebases = sum(metrics_functions.REBASES.value(connection=project["name"]) for project in projects)
+    pulls = synced_rows(projects, "pull")
+    pushes = synced_rows(projects, "push")
+    return {
+        "projects": len(projects),
+        "rows": args.rows,
+        "tables": args.tables,
+        "sleep_time": sleep_time,
+        "elapsed": elapsed,
+        "cycles": cycles,
+        "cycle_duration_mean": sum(durations) / len(durations) if durations else 0,
+        "cycle_duration_max": max(durations, default=0),
+        "first_overrun": overrun,
+        "rows_written": {"db": db_writer.rows_written, "mergin": field_writer.rows_written},
+        "rows_synced": {"push": pushes, "pull": pulls},
+        "rows_per_second": {"push": pushes / elapsed, "pull": pulls / elapsed},
+        "rebases": rebases,
+        "rebase_frequency": rebases / (len(cycles) * len(projects)) if cycles else 0,
+        "errors": {
+            "sync": sum(1 for c in cycles if c["error"]),
+            "db_writer": db_writer.errors,
+            "field_writer": field_writer.errors,
+        },
+    }
+
+
+def print_report(report: dict) -> None:
+    logging.info("== Load test results ==")
+    logging.info(f"Projects: {report['projects']} ({report['rows']} rows in {report['tables']} tables each)")
+    logging.info(f"Cycles: {len(report['cycles'])} in {report['elapsed']:.1f}s")
+    logging.info(f"Cycle duration: mean {report['cycle_duration_mean']:.2f}s, max {report['cycle_duration_max']:.2f}s")
+    logging.info(
+        f"Rows written: {report['rows_written']['db']} in DB, {report['rows_written']['mergin']} in Mergin Maps"
+    )
+    for direction, label in (("push", "DB -> Mergin Maps"), ("pull", "Mergin Maps -> DB")):
+        logging.info(
+            f"Rows synced {label}: {report['rows_synced'][direction]} "
+            f"({report['rows_per_second'][direction]:.1f} rows/s)"
+        )
+    logging.info(f"Rebases: {report['rebases']} ({report['rebase_frequency']:.0%} of pulls of a project)")
+    overrun = report["first_overrun"]
+    if overrun:
+        logging.info(
+            f"Cycle {overrun['cycle']} exceeded sleep_time ({report['sleep_time']}s): took {overrun['duration']:.2f}s "
+            f"at {overrun['rate']:.1f} rows/s per project and side"
+        )
+    else:
+        logging.info(f"No cycle exceeded sleep_time ({report['sleep_time']}s)")
+    logging.info(f"Errors: {report['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="dbsync_load_generator.py",
+        description="Measures sustained sync throughput of DB Sync under concurrent edits in DB and Mergin Maps.",
+        epilog="www.merginmaps.com",
+    )
+    parser.add_argument("config_file", nargs="?", default="config.yaml", help="Path to file with configuration.")
+    parser.add_argument("--workspace", required=True, help="Mergin Maps workspace to create test projects in.")
+    parser.add_argument("--db-conninfo", help="Database connection (default is conn_info of the first connection).")
+    parser.add_argument("--projects", type=int, default=1, help="Number of synced projects.")
+    parser.add_argument("--rows", type=int, default=10000, help="Number of rows per table.")
+    parser.add_argument("--tables", type=int, default=1, help="Number of tables per project.")
+    parser.add_argument("--rate", type=float, default=1.0, help="Edited rows per second per project on each side.")
+    parser.add_argument("--ramp", type=float, default=1.0, help="Factor to multiply the rate with after each cycle.")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between batches of edits.")
+    parser.add_argument("--cycles", type=int, default=10, help="Number of sync cycles to run.")
+    parser.add_argument("--sleep-time", type=float, help="Sleep between cycles (default is daemon.sleep_time).")
+    parser.add_argument("--stop-on-overrun", action="store_true", help="Stop when a cycle exceeds sleep_time.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random choice of edited rows.")
+    parser.add_argument("--work-dir", help="Directory for copies of projects edited in the field.")
+    parser.add_argument("--output", help="File to write the results to (JSON).")
+    parser.add_argument("--keep", action="store_true", help="Keep projects and schemas after the run.")
+    parser.add_argument(
+        "--recreate", action="store_true", help="Delete projects and schemas left from a previous run (if any)."
+    )
+    args = parser.parse_args()
+
+    setup_logger()
+    logging.getLogger().handlers[-1].setLevel(logging.INFO)
+
+    try:
+        update_config_path(args.config_file)
+    except IOError as e:
+        handle_error_and_exit(e)
+
+    sleep_time = args.sleep_time if args.sleep_time is not None else config.as_int("daemon.sleep_time")
+    conn_info = args.db_conninfo
+    if conn_info is None:
+        if not config.get("connections"):
+            handle_error_and_exit("Database connection must be set with --db-conninfo or in the config file")
+        conn_info = config.connections[0].conn_info
+    if args.work_dir is None:
+        args.work_dir = tempfile.mkdtemp(prefix="dbsync-load-")
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    try:
+        mc = dbsync.create_mergin_client()
+        projects = setup_projects(mc, args, conn_info)
+    except (dbsync.DbSyncError, ClientError, ConfigError) as e:
+        handle_error_and_exit(e)
+
+    try:
+        report = run_load(mc, args, projects, conn_info, sleep_time)
+    finally:
+        if not args.keep:
+            cleanup_projects(mc, projects, conn_info)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
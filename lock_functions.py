@@ -0,0 +1,207 @@
+"""
+Mergin Maps DB Sync - a tool for two-way synchronization between Mergin Maps and a PostGIS database
+
+Copyright (C) 2024 Lutra Consulting
+
+License: MIT
+"""
+
+import logging
+import threading
+import time
+import typing
+import zlib
+
+import psycopg2
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows - only the advisory lock is used there
+    fcntl = None
+
+# First keys of the two-key PostgreSQL advisory locks taken by DB Sync, the second key is derived from the name
+# of the base schema of the connection (see advisory_lock_key())
+OWNERSHIP_LOCK_CLASS = 0x44420001  # held by the daemon instance that processes the connection
+OPERATION_LOCK_CLASS = 0x44420002  # held by the process running init/pull/push of the connection
+
+
+def advisory_lock_key(name: str) -> int:
+    """Returns a stable 32-bit signed integer for the name, to be used as a key of an advisory lock"""
+    key = zlib.crc32(name.encode("utf-8"))
+    return key - 2**32 if key >= 2**31 else key
+
+
+def parse_shard(value: str) -> typing.Tuple[int, int]:
+    """Parses shard assignment in "i/N" format (i is zero-based), raises ValueError if it is not valid"""
+    try:
+        shard, shards = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{value}', expected format is i/N (e.g. 0/2)")
+    if shards < 1 or not 0 <= shard < shards:
+        raise ValueError(f"Invalid shard '{value}', i must be between 0 and N-1")
+    return shard, shards
+
+
+def connection_shard(conn_cfg, shards: int) -> int:
+    """Returns shard of the connection - based on the project name, so it does not depend on order of connections"""
+    return zlib.crc32(conn_cfg.mergin_project.encode("utf-8")) % shards
+
+
+class ConnectionCoordinator:
+    """
+    Decides which connections get processed by this daemon instance, so that multiple instances
+    (possibly on different hosts) can split the connections of the same config file.
+
+    Connections are assigned to shards by their project name. Without advisory locks, the instance
+    processes connections of its shard only. With advisory locks, the instance takes a session-level
+    lock for each connection of its shard and keeps it while it is running - if it dies, the lock
+    is released by PostgreSQL. Other instances then take over its connections: in each cycle they
+    lock connections of other shards that nobody holds and release them at the end of the cycle,
+    so that the connections return to their shard once its instance is back.
+    """
+
+    def __init__(self, shard: int = 0, shards: int = 1, use_locks: bool = True):
+        self.shard = shard
+        self.shards = shards
+        self.use_locks = use_locks
+        self.owned = {}  # key = project name of a connection of our shard locked by us, value = its conn_info
+        self.borrowed = {}  # key = project name, value = connection config locked by us until end of the cycle
+        self._db_conns = {}  # key = conn_info, value = database connection holding the locks
+
+    def _db_conn(self, conn_info: str) -> psycopg2.extensions.connection:
+        """Returns database connection used for locks, reconnecting (and forgetting its locks) if it got broken"""
+        conn = self._db_conns.get(conn_info)
+        if conn is not None:
+            try:
+                conn.cursor().execute("SELECT 1")
+                return conn
+            except psycopg2.Error:
+                logging.warning("Lost database connection holding advisory locks, connections will be claimed again")
+                del self._db_conns[conn_info]
+                self.owned = {name: info for name, info in self.owned.items() if info != conn_info}
+        conn = psycopg2.connect(conn_info)
+        conn.autocommit = True
+        self._db_conns[conn_info] = conn
+        return conn
+
+    def _lock(self, conn_cfg, lock: bool) -> bool:
+        cur = self._db_conn(conn_cfg.conn_info).cursor()
+        function = "pg_try_advisory_lock" if lock else "pg_advisory_unlock"
+        cur.execute(f"SELECT {function}(%s, %s)", (OWNERSHIP_LOCK_CLASS, advisory_lock_key(conn_cfg.base)))
+        return cur.fetchone()[0]
+
+    def claim(self, connections) -> list:
+        """Returns connections to be processed in this cycle - those of our shard first, then taken over ones"""
+        ours = [c for c in connections if connection_shard(c, self.shards) == self.shard]
+        if not self.use_locks:
+            return ours
+
+        claimed = []
+        others = [c for c in connections if connection_shard(c, self.shards) != self.shard]
+        for conn_cfg in ours + others:
+            name = conn_cfg.mergin_project
+            try:
+                if name in self.owned:
+                    self._db_conn(conn_cfg.conn_info)  # the lock is lost if its database connection got broken
+                if name in self.owned:
+                    claimed.append(conn_cfg)
+                elif self._lock(conn_cfg, True):
+                    if connection_shard(conn_cfg, self.shards) == self.shard:
+                        logging.info(f"Connection {name} claimed by this instance")
+                        self.owned[name] = conn_cfg.conn_info
+                    else:
+                        logging.info(f"Connection {name} of shard {connection_shard(conn_cfg, self.shards)} taken over")
+                        self.borrowed[name] = conn_cfg
+                    claimed.append(conn_cfg)
+            except psycopg2.Error as e:
+                logging.error(f"Unable to lock connection {name}: {e}")
+        return claimed
+
+    def release_borrowed(self) -> None:
+        """Releases connections of other shards taken over in this cycle"""
+        for conn_cfg in self.borrowed.values():
+            try:
+                self._lock(conn_cfg, False)
+            except psycopg2.Error as e:
+                logging.warning(f"Unable to unlock connection {conn_cfg.mergin_project}: {e}")
+        self.borrowed.clear()
+
+    def close(self) -> None:
+        """Releases all locks by closing the database connections"""
+        for conn in self._db_conns.values():
+            conn.close()
+        self._db_conns.clear()
+        self.owned.clear()
+        self.borrowed.clear()
+
+
+class ConnectionLock:
+    """
+    Exclusive lock of a connection held while an operation (init/pull/push) runs, so that concurrent
+    DB Sync processes (e.g. the daemon and a --single-run cron job) never work with the same connection
+    at the same time. It consists of a file lock in the working directory (processes sharing the working
+    directory on this host) and an advisory lock on the base schema (processes on other hosts).
+    """
+
+    def __init__(self, lock_file: str, conn_info: str, base_schema: str):
+        self.lock_file = lock_file
+        self.conn_info = conn_info
+        self.base_schema = base_schema
+        self._file = None
+        self._db_conn = None
+
+    def _try_lock_file(self) -> bool:
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _try_lock_db(self) -> bool:
+        cur = self._db_conn.cursor()
+        cur.execute("SELECT pg_try_advisory_lock(%s, %s)", (OPERATION_LOCK_CLASS, advisory_lock_key(self.base_schema)))
+        return cur.fetchone()[0]
+
+    def acquire(
+        self, timeout: typing.Optional[float] = None, poll_interval: float = 0.5, cancel: threading.Event = None
+    ) -> bool:
+        """
+        Tries to take both locks, waiting at most `timeout` seconds (None = forever, 0 = do not wait) or until
+        `cancel` gets set. Returns False if they are held by somebody else. Raises OSError or psycopg2.Error on failure.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        cancel = cancel or threading.Event()
+        self._file = open(self.lock_file, "a")
+        try:
+            self._db_conn = psycopg2.connect(self.conn_info)
+            self._db_conn.autocommit = True
+            while True:
+                if self._try_lock_file():
+                    if self._try_lock_db():
+                        return True
+                    self._unlock_file()
+                if cancel.is_set() or (deadline is not None and time.monotonic() >= deadline):
+                    self.release()
+                    return False
+                cancel.wait(
+                    poll_interval if deadline is None else max(0.0, min(poll_interval, deadline - time.monotonic()))
+                )
+        except Exception:
+            self.release()
+            raise
+
+    def _unlock_file(self) -> None:
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def release(self) -> None:
+        """Releases the locks - closing the file and the database connection does it"""
+        if self._db_conn is not None:
+            self._db_conn.close()
+            self._db_conn = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
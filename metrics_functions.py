@@ -0,0 +1,288 @@
+"""
+Mergin Maps DB Sync - a tool for two-way synchronization between Mergin Maps and a PostGIS database
+
+Copyright (C) 2024 Lutra Consulting
+
+License: MIT
+"""
+
+import collections
+import contextlib
+import http.server
+import logging
+import math
+import threading
+import time
+
+import timing_functions
+
+DEFAULT_DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label_value(value)}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """Base class of metrics - keeps values for each combination of label values"""
+
+    type = None
+
+    def __init__(self, name: str, documentation: str, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"Metric {self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _samples(self):
+        """Returns list of (suffix, labels, value) tuples"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            samples = self._samples()
+        for suffix, labels, value in samples:
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """Returns current value of the counter (zero if it has not been incremented yet)"""
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def _samples(self):
+        return [("", dict(zip(self.label_names, key)), value) for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        """Returns current value of the gauge (None if it has not been set yet)"""
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key)
+
+    def _samples(self):
+        return [("", dict(zip(self.label_names, key)), value) for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names=(), buckets=DEFAULT_DURATION_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            bucket_counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_counts[i] += 1
+            self._values[key] = (bucket_counts, total + value)
+
+    def _samples(self):
+        samples = []
+        for key, (bucket_counts, total) in self._values.items():
+            labels = dict(zip(self.label_names, key))
+            for bound, count in zip(self.buckets, bucket_counts):
+                samples.append(("_bucket", {**labels, "le": _format_value(bound)}, count))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, bucket_counts[-1]))
+        return samples
+
+
+class Summary(Metric):
+    """Reports quantiles of the most recent observations (up to max_samples of them)"""
+
+    type = "summary"
+
+    def __init__(self, name: str, documentation: str, label_names=(), quantiles=(0.5, 0.9, 0.99), max_samples=1000):
+        super().__init__(name, documentation, label_names)
+        self.quantiles = quantiles
+        self.max_samples = max_samples
+
+    def observe(self, value, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            samples, count, total = self._values.get(key, (collections.deque(maxlen=self.max_samples), 0, 0.0))
+            samples.append(value)
+            self._values[key] = (samples, count + 1, total + value)
+
+    def _samples(self):
+        samples = []
+        for key, (values, count, total) in self._values.items():
+            labels = dict(zip(self.label_names, key))
+            values = sorted(values)
+            for quantile in self.quantiles:
+                index = min(len(values) - 1, max(0, math.ceil(quantile * len(values)) - 1))
+                samples.append(("", {**labels, "quantile": str(quantile)}, values[index]))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return samples
+
+
+# All created metrics, in the order they get rendered
+registry = []
+
+SYNC_DURATION = Histogram(
+    "dbsync_sync_duration_seconds",
+    "Duration of init/pull/push of a connection.",
+    ["connection", "operation"],
+)
+GEODIFF_DURATION = Histogram(
+    "dbsync_geodiff_duration_seconds",
+    "Duration of geodiff invocations.",
+    ["connection", "subcommand"],
+)
+CHANGESETS = Counter(
+    "dbsync_changesets_total",
+    "Number of non-empty changesets synchronized.",
+    ["connection", "direction"],
+)
+CHANGESET_BYTES = Counter(
+    "dbsync_changeset_bytes_total",
+    "Size of synchronized changesets in bytes.",
+    ["connection", "direction"],
+)
+CHANGESET_ROWS = Counter(
+    "dbsync_changeset_rows_total",
+    "Number of synchronized row changes.",
+    ["connection", "direction", "type"],
+)
+SERVER_VERSIONS_BEHIND = Gauge(
+    "dbsync_server_versions_behind",
+    "Number of versions the local project is behind the server before pull.",
+    ["connection"],
+)
+LAST_SUCCESS = Gauge(
+    "dbsync_last_success_timestamp_seconds",
+    "Unix time of the last successful init/pull/push of a connection.",
+    ["connection", "operation"],
+)
+REBASES = Counter(
+    "dbsync_rebases_total",
+    "Number of pulls that needed a rebase of pending database changes.",
+    ["connection"],
+)
+SYNC_LATENCY = Summary(
+    "dbsync_sync_latency_seconds",
+    "Time from a change (DB commit or Mergin Maps version) to it being synchronized to the other side.",
+    ["connection", "direction"],
+)
+ERRORS = Counter(
+    "dbsync_errors_total",
+    "Number of failed init/pull/push operations.",
+    ["connection", "operation"],
+)
+CHILDREN_MAX_RSS = Gauge(
+    "dbsync_children_max_rss_bytes",
+    "Peak resident set size of the largest child process (e.g. geodiff) since the start of DB Sync.",
+)
+NOTIFICATION_EMAILS = Counter(
+    "dbsync_notification_emails_total",
+    "Number of notification emails sent.",
+)
+
+
+def render() -> str:
+    """Returns all metrics in Prometheus text exposition format"""
+    return "".join(metric.render() for metric in registry)
+
+
+def _observe_span(record: dict) -> None:
+    connection = record["connection"] or ""
+    if record["phase"] in ("init", "pull", "push"):
+        SYNC_DURATION.observe(record["wall_time"], connection=connection, operation=record["phase"])
+    elif record["phase"].startswith("geodiff "):
+        GEODIFF_DURATION.observe(
+            record["wall_time"], connection=connection, subcommand=record["phase"][len("geodiff ") :]
+        )
+        max_rss = timing_functions.children_max_rss()
+        if max_rss is not None:
+            CHILDREN_MAX_RSS.set(max_rss * 1024)
+
+
+timing_functions.span_listeners.append(_observe_span)
+
+
+@contextlib.contextmanager
+def track_operation(operation: str, connection: str):
+    """Counts errors raised in the `with` block and marks the time of success otherwise"""
+    try:
+        yield
+    except Exception:
+        ERRORS.inc(connection=connection, operation=operation)
+        raise
+    LAST_SUCCESS.set(time.time(), connection=connection, operation=operation)
+
+
+def observe_changeset(connection: str, direction: str, size: int, summary: list) -> None:
+    """Records size of a changeset and row counts from its geodiff summary"""
+    CHANGESETS.inc(connection=connection, direction=direction)
+    CHANGESET_BYTES.inc(size, connection=connection, direction=direction)
+    for change_type in ("insert", "update", "delete"):
+        rows = sum(item[change_type] for item in summary)
+        CHANGESET_ROWS.inc(rows, connection=connection, direction=direction, type=change_type)
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics server: " + format % args)
+
+
+def start_http_server(port: int, host: str = "127.0.0.1") -> http.server.ThreadingHTTPServer:
+    """Starts serving metrics on http://host:port/metrics in a background thread"""
+    server = http.server.ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logging.debug(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
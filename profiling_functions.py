@@ -0,0 +1,83 @@
+"""
+Mergin Maps DB Sync - a tool for two-way synchronization between Mergin Maps and a PostGIS database
+
+Copyright (C) 2024 Lutra Consulting
+
+License: MIT
+"""
+
+import contextlib
+import cProfile
+import logging
+import os
+import re
+import tracemalloc
+
+# key = connection (Mergin Maps project name), value = profiler collecting its pull/push calls
+profilers = {}
+profile_cycles_left = 0
+profile_dir = "."
+
+_last_memory_snapshot = None
+
+
+def start_profiling(cycles: int, directory: str) -> None:
+    """Profile pull/push of each connection in the following number of sync cycles"""
+    global profile_cycles_left, profile_dir
+    os.makedirs(directory, exist_ok=True)
+    profile_cycles_left = cycles
+    profile_dir = directory
+    profilers.clear()
+
+
+def profile_path(connection: str) -> str:
+    return os.path.join(profile_dir, re.sub(r"[^\w.-]", "_", connection) + ".pstats")
+
+
+@contextlib.contextmanager
+def profile(connection: str):
+    """Runs the `with` block in the profiler of the connection, if profiling is active"""
+    if profile_cycles_left <= 0:
+        yield
+        return
+    profiler = profilers.setdefault(connection, cProfile.Profile())
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+
+
+def end_cycle() -> None:
+    """Writes profiles collected so far (to be called after each sync cycle)"""
+    global profile_cycles_left
+    if profile_cycles_left <= 0:
+        return
+    profile_cycles_left -= 1
+    for connection, profiler in profilers.items():
+        profiler.dump_stats(profile_path(connection))
+    if profile_cycles_left == 0:
+        logging.info(f"Profiling finished, profiles written to {os.path.abspath(profile_dir)}")
+        profilers.clear()
+
+
+def start_memory_tracing() -> None:
+    global _last_memory_snapshot
+    tracemalloc.start()
+    _last_memory_snapshot = None
+
+
+def log_memory_diff(limit: int = 10) -> None:
+    """Logs code locations with the biggest change of allocated memory since the previous call"""
+    global _last_memory_snapshot
+    if not tracemalloc.is_tracing():
+        return
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>")]
+    )
+    current, peak = tracemalloc.get_traced_memory()
+    logging.info(f"Traced memory: current {current / 1024:.1f} kB, peak {peak / 1024:.1f} kB")
+    if _last_memory_snapshot is not None:
+        for stat in snapshot.compare_to(_last_memory_snapshot, "lineno")[:limit]:
+            logging.info(f"Memory diff: {stat}")
+    _last_memory_snapshot = snapshot
@@ -1,11 +1,28 @@
+import collections
 import datetime
 import logging
+import queue
 import smtplib
+import threading
+import time
 import typing
 from email.message import EmailMessage
 
 from dynaconf import Dynaconf
 
+import metrics_functions
+
+# default value of `minimal_email_interval` (in hours)
+DEFAULT_EMAIL_INTERVAL = 4
+# delays (in seconds) between retries of sending an email that failed
+RETRY_DELAYS = (10, 60, 300)
+# how many of the latest errors of a connection get listed in an email
+MAX_DIGEST_ERRORS = 5
+# an open connection to the SMTP server gets closed after this many seconds without sending an email
+SMTP_IDLE_TIMEOUT = 60
+# default value of `smtp_timeout` - how long (in seconds) to wait for the SMTP server
+DEFAULT_SMTP_TIMEOUT = 30
+
 
 def create_connection_and_log_user(config: Dynaconf) -> typing.Union[smtplib.SMTP_SSL, smtplib.SMTP]:
     """Create connection and log user to the SMTP server using the configuration in config."""
@@ -14,10 +31,13 @@ def create_connection_and_log_user(config: Dynaconf) -> typing.Union[smtplib.SMT
     else:
         port = 0
 
+    # a server that stops responding must not block the notifications forever
+    timeout = config.notification.get("smtp_timeout", DEFAULT_SMTP_TIMEOUT)
+
     if "use_ssl" in config.notification and config.notification.use_ssl:
-        host = smtplib.SMTP_SSL(config.notification.smtp_server, port)
+        host = smtplib.SMTP_SSL(config.notification.smtp_server, port, timeout=timeout)
     else:
-        host = smtplib.SMTP(config.notification.smtp_server, port)
+        host = smtplib.SMTP(config.notification.smtp_server, port, timeout=timeout)
 
     if "use_tls" in config.notification and config.notification.use_tls:
         host.starttls()
@@ -27,19 +47,23 @@ def create_connection_and_log_user(config: Dynaconf) -> typing.Union[smtplib.SMT
     return host
 
 
-def send_email(error: str, config: Dynaconf) -> None:
-    """Sends email with provided error using the settings in config."""
+def _format_time(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%d/%m/%Y %H:%M:%S")
+
 
+def _create_message(config: Dynaconf, content: str) -> EmailMessage:
     msg = EmailMessage()
     msg["Subject"] = config.notification.email_subject
     msg["From"] = config.notification.email_sender
     msg["To"] = ", ".join(config.notification.email_recipients)
+    msg.set_content(content)
+    return msg
 
-    date_time = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
 
-    error = f"{date_time}: {error}"
+def send_email(error: str, config: Dynaconf) -> None:
+    """Sends email with provided error using the settings in config."""
 
-    msg.set_content(error)
+    msg = _create_message(config, f"{_format_time(time.time())}: {error}")
 
     sender_email = config.notification.email_sender
 
@@ -47,6 +71,146 @@ def send_email(error: str, config: Dynaconf) -> None:
         smtp_conn = create_connection_and_log_user(config)
         smtp_conn.sendmail(sender_email, config.notification.email_recipients, msg.as_string())
         smtp_conn.quit()
+        metrics_functions.NOTIFICATION_EMAILS.inc()
         logging.debug("Notification email sent.")
     except:
         logging.exception("Failed to send notification email!")
+
+
+class EmailNotifier:
+    """
+    Sends notification emails about sync errors from a background thread, so that a slow or unreachable SMTP server
+    does not delay syncing.
+
+    Each connection gets at most one email per `minimal_email_interval`, errors reported in the meantime are collected
+    and sent in a digest with the next email. Errors of all connections that are due are sent in a single email.
+    """
+
+    def __init__(self, config: Dynaconf):
+        self.config = config
+        self.interval = config.notification.get("minimal_email_interval", DEFAULT_EMAIL_INTERVAL) * 3600
+        self.retry_delays = RETRY_DELAYS
+        self._queue = queue.Queue()
+        # key = project name of the connection ("" for errors not related to a connection),
+        # value = number of errors, time of the first error and the latest errors (times and messages)
+        self._pending = {}
+        self._last_sent = {}  # key = project name of the connection, value = time.monotonic() of the last email
+        self._smtp = None
+        self._smtp_last_used = None
+        self._thread = threading.Thread(target=self._run, name="email-notifier", daemon=True)
+        self._thread.start()
+
+    def notify(self, error: str, connection: str = None) -> None:
+        """Queues notification about the error (of the connection with the given project name) and returns"""
+        self._queue.put((time.time(), connection or "", error))
+
+    def stop(self, timeout: float = None) -> None:
+        """Sends errors that are due and stops the background thread (waits at most `timeout` seconds for it)"""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                item = self._queue.get(timeout=self._wait_time())
+            except queue.Empty:
+                self._close_idle_connection()
+                item = ()
+            # errors reported at once (e.g. in the same sync cycle) get sent together
+            items = [item]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in items:
+                if item:
+                    self._add_error(*item)
+            self._send_due()
+            if None in items:
+                self._close()
+                return
+
+    def _wait_time(self) -> typing.Optional[float]:
+        """Returns how long to wait for new errors before some pending errors get due (None = no pending errors)"""
+        now = time.monotonic()
+        times = [self._last_sent[name] + self.interval - now for name in self._pending if name in self._last_sent]
+        if self._smtp is not None:
+            times.append(self._smtp_last_used + SMTP_IDLE_TIMEOUT - now)
+        return max(min(times), 0) if times else None
+
+    def _add_error(self, timestamp: float, connection: str, error: str) -> None:
+        pending = self._pending.setdefault(
+            connection, {"count": 0, "first": timestamp, "errors": collections.deque(maxlen=MAX_DIGEST_ERRORS)}
+        )
+        pending["count"] += 1
+        pending["errors"].append((timestamp, error))
+
+    def _digest(self, connections: typing.List[str]) -> str:
+        parts = []
+        for name in connections:
+            pending = self._pending[name]
+            lines = [
+                f"{name or 'DB Sync'}: {pending['count']} error(s) since {_format_time(pending['first'])}",
+            ]
+            if pending["count"] > len(pending["errors"]):
+                lines.append(f"(only the latest {len(pending['errors'])} errors are listed)")
+            lines.extend(f"{_format_time(timestamp)}: {error}" for timestamp, error in pending["errors"])
+            parts.append("\n".join(lines))
+        return "\n\n".join(parts)
+
+    def _send_due(self) -> None:
+        now = time.monotonic()
+        due = [
+            name
+            for name in self._pending
+            if name not in self._last_sent or now - self._last_sent[name] >= self.interval
+        ]
+        if not due:
+            return
+        sent = self._send(_create_message(self.config, self._digest(due)))
+        for name in due:
+            del self._pending[name]
+            if sent:
+                self._last_sent[name] = now
+
+    def _send(self, msg: EmailMessage) -> bool:
+        """Sends the message, reusing connection to the SMTP server and retrying on failure"""
+        retry = 0
+        while True:
+            reused = self._smtp is not None
+            try:
+                if self._smtp is None:
+                    self._smtp = create_connection_and_log_user(self.config)
+                self._smtp.sendmail(
+                    self.config.notification.email_sender, self.config.notification.email_recipients, msg.as_string()
+                )
+                self._smtp_last_used = time.monotonic()
+                metrics_functions.NOTIFICATION_EMAILS.inc()
+                logging.debug("Notification email sent.")
+                return True
+            except (smtplib.SMTPException, OSError) as e:
+                self._close()
+                if reused:
+                    # the server may have closed the connection - try again with a new one right away
+                    continue
+                if retry >= len(self.retry_delays):
+                    logging.error(f"Failed to send notification email: {e}")
+                    logging.warning("Undelivered notification email:\n" + msg.get_content())
+                    return False
+                logging.warning(f"Failed to send notification email, retrying in {self.retry_delays[retry]}s: {e}")
+                time.sleep(self.retry_delays[retry])
+                retry += 1
+
+    def _close_idle_connection(self) -> None:
+        if self._smtp is not None and time.monotonic() - self._smtp_last_used >= SMTP_IDLE_TIMEOUT:
+            self._close()
+
+    def _close(self) -> None:
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._smtp = None
@@ -18,6 +18,19 @@ SERVER_URL = os.environ.get("TEST_MERGIN_URL")
 API_USER = os.environ.get("TEST_API_USERNAME")
 USER_PWD = os.environ.get("TEST_API_PASSWORD")
 WORKSPACE = os.environ.get("TEST_API_WORKSPACE")
+
+if SERVER_URL == "mock":
+    # run without network access against a local stand-in of Mergin Maps server
+    from benchmarks.mock_server import MockMerginServer
+
+    MOCK_BANDWIDTH = os.environ.get("TEST_MOCK_BANDWIDTH")
+    MOCK_SERVER = MockMerginServer(
+        {API_USER: USER_PWD},
+        latency=float(os.environ.get("TEST_MOCK_LATENCY", 0)),
+        bandwidth=float(MOCK_BANDWIDTH) if MOCK_BANDWIDTH else None,
+    ).start()
+    SERVER_URL = MOCK_SERVER.url
+
 TMP_DIR = tempfile.gettempdir()
 TEST_DATA_DIR = os.path.join(
     os.path.dirname(os.path.realpath(__file__)),
@@ -671,6 +671,11 @@ def test_recreated_project_ids(
     assert local_project_id != server_project_id
     with pytest.raises(DbSyncError):
         dbsync_status(mc)
+    # project ID is also checked using the project info from the version query in pull/push
+    with pytest.raises(DbSyncError, match="does not match the server project ID"):
+        dbsync_pull(mc)
+    with pytest.raises(DbSyncError, match="does not match the server project ID"):
+        dbsync_push(mc)
 
 
 @pytest.mark.parametrize(
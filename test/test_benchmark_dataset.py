@@ -0,0 +1,64 @@
+import json
+import os
+import shutil
+import sqlite3
+
+import pygeodiff
+
+from benchmarks import dataset
+
+
+def test_create_and_edit_gpkg(tmp_path):
+    base = os.path.join(tmp_path, "base.gpkg")
+    modified = os.path.join(tmp_path, "modified.gpkg")
+    dataset.create_gpkg(base, rows=100, tables=2, vertices=16)
+
+    conn = sqlite3.connect(base)
+    for t in range(2):
+        assert conn.execute(f"SELECT count(*) FROM {dataset.table_name(t)}").fetchone()[0] == 100
+    geometry = conn.execute("SELECT geometry FROM table_0 WHERE fid = 1").fetchone()[0]
+    conn.close()
+    assert geometry[:2] == b"GP"
+    # header with envelope (40 bytes) + WKB polygon header (13 bytes) + closed ring of 17 points
+    assert len(geometry) == 40 + 13 + 17 * 16
+
+    shutil.copy(base, modified)
+    edits = dataset.edit_gpkg(modified, rows=100, tables=2, edit_rate=0.1)
+
+    # the generated GeoPackage can be diffed by geodiff
+    geodiff = pygeodiff.GeoDiff()
+    changeset = os.path.join(tmp_path, "changeset")
+    summary = os.path.join(tmp_path, "summary.json")
+    geodiff.create_changeset(base, modified, changeset)
+    geodiff.list_changes_summary(changeset, summary)
+    with open(summary) as f:
+        changes = json.load(f)["geodiff_summary"]
+    assert sum(item["insert"] + item["update"] + item["delete"] for item in changes) == edits
+    assert {item["table"] for item in changes} == {"table_0", "table_1"}
+
+
+def test_edited_fids():
+    assert dataset.edited_fids(100, 0.1, 0) == [1, 11, 21, 31, 41, 51, 61, 71, 81, 91]
+    assert dataset.edited_fids(100, 0.1, 1) == [2, 12, 22, 32, 42, 52, 62, 72, 82, 92]
+    assert dataset.edited_fids(100, 0, 0) == []
+
+
+def test_edit_gpkg_rows(tmp_path):
+    path = os.path.join(tmp_path, "data.gpkg")
+    dataset.create_gpkg(path, rows=100)
+    original = os.path.join(tmp_path, "original.gpkg")
+    shutil.copy(path, original)
+
+    assert dataset.edit_gpkg_rows(path, "table_0", 20, parity=1) == 20
+
+    conn = sqlite3.connect(path)
+    conn.execute("ATTACH ? AS original", (original,))
+    # only rows with odd fid got updated or deleted
+    changed = conn.execute(
+        "SELECT o.fid FROM original.table_0 o LEFT JOIN table_0 t ON o.fid = t.fid "
+        "WHERE t.fid IS NULL OR t.value != o.value"
+    ).fetchall()
+    assert len(changed) == 18
+    assert all(fid % 2 == 1 for fid, in changed)
+    assert conn.execute("SELECT count(*) FROM table_0").fetchone()[0] == 100
+    conn.close()
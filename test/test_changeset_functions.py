@@ -0,0 +1,92 @@
+import os
+import shutil
+import sqlite3
+
+import pygeodiff
+import pytest
+
+import changeset_functions
+from benchmarks import dataset
+
+
+def _content(gpkg_path):
+    conn = sqlite3.connect(gpkg_path)
+    content = [conn.execute(f"SELECT * FROM {dataset.table_name(t)} ORDER BY fid").fetchall() for t in range(2)]
+    conn.close()
+    return content
+
+
+@pytest.fixture
+def changeset(tmp_path):
+    base = str(tmp_path / "base.gpkg")
+    modified = str(tmp_path / "modified.gpkg")
+    dataset.create_gpkg(base, rows=200, tables=2)
+    shutil.copy(base, modified)
+    dataset.edit_gpkg(modified, rows=200, tables=2, edit_rate=0.2)
+    changeset = str(tmp_path / "changeset")
+    pygeodiff.GeoDiff().create_changeset(base, modified, changeset)
+    return base, modified, changeset
+
+
+@pytest.mark.parametrize("max_rows, max_bytes", [(7, None), (None, 5000), (1000, None)])
+def test_split_changeset(tmp_path, changeset, max_rows, max_bytes):
+    base, modified, changeset = changeset
+    geodiff = pygeodiff.GeoDiff()
+    chunks = changeset_functions.split_changeset(changeset, str(tmp_path / "chunks"), max_rows, max_bytes)
+
+    counts = [geodiff.changes_count(chunk) for chunk in chunks]
+    assert sum(counts) == geodiff.changes_count(changeset)
+    if max_rows:
+        assert max(counts) <= max_rows
+        assert len(chunks) == -(-geodiff.changes_count(changeset) // max_rows)
+    if max_bytes:
+        assert len(chunks) > 1
+        assert max(os.path.getsize(chunk) for chunk in chunks) <= max_bytes
+
+    # applying chunks one by one gives the same result as the whole changeset
+    for chunk in chunks:
+        geodiff.apply_changeset(base, chunk)
+    assert _content(base) == _content(modified)
+
+
+def test_concat_changesets(tmp_path, changeset):
+    base, modified, changeset = changeset
+    geodiff = pygeodiff.GeoDiff()
+    partial = []
+    for t in range(2):
+        partial.append(str(tmp_path / f"changeset-{t}"))
+        geodiff.set_tables_to_skip([dataset.table_name(1 - t)])
+        geodiff.create_changeset(base, modified, partial[-1])
+    geodiff.set_tables_to_skip([])
+
+    output = str(tmp_path / "concatenated")
+    changeset_functions.concat_changesets(partial, output)
+    assert geodiff.changes_count(output) == geodiff.changes_count(changeset)
+    geodiff.apply_changeset(base, output)
+    assert _content(base) == _content(modified)
+
+
+def test_changeset_digest(tmp_path, changeset):
+    base, modified, changeset = changeset
+    geodiff = pygeodiff.GeoDiff()
+    partial = []
+    for t in range(2):
+        partial.append(str(tmp_path / f"changeset-{t}"))
+        geodiff.set_tables_to_skip([dataset.table_name(1 - t)])
+        geodiff.create_changeset(base, modified, partial[-1])
+
+    # the same changes concatenated in a different order of tables
+    changeset_functions.concat_changesets(partial, str(tmp_path / "concatenated"))
+    changeset_functions.concat_changesets(partial[::-1], str(tmp_path / "reversed"))
+    digest = changeset_functions.changeset_digest(str(tmp_path / "concatenated"))
+    assert changeset_functions.changeset_digest(str(tmp_path / "reversed")) == digest
+    assert changeset_functions.changeset_digest(changeset) == digest
+    assert changeset_functions.changeset_digest(partial[0]) != digest
+
+
+def test_invalid_changeset(tmp_path):
+    path = str(tmp_path / "changeset")
+    with open(path, "wb") as f:
+        f.write(b"\x17\x00\x01")
+    with pytest.raises(changeset_functions.ChangesetFormatError):
+        changeset_functions.split_changeset(path, str(tmp_path / "chunks"), max_rows=1)
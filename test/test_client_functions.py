@@ -0,0 +1,77 @@
+import datetime
+import json
+import os
+import stat
+import time
+
+import client_functions
+from config import config
+
+
+class _FakeClient:
+    def __init__(self, token, lifetime, valid=True):
+        self.valid = valid
+        self._set_session(token, lifetime)
+
+    def _set_session(self, token, lifetime):
+        expire = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=lifetime)
+        self._auth_session = {"token": token, "expire": expire}
+
+    def user_info(self):
+        if not self.valid:
+            raise RuntimeError("Invalid token")
+
+
+def _factory(clients, lifetime=3600 * 12, valid=True):
+    def create_client(auth_token=None):
+        clients.append(_FakeClient(auth_token or f"Bearer new-{len(clients)}", lifetime, valid))
+        return clients[-1]
+
+    return create_client
+
+
+def test_stored_token(tmp_path):
+    token_file = str(tmp_path / "token.json")
+    config.update({"MERGIN": {"URL": "https://app.merginmaps.com", "USERNAME": "user", "TOKEN_FILE": token_file}})
+    try:
+        clients = []
+        manager = client_functions.MerginClientManager(config, _factory(clients))
+        mc = manager.client()
+        assert manager.client() is mc
+        manager.close()
+        assert stat.S_IMODE(os.stat(token_file).st_mode) == 0o600
+        with open(token_file) as f:
+            assert json.load(f)["token"] == "Bearer new-0"
+
+        # restarted daemon uses the stored token
+        manager = client_functions.MerginClientManager(config, _factory(clients))
+        assert manager.client()._auth_session["token"] == "Bearer new-0"
+        assert len(clients) == 2
+        manager.close()
+
+        # ... unless it is no longer valid
+        manager = client_functions.MerginClientManager(config, _factory(clients, valid=False))
+        manager.client()
+        assert clients[-1]._auth_session["token"] == "Bearer new-3"
+        assert len(clients) == 4
+        manager.close()
+    finally:
+        config.unset("MERGIN", force=True)
+
+
+def test_token_refresh():
+    config.update({"MERGIN": {"URL": "https://app.merginmaps.com", "USERNAME": "user", "PASSWORD": "pass"}})
+    clients = []
+    manager = client_functions.MerginClientManager(config, _factory(clients, lifetime=1.5), refresh_margin=1)
+    try:
+        mc = manager.client()
+        # the token gets refreshed in background before it expires, the shared client stays the same
+        start = time.monotonic()
+        while mc._auth_session["token"] == "Bearer new-0" and time.monotonic() - start < 5:
+            time.sleep(0.05)
+        assert manager.client() is mc
+        assert mc._auth_session["token"] == "Bearer new-1"
+        assert mc._auth_session is clients[1]._auth_session
+    finally:
+        manager.close()
+        config.unset("MERGIN", force=True)
@@ -8,7 +8,7 @@ License: MIT
 
 import pytest
 
-from config import ConfigError, config, get_ignored_tables, validate_config
+from config import ConfigError, check_smtp_server, config, get_ignored_tables, validate_config
 
 from .conftest import _reset_config
 
@@ -345,3 +345,370 @@ def test_config_notification_setup():
 
     with pytest.raises(ConfigError, match="Config SMTP Error"):
         validate_config(config)
+
+    # connection to the SMTP server can be checked separately
+    validate_config(config, check_smtp=False)
+    with pytest.raises(ConfigError, match="Config SMTP Error"):
+        check_smtp_server(config)
+
+
+def test_config_smtp_timeout():
+    _reset_config()
+    notification = {
+        "smtp_server": "server",
+        "email_sender": "dbsync@info.com",
+        "email_subject": "DB Sync Error",
+        "email_recipients": ["recipient1@test.com"],
+    }
+    try:
+        config.update({"NOTIFICATION": {**notification, "smtp_timeout": 10}})
+        validate_config(config, check_smtp=False)
+
+        for timeout in [0, "10", True]:
+            config.update({"NOTIFICATION": {**notification, "smtp_timeout": timeout}})
+            with pytest.raises(ConfigError, match="Config error: `smtp_timeout` must be set to a positive number"):
+                validate_config(config, check_smtp=False)
+    finally:
+        config.unset("NOTIFICATION", force=True)
+
+
+def test_config_token_file():
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+
+    config.update({"MERGIN__TOKEN_FILE": "/var/lib/dbsync/token.json"})
+    validate_config(config)
+
+    config.update({"MERGIN__TOKEN_FILE": 1})
+    with pytest.raises(ConfigError, match="Config error: `token_file` must be set to a path"):
+        validate_config(config)
+
+    config.unset("MERGIN", force=True)
+
+
+def test_config_download_workers():
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+
+    config.update({"MERGIN__DOWNLOAD_WORKERS": 8})
+    validate_config(config)
+
+    config.update({"MERGIN__DOWNLOAD_WORKERS": 0})
+    with pytest.raises(ConfigError, match="Config error: `download_workers` must be set to a positive integer"):
+        validate_config(config)
+
+    config.update({"MERGIN__DOWNLOAD_WORKERS": "many"})
+    with pytest.raises(ConfigError, match="Config error: `download_workers` must be set to a positive integer"):
+        validate_config(config)
+
+    config.unset("MERGIN", force=True)
+
+
+@pytest.mark.parametrize(
+    "settings, message",
+    [
+        ({"GEODIFF_LOG_LEVEL": True}, "`geodiff_log_level` must be set to a number between 0 and 4"),
+        ({"MERGIN__DOWNLOAD_WORKERS": True}, "`download_workers` must be set to a positive integer"),
+        ({"MERGIN__PROJECT_CACHE_SIZE": True}, "`project_cache_size` must be set to a positive integer"),
+        ({"MERGIN__PROJECT_ID_CHECK_INTERVAL": False}, "`project_id_check_interval` must be set to a number"),
+        ({"DAEMON": {"sleep_time": 10, "metrics_port": True}}, "`metrics_port` must be set to a valid port number"),
+        ({"DAEMON": {"sleep_time": 10, "control_port": False}}, "`control_port` must be set to a valid port number"),
+        ({"DAEMON": {"sleep_time": 10, "init_workers": True}}, "`init_workers` must be set to a positive integer"),
+        ({"DAEMON": {"sleep_time": 10, "lock_timeout": True}}, "`lock_timeout` must be a non-negative number"),
+    ],
+)
+def test_config_boolean_numbers(settings, message):
+    # YAML `true` and `false` are booleans, which are integers in Python - they must not be taken as numbers
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+    config.update(settings)
+    try:
+        with pytest.raises(ConfigError, match=f"Config error: {message}"):
+            validate_config(config)
+    finally:
+        for key in settings:
+            section, _, name = key.partition("__")
+            if name:
+                config.get(section).pop(name, None)
+            else:
+                config.unset(section, force=True)
+
+
+def test_config_metrics():
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+
+    config.update({"DAEMON": {"sleep_time": 10, "metrics_port": 9090, "metrics_host": "0.0.0.0"}})
+    validate_config(config)
+
+    config.update({"DAEMON": {"sleep_time": 10, "metrics_port": "9090"}})
+    with pytest.raises(ConfigError, match="Config error: `metrics_port` must be set to a valid port number"):
+        validate_config(config)
+
+    config.update({"DAEMON": {"sleep_time": 10, "metrics_port": 9090, "metrics_host": 1}})
+    with pytest.raises(ConfigError, match="Config error: `metrics_host` must be set to a host name or an IP address"):
+        validate_config(config)
+
+    config.unset("DAEMON", force=True)
+
+
+def test_config_control_server():
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+
+    config.update({"DAEMON": {"sleep_time": 10, "control_port": 9091, "control_host": "localhost"}})
+    validate_config(config)
+
+    config.update({"DAEMON": {"sleep_time": 10, "control_port": 70000}})
+    with pytest.raises(ConfigError, match="Config error: `control_port` must be set to a valid port number"):
+        validate_config(config)
+
+    config.update({"DAEMON": {"sleep_time": 10, "control_port": 9091, "control_host": ["localhost"]}})
+    with pytest.raises(ConfigError, match="Config error: `control_host` must be set to a host name or an IP address"):
+        validate_config(config)
+
+    config.unset("DAEMON", force=True)
+
+
+def test_config_coordination():
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+
+    config.update({"DAEMON": {"sleep_time": 10, "coordination": True}})
+    validate_config(config)
+
+    config.update({"DAEMON": {"sleep_time": 10, "coordination": "yes"}})
+    with pytest.raises(ConfigError, match="Config error: `coordination` must be set to either `true` or `false`"):
+        validate_config(config)
+
+    config.unset("DAEMON", force=True)
+
+
+def test_config_lock_policy():
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+
+    config.update({"DAEMON": {"sleep_time": 10, "lock_policy": "skip", "lock_timeout": 30}})
+    validate_config(config)
+
+    config.update({"DAEMON": {"sleep_time": 10, "lock_policy": "never", "lock_timeout": 30}})
+    with pytest.raises(ConfigError, match="Config error: `lock_policy` must be set to either `wait` or `skip`"):
+        validate_config(config)
+
+    config.update({"DAEMON": {"sleep_time": 10, "lock_policy": "wait", "lock_timeout": -1}})
+    with pytest.raises(ConfigError, match="Config error: `lock_timeout` must be a non-negative number of seconds"):
+        validate_config(config)
+
+    config.unset("DAEMON", force=True)
+
+
+def test_config_shutdown_timeout():
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+
+    config.update({"DAEMON": {"sleep_time": 10, "shutdown_timeout": 60}})
+    validate_config(config)
+
+    config.update({"DAEMON": {"sleep_time": 10, "shutdown_timeout": "1m"}})
+    with pytest.raises(ConfigError, match="Config error: `shutdown_timeout` must be a non-negative number of seconds"):
+        validate_config(config)
+
+    config.unset("DAEMON", force=True)
+
+
+def test_config_init_workers():
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+
+    config.update({"DAEMON": {"sleep_time": 10, "init_workers": 8}})
+    validate_config(config)
+
+    config.update({"DAEMON": {"sleep_time": 10, "init_workers": 0}})
+    with pytest.raises(ConfigError, match="Config error: `init_workers` must be set to a positive integer"):
+        validate_config(config)
+
+    config.unset("DAEMON", force=True)
+
+
+def test_config_measure_latency():
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+
+    connection = {
+        "driver": "postgres",
+        "conn_info": "",
+        "modified": "mergin_main",
+        "base": "mergin_base",
+        "mergin_project": "john/dbsync",
+        "sync_file": "sync.gpkg",
+    }
+
+    config.update({"CONNECTIONS": [{**connection, "measure_latency": True}]})
+    validate_config(config)
+
+    config.update({"CONNECTIONS": [{**connection, "measure_latency": "yes"}]})
+    with pytest.raises(ConfigError, match="Config error: `measure_latency` must be set to either `true` or `false`"):
+        validate_config(config)
+
+
+def test_config_skip_unchanged_tables():
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+
+    connection = {
+        "driver": "postgres",
+        "conn_info": "",
+        "modified": "mergin_main",
+        "base": "mergin_base",
+        "mergin_project": "john/dbsync",
+        "sync_file": "sync.gpkg",
+    }
+
+    config.update({"CONNECTIONS": [{**connection, "skip_unchanged_tables": True}]})
+    validate_config(config)
+
+    config.update({"CONNECTIONS": [{**connection, "skip_unchanged_tables": 1}]})
+    with pytest.raises(
+        ConfigError, match="Config error: `skip_unchanged_tables` must be set to either `true` or `false`"
+    ):
+        validate_config(config)
+
+    config.update({"CONNECTIONS": [{**connection, "skip_unchanged_tables": True, "full_compare_interval": 0}]})
+    validate_config(config)
+
+    config.update({"CONNECTIONS": [{**connection, "full_compare_interval": -1}]})
+    with pytest.raises(
+        ConfigError, match="Config error: `full_compare_interval` must be a non-negative number of seconds"
+    ):
+        validate_config(config)
+
+
+def test_config_change_source():
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+
+    connection = {
+        "driver": "postgres",
+        "conn_info": "",
+        "modified": "mergin_main",
+        "base": "mergin_base",
+        "mergin_project": "john/dbsync",
+        "sync_file": "sync.gpkg",
+    }
+
+    config.update({"CONNECTIONS": [{**connection, "change_source": "logical"}]})
+    validate_config(config)
+
+    config.update({"CONNECTIONS": [{**connection, "change_source": "wal2json"}]})
+    with pytest.raises(ConfigError, match="Config error: `change_source` must be set to either `diff` or `logical`"):
+        validate_config(config)
+
+
+def test_config_push_debounce():
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+
+    connection = {
+        "driver": "postgres",
+        "conn_info": "",
+        "modified": "mergin_main",
+        "base": "mergin_base",
+        "mergin_project": "john/dbsync",
+        "sync_file": "sync.gpkg",
+    }
+
+    config.update({"CONNECTIONS": [{**connection, "push_quiet_time": 30, "push_max_delay": 120.5}]})
+    validate_config(config)
+
+    config.update({"CONNECTIONS": [{**connection, "push_quiet_time": "30"}]})
+    with pytest.raises(ConfigError, match="Config error: `push_quiet_time` must be a non-negative number of seconds"):
+        validate_config(config)
+
+    config.update({"CONNECTIONS": [{**connection, "push_max_delay": -1}]})
+    with pytest.raises(ConfigError, match="Config error: `push_max_delay` must be a non-negative number of seconds"):
+        validate_config(config)
+
+
+def test_config_timeouts():
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+
+    connection = {
+        "driver": "postgres",
+        "conn_info": "",
+        "modified": "mergin_main",
+        "base": "mergin_base",
+        "mergin_project": "john/dbsync",
+        "sync_file": "sync.gpkg",
+    }
+
+    config.update({"CONNECTIONS": [{**connection, "geodiff_timeout": 3600, "server_timeout": 60.5}]})
+    validate_config(config)
+
+    config.update({"CONNECTIONS": [{**connection, "geodiff_timeout": "1h"}]})
+    with pytest.raises(ConfigError, match="Config error: `geodiff_timeout` must be a non-negative number of seconds"):
+        validate_config(config)
+
+    config.update({"CONNECTIONS": [{**connection, "server_timeout": -5}]})
+    with pytest.raises(ConfigError, match="Config error: `server_timeout` must be a non-negative number of seconds"):
+        validate_config(config)
+
+
+def test_config_push_chunks():
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+
+    connection = {
+        "driver": "postgres",
+        "conn_info": "",
+        "modified": "mergin_main",
+        "base": "mergin_base",
+        "mergin_project": "john/dbsync",
+        "sync_file": "sync.gpkg",
+    }
+
+    config.update({"CONNECTIONS": [{**connection, "push_chunk_rows": 100000, "push_chunk_bytes": 50000000}]})
+    validate_config(config)
+
+    config.update({"CONNECTIONS": [{**connection, "push_chunk_rows": 0}]})
+    with pytest.raises(ConfigError, match="Config error: `push_chunk_rows` must be a positive integer"):
+        validate_config(config)
+
+    config.update({"CONNECTIONS": [{**connection, "push_chunk_bytes": 1.5}]})
+    with pytest.raises(ConfigError, match="Config error: `push_chunk_bytes` must be a positive integer"):
+        validate_config(config)
+
+
+def test_config_diff_jobs():
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+
+    connection = {
+        "driver": "postgres",
+        "conn_info": "",
+        "modified": "mergin_main",
+        "base": "mergin_base",
+        "mergin_project": "john/dbsync",
+        "sync_file": "sync.gpkg",
+    }
+
+    config.update({"CONNECTIONS": [{**connection, "diff_jobs": 8}]})
+    validate_config(config)
+
+    config.update({"CONNECTIONS": [{**connection, "diff_jobs": "8"}]})
+    with pytest.raises(ConfigError, match="Config error: `diff_jobs` must be a positive integer"):
+        validate_config(config)
+
+
+def test_config_geodiff_log_level():
+    _reset_config()
+    config.unset("NOTIFICATION", force=True)
+
+    config.update({"GEODIFF_LOG_LEVEL": 2})
+    validate_config(config)
+
+    config.update({"GEODIFF_LOG_LEVEL": 5})
+    with pytest.raises(ConfigError, match="Config error: `geodiff_log_level` must be set to a number between 0 and 4"):
+        validate_config(config)
+
+    config.unset("GEODIFF_LOG_LEVEL", force=True)
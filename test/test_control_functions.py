@@ -0,0 +1,76 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import control_functions
+import metrics_functions
+
+
+def test_coalesce_requests():
+    scheduler = control_functions.SyncScheduler(["ws/a", "ws/b"])
+    assert scheduler.request("pull", "ws/a") == {"queued": ["ws/a"], "coalesced": []}
+    assert scheduler.request("pull", "ws/a") == {"queued": [], "coalesced": ["ws/a"]}
+    assert scheduler.request("sync") == {"queued": ["ws/a", "ws/b"], "coalesced": []}
+    assert scheduler.request("push", "ws/b") == {"queued": [], "coalesced": ["ws/b"]}
+    with pytest.raises(KeyError):
+        scheduler.request("sync", "ws/unknown")
+
+    assert scheduler.wait(10) == {"ws/a": {"pull", "push"}, "ws/b": {"pull", "push"}}
+    # nothing is pending any more
+    start = time.monotonic()
+    assert scheduler.wait(0.2) == {}
+    assert time.monotonic() - start >= 0.2
+
+
+def test_request_wakes_up_scheduler():
+    scheduler = control_functions.SyncScheduler(["ws/a"])
+    threading.Timer(0.1, scheduler.request, ["push", "ws/a"]).start()
+    start = time.monotonic()
+    assert scheduler.wait(10) == {"ws/a": {"push"}}
+    assert time.monotonic() - start < 5
+
+
+def test_stop_scheduler():
+    scheduler = control_functions.SyncScheduler(["ws/a"])
+    threading.Timer(0.1, scheduler.stop).start()
+    start = time.monotonic()
+    assert scheduler.wait(10) == {}
+    assert time.monotonic() - start < 5
+    # requests made after the stop do not get run
+    scheduler.request("sync")
+    assert scheduler.wait(10) == {}
+    assert scheduler.status()["state"] == "stopping"
+
+
+def test_control_http_server():
+    scheduler = control_functions.SyncScheduler(["ws/a", "ws/b"])
+    metrics_functions.LAST_SUCCESS.set(1234.5, connection="ws/a", operation="pull")
+    server = control_functions.start_http_server(scheduler, 0)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with urllib.request.urlopen(urllib.request.Request(f"{url}/sync?connection=ws/a", method="POST")) as response:
+            assert response.status == 202
+            assert json.load(response) == {"queued": ["ws/a"], "coalesced": []}
+        with urllib.request.urlopen(urllib.request.Request(f"{url}/pull", method="POST")) as response:
+            assert json.load(response) == {"queued": ["ws/b"], "coalesced": ["ws/a"]}
+
+        with urllib.request.urlopen(f"{url}/status") as response:
+            status = json.load(response)
+        assert status["state"] == "syncing"
+        assert status["pending"] == {"ws/a": ["pull", "push"], "ws/b": ["pull"]}
+        assert status["connections"]["ws/a"]["last_pull"] == 1234.5
+        assert status["connections"]["ws/b"]["last_push"] is None
+
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(urllib.request.Request(f"{url}/sync?connection=ws/c", method="POST"))
+        assert e.value.code == 404
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(urllib.request.Request(f"{url}/other", method="POST"))
+        assert e.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,136 @@
+import contextlib
+import time
+import types
+
+import pytest
+
+import control_functions
+import dbsync
+import dbsync_daemon
+from config import config
+from dbsync import DbSyncError
+
+
+def test_staged_init(monkeypatch):
+    def init(mc, connections):
+        time.sleep(connections[0].init_time)
+        if connections[0].init_time > 0.2:
+            raise DbSyncError("init failed")
+
+    monkeypatch.setattr(dbsync, "dbsync_init", init)
+    connections = [
+        types.SimpleNamespace(mergin_project="ws/slow", init_time=0.3),
+        types.SimpleNamespace(mergin_project="ws/fast", init_time=0),
+    ]
+    scheduler = control_functions.SyncScheduler([conn.mergin_project for conn in connections])
+
+    futures = dbsync_daemon.start_init(None, connections, scheduler)
+    # the connection that finished its init gets synced without waiting for the others
+    assert scheduler.wait(5) == {"ws/fast": {"pull", "push"}}
+    assert not futures["ws/slow"].done()
+
+    with pytest.raises(DbSyncError, match="init failed"):
+        futures["ws/slow"].result()
+    assert scheduler.wait(0.1) == {}
+
+
+def test_finish_init(monkeypatch):
+    started = []
+
+    def init(mc, connections):
+        started.append(connections[0].mergin_project)
+        time.sleep(connections[0].init_time)
+        if connections[0].fails:
+            raise DbSyncError(f"init of {connections[0].mergin_project} failed")
+
+    monkeypatch.setattr(dbsync, "dbsync_init", init)
+    connections = [
+        types.SimpleNamespace(mergin_project="ws/fast", init_time=0, fails=True),
+        types.SimpleNamespace(mergin_project="ws/slow", init_time=0.3, fails=True),
+    ] + [types.SimpleNamespace(mergin_project=f"ws/waiting_{i}", init_time=0, fails=False) for i in range(5)]
+    config.update({"DAEMON__INIT_WORKERS": 2})
+    try:
+        futures = dbsync_daemon.start_init(None, connections)
+    finally:
+        config.daemon.pop("INIT_WORKERS")
+
+    # the running init gets finished and its failure is reported too, inits waiting for a worker get cancelled
+    with pytest.raises(dbsync.SyncErrors) as e:
+        dbsync_daemon.finish_init(futures)
+    assert [name for name, error in e.value.errors] == ["ws/fast", "ws/slow"]
+    assert all(future.done() for future in futures.values())
+    assert any(future.cancelled() for future in futures.values())
+    assert all(futures[name].cancelled() for name in futures if name not in started)
+
+
+def test_run_in_background():
+    assert dbsync_daemon.run_in_background(sum, [1, 2]).result(5) == 3
+    with pytest.raises(ZeroDivisionError):
+        dbsync_daemon.run_in_background(divmod, 1, 0).result(5)
+
+
+def test_failed_pull_does_not_stop_pushes(monkeypatch):
+    pulled, pushed = [], []
+
+    def pull(conn_cfg, mc):
+        if conn_cfg.mergin_project == "ws/broken":
+            raise DbSyncError("pull failed")
+        pulled.append(conn_cfg.mergin_project)
+
+    def push(conn_cfg, mc, debounce=False):
+        if conn_cfg.mergin_project == "ws/rejected":
+            raise DbSyncError("push failed")
+        pushed.append(conn_cfg.mergin_project)
+
+    monkeypatch.setattr(dbsync, "_lock_connection", lambda conn_cfg: contextlib.nullcontext(True))
+    monkeypatch.setattr(dbsync, "pull", pull)
+    monkeypatch.setattr(dbsync, "push", push)
+    connections = [
+        types.SimpleNamespace(mergin_project=name, get=lambda key, default=None: default)
+        for name in ("ws/broken", "ws/ok", "ws/rejected")
+    ]
+    mc = types.SimpleNamespace(opener=None)
+
+    with pytest.raises(dbsync.SyncErrors) as e:
+        dbsync_daemon.run_sync(mc, connections, connections)
+    assert pulled == ["ws/ok", "ws/rejected"]
+    # connections that pulled are pushed even though another pull failed
+    assert pushed == ["ws/ok"]
+    assert [(name, str(error)) for name, error in e.value.errors] == [
+        ("ws/broken", "pull failed"),
+        ("ws/rejected", "push failed"),
+    ]
+
+
+def test_init_claimed(monkeypatch):
+    inits = []
+    versions_current = {"ws/borrowed": True}
+
+    def init(mc, connections):
+        name = connections[0].mergin_project
+        inits.append(name)
+        if name == "ws/broken":
+            raise DbSyncError("init failed")
+
+    monkeypatch.setattr(dbsync, "dbsync_init", init)
+    monkeypatch.setattr(dbsync, "is_init_current", lambda conn: versions_current.get(conn.mergin_project, False))
+    connections = [types.SimpleNamespace(mergin_project=name) for name in ("ws/broken", "ws/ok", "ws/borrowed")]
+    borrowed = {"ws/borrowed": connections[2]}
+    initialized, current = set(), set()
+
+    # a failing init does not stop init of the others
+    ready, errors = dbsync_daemon.init_claimed(None, connections, borrowed, initialized, current)
+    assert [conn.mergin_project for conn in ready] == ["ws/ok", "ws/borrowed"]
+    assert [(name, str(error)) for name, error in errors] == [("ws/broken", "init failed")]
+    assert inits == ["ws/broken", "ws/ok", "ws/borrowed"]
+    assert initialized == {"ws/ok", "ws/borrowed"}
+    assert current == {"ws/ok"}
+
+    # the borrowed connection does not get a full init again unless another instance synced it
+    inits.clear()
+    ready, errors = dbsync_daemon.init_claimed(None, connections[1:], borrowed, initialized, current)
+    assert len(ready) == 2 and not errors
+    assert inits == []
+    versions_current["ws/borrowed"] = False
+    dbsync_daemon.init_claimed(None, connections[1:], borrowed, initialized, current)
+    assert inits == ["ws/borrowed"]
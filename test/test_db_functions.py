@@ -1,8 +1,16 @@
+import datetime
+import time
+
 import psycopg2
 import psycopg2.extensions
+import pytest
 
+import dbsync
 from dbsync import (
     _check_postgis_available,
+    _check_track_commit_timestamp,
+    _get_db_commit_timestamps,
+    _get_db_schema_fingerprint,
     _try_install_postgis,
 )
 
@@ -31,3 +39,82 @@ def test_try_install_postgis(
     _try_install_postgis(db_connection)
 
     assert _check_postgis_available(db_connection)
+
+
+def _wait_for_fingerprint(db_connection, schema, condition):
+    """Counters of changed rows get reported to the statistics asynchronously"""
+    for _ in range(50):
+        fingerprint = _get_db_schema_fingerprint(db_connection, schema, [])
+        if condition(fingerprint):
+            break
+        time.sleep(0.1)
+    return fingerprint
+
+
+def test_db_schema_fingerprint(
+    db_connection: psycopg2.extensions.connection,
+):
+    cur = db_connection.cursor()
+    cur.execute("DROP SCHEMA IF EXISTS fingerprint_test CASCADE; CREATE SCHEMA fingerprint_test;")
+    cur.execute("CREATE TABLE fingerprint_test.a (fid serial PRIMARY KEY, name text);")
+    cur.execute("CREATE TABLE fingerprint_test.b (fid serial PRIMARY KEY);")
+    cur.execute("INSERT INTO fingerprint_test.a (name) VALUES ('x'), ('y');")
+    db_connection.commit()
+
+    fingerprint = _wait_for_fingerprint(db_connection, "fingerprint_test", lambda f: f["a"][2] == 2)
+    assert sorted(fingerprint) == ["a", "b"]
+    assert fingerprint["a"][2] == 2
+    assert _get_db_schema_fingerprint(db_connection, "fingerprint_test", []) == fingerprint
+    assert sorted(_get_db_schema_fingerprint(db_connection, "fingerprint_test", ["b"])) == ["a"]
+
+    # any change of rows or columns changes the fingerprint
+    for statement in (
+        "UPDATE fingerprint_test.a SET name = 'z' WHERE fid = 1",
+        "DELETE FROM fingerprint_test.a WHERE fid = 2",
+        "ALTER TABLE fingerprint_test.b ADD COLUMN value integer",
+        "TRUNCATE fingerprint_test.a",
+    ):
+        cur.execute(statement)
+        db_connection.commit()
+        changed = _wait_for_fingerprint(db_connection, "fingerprint_test", lambda f: f != fingerprint)
+        assert changed != fingerprint
+        fingerprint = changed
+
+    cur.execute("DROP SCHEMA fingerprint_test CASCADE;")
+    db_connection.commit()
+
+
+def test_db_commit_timestamps(
+    db_connection: psycopg2.extensions.connection,
+    monkeypatch,
+):
+    if not _check_track_commit_timestamp(db_connection):
+        pytest.skip("track_commit_timestamp is not enabled in the database server")
+    cur = db_connection.cursor()
+    cur.execute("DROP SCHEMA IF EXISTS commit_ts_test CASCADE; CREATE SCHEMA commit_ts_test;")
+    cur.execute("CREATE TABLE commit_ts_test.a (fid serial PRIMARY KEY);")
+    cur.execute("CREATE TABLE commit_ts_test.b (fid serial PRIMARY KEY);")
+    db_connection.commit()
+    since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1)
+    assert _get_db_commit_timestamps(db_connection, "commit_ts_test", ["a", "b"], since) == []
+
+    cur.execute("INSERT INTO commit_ts_test.a SELECT FROM generate_series(1, 3);")
+    db_connection.commit()
+    cur.execute("INSERT INTO commit_ts_test.b SELECT FROM generate_series(1, 2);")
+    db_connection.commit()
+    timestamps = _get_db_commit_timestamps(db_connection, "commit_ts_test", ["a", "b"], since)
+    assert len(timestamps) == 5
+    assert timestamps == sorted(timestamps) and timestamps[0] < timestamps[-1]
+
+    # many changed rows are summarized by percentiles
+    monkeypatch.setattr(dbsync, "LATENCY_SAMPLES", 4)
+    assert _get_db_commit_timestamps(db_connection, "commit_ts_test", ["a", "b"], since) == [
+        timestamps[0],
+        timestamps[1],
+        timestamps[3],
+        timestamps[4],
+    ]
+    assert _get_db_commit_timestamps(db_connection, "commit_ts_test", ["a"], timestamps[-1]) == []
+
+    cur.execute("DROP SCHEMA commit_ts_test CASCADE;")
+    db_connection.commit()
@@ -0,0 +1,126 @@
+import logging
+import os
+import stat
+import time
+import types
+
+import pytest
+
+import dbsync
+from config import config
+from dbsync import DbSyncError, _run_geodiff
+
+
+class _Connection(dict):
+    __getattr__ = dict.__getitem__
+
+
+def _fake_geodiff(tmp_path, script):
+    path = tmp_path / "geodiff"
+    path.write_text("#!/bin/sh\n" + script)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+def test_geodiff_output_levels(tmp_path, caplog):
+    geodiff = _fake_geodiff(
+        tmp_path,
+        'echo "Debug: level $GEODIFF_LOGGER_LEVEL"\necho "Warn: something odd"\necho "Error: not fatal" >&2\n',
+    )
+    config.update({"GEODIFF_LOG_LEVEL": 2})
+    try:
+        with caplog.at_level(logging.DEBUG):
+            _run_geodiff([geodiff, "diff"])
+    finally:
+        config.unset("GEODIFF_LOG_LEVEL", force=True)
+
+    records = [(r.levelno, r.getMessage()) for r in caplog.records]
+    assert (logging.DEBUG, "GEODIFF: Debug: level 2") in records
+    assert (logging.WARNING, "GEODIFF: Warn: something odd") in records
+    assert (logging.ERROR, "GEODIFF: Error: not fatal") in records
+
+
+def test_geodiff_output_limit(tmp_path, caplog, monkeypatch):
+    monkeypatch.setattr(dbsync, "GEODIFF_LOG_LIMIT", 1000)
+    geodiff = _fake_geodiff(
+        tmp_path,
+        'i=0\nwhile [ $i -lt 1000 ]; do echo "Debug: line $i"; i=$((i+1)); done\necho "Error: failed"\nexit 1\n',
+    )
+    with caplog.at_level(logging.DEBUG):
+        with pytest.raises(DbSyncError, match="Error: failed"):
+            _run_geodiff([geodiff, "diff"])
+
+    messages = [r.getMessage() for r in caplog.records]
+    # each line has at least 14 bytes
+    assert 0 < len([m for m in messages if m.startswith("GEODIFF: Debug:")]) <= 1000 // 14
+    assert "GEODIFF: Error: failed" in messages
+    assert any(m.endswith("more bytes of output not logged") for m in messages)
+
+
+def test_geodiff_multiline_error(tmp_path, caplog, monkeypatch):
+    monkeypatch.setattr(dbsync, "GEODIFF_LOG_LIMIT", 100)
+    geodiff = _fake_geodiff(
+        tmp_path,
+        'echo "Debug: $(printf \'x%.0s\' $(seq 100))"\necho "Error: query failed"\necho "DETAIL: key exists"\n'
+        'echo "Info: done"\necho "more info"\nexit 1\n',
+    )
+    with caplog.at_level(logging.DEBUG):
+        with pytest.raises(DbSyncError, match="Error: query failed\nDETAIL: key exists"):
+            _run_geodiff([geodiff, "diff"])
+
+    records = [(r.levelno, r.getMessage()) for r in caplog.records]
+    # continuation lines keep the level of the line starting the message and errors are never cut off
+    assert (logging.ERROR, "GEODIFF: DETAIL: key exists") in records
+    assert (logging.INFO, "GEODIFF: Info: done") in records
+    assert (logging.INFO, "GEODIFF: more info") in records
+
+
+def test_client_geodiff_log_level(monkeypatch):
+    monkeypatch.setattr(dbsync, "MerginClient", lambda *args, **kwargs: types.SimpleNamespace(opener=None))
+    if "MERGIN" not in config:
+        config.update({"MERGIN": {}})
+    for key in ["URL", "USERNAME", "PASSWORD"]:
+        monkeypatch.setitem(config.mergin, key, "test")
+    monkeypatch.setenv("GEODIFF_LOGGER_LEVEL", "4")
+    config.update({"GEODIFF_LOG_LEVEL": 1})
+    try:
+        dbsync.create_mergin_client()
+    finally:
+        config.unset("GEODIFF_LOG_LEVEL", force=True)
+    assert os.environ["GEODIFF_LOGGER_LEVEL"] == "1"
+
+
+def test_geodiff_timeout(tmp_path, monkeypatch):
+    geodiff = _fake_geodiff(tmp_path, 'echo "Info: started"\nexec sleep 30\n')
+    terminated = []
+    monkeypatch.setattr(dbsync, "_terminate_db_sessions", lambda *args: terminated.append(args))
+    conn_cfg = _Connection(conn_info="dbname=test", geodiff_timeout=0.5)
+    monkeypatch.setattr(dbsync._current_operation, "conn_cfg", conn_cfg, raising=False)
+
+    start = time.monotonic()
+    with pytest.raises(DbSyncError, match="geodiff did not finish within 0.5 seconds"):
+        _run_geodiff([geodiff, "diff"])
+    assert time.monotonic() - start < 10
+    assert len(terminated) == 1
+    assert terminated[0][1].startswith("dbsync-geodiff-")
+
+
+def test_timeout_opener():
+    calls = []
+    opener = dbsync._TimeoutOpener(types.SimpleNamespace(open=lambda *args: calls.append(args), handlers=[]))
+    opener.open("request")
+    opener.timeout = 30
+    opener.open("request")
+    opener.open("request", None, 5)
+    assert [args[2] for args in calls] == [None, 30, 5]
+    assert opener.handlers == []
+
+    # concurrent operations (e.g. from threads) get the longest timeout
+    opener.timeout = None
+    with opener.limit(10):
+        with opener.limit(20):
+            assert opener.timeout == 20
+        assert opener.timeout == 10
+        with opener.limit(None):
+            assert opener.timeout is None
+    assert opener.timeout is None
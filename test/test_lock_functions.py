@@ -0,0 +1,106 @@
+import threading
+import time
+import types
+
+import psycopg2
+import pytest
+
+import lock_functions
+
+from .conftest import DB_CONNINFO
+
+
+def _connection(name: str):
+    return types.SimpleNamespace(mergin_project=f"ws/{name}", base=f"{name}_base", conn_info=DB_CONNINFO)
+
+
+def test_advisory_lock_key():
+    key = lock_functions.advisory_lock_key("project_base")
+    assert key == lock_functions.advisory_lock_key("project_base")
+    assert key != lock_functions.advisory_lock_key("other_base")
+    for name in ("a", "b", "project_base", "x" * 100):
+        assert -(2**31) <= lock_functions.advisory_lock_key(name) < 2**31
+
+
+def test_parse_shard():
+    assert lock_functions.parse_shard("0/1") == (0, 1)
+    assert lock_functions.parse_shard("2/3") == (2, 3)
+    for value in ("3/3", "-1/2", "1/0", "1", "a/b", "1/2/3"):
+        with pytest.raises(ValueError):
+            lock_functions.parse_shard(value)
+
+
+def test_static_shards():
+    connections = [_connection(f"project_{i}") for i in range(20)]
+    claimed = []
+    for shard in range(3):
+        coordinator = lock_functions.ConnectionCoordinator(shard, 3, use_locks=False)
+        claimed.append(coordinator.claim(connections))
+        # the assignment is stable
+        assert coordinator.claim(list(reversed(connections))) == list(reversed(claimed[-1]))
+    assert sorted(c.mergin_project for shard in claimed for c in shard) == sorted(c.mergin_project for c in connections)
+    assert all(claimed)
+
+
+def test_advisory_lock_takeover():
+    connections = [_connection(f"dbsync_shard_test_{i}") for i in range(6)]
+    first = lock_functions.ConnectionCoordinator(0, 2)
+    second = lock_functions.ConnectionCoordinator(1, 2)
+    try:
+        first_claimed = first.claim(connections)
+        second_claimed = second.claim(connections)
+        # each instance processes connections of its own shard only
+        assert {c.mergin_project for c in first_claimed} == set(first.owned)
+        assert {c.mergin_project for c in second_claimed} == set(second.owned)
+        assert len(first_claimed) + len(second_claimed) == len(connections)
+        first.release_borrowed()
+
+        # when the first instance dies, the second one takes over its connections and releases them after the cycle
+        first.close()
+        assert len(second.claim(connections)) == len(connections)
+        assert set(second.borrowed) == {c.mergin_project for c in first_claimed}
+        second.release_borrowed()
+
+        # when the first instance is back, it gets its connections back
+        assert first.claim(connections) == first_claimed
+        assert second.claim(connections) == second_claimed
+    finally:
+        first.close()
+        second.close()
+
+
+def test_connection_lock(tmp_path):
+    lock_file = str(tmp_path / "project.lock")
+    first = lock_functions.ConnectionLock(lock_file, DB_CONNINFO, "dbsync_lock_test_base")
+    second = lock_functions.ConnectionLock(lock_file, DB_CONNINFO, "dbsync_lock_test_base")
+    other = lock_functions.ConnectionLock(str(tmp_path / "other.lock"), DB_CONNINFO, "dbsync_lock_test_base")
+    try:
+        assert first.acquire(0)
+        # locked by the file lock (same working directory) as well as by the advisory lock (other hosts)
+        assert not second.acquire(0)
+        assert not other.acquire(0)
+        start = time.monotonic()
+        assert not second.acquire(1, poll_interval=0.1)
+        assert time.monotonic() - start >= 1
+
+        first.release()
+        assert second.acquire(0)
+    finally:
+        first.release()
+        second.release()
+        other.release()
+
+
+def test_connection_lock_cancel(tmp_path, monkeypatch):
+    # the advisory lock is held by another process
+    cursor = types.SimpleNamespace(execute=lambda query, args: None, fetchone=lambda: (False,))
+    monkeypatch.setattr(
+        psycopg2, "connect", lambda conn_info: types.SimpleNamespace(cursor=lambda: cursor, close=lambda: None)
+    )
+    lock = lock_functions.ConnectionLock(str(tmp_path / "project.lock"), "", "base")
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+
+    start = time.monotonic()
+    assert not lock.acquire(None, poll_interval=0.05, cancel=cancel)
+    assert time.monotonic() - start < 5
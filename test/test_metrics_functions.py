@@ -0,0 +1,114 @@
+import datetime
+import types
+import urllib.error
+import urllib.request
+
+import pytest
+from mergin import ClientError
+
+import dbsync
+import metrics_functions
+import timing_functions
+
+
+def test_render_metrics():
+    counter = metrics_functions.Counter("test_counter_total", "Test counter.", ["connection"])
+    histogram = metrics_functions.Histogram("test_duration_seconds", "Test histogram.", ["connection"], buckets=[1, 5])
+    try:
+        counter.inc(connection='ws/"project"')
+        counter.inc(2, connection='ws/"project"')
+        assert counter.value(connection='ws/"project"') == 3
+        assert counter.value(connection="ws/other") == 0
+        histogram.observe(0.5, connection="ws/project")
+        histogram.observe(3, connection="ws/project")
+
+        output = metrics_functions.render()
+        assert "# TYPE test_counter_total counter" in output
+        assert 'test_counter_total{connection="ws/\\"project\\""} 3.0' in output
+        assert "# TYPE test_duration_seconds histogram" in output
+        assert 'test_duration_seconds_bucket{connection="ws/project",le="1.0"} 1.0' in output
+        assert 'test_duration_seconds_bucket{connection="ws/project",le="5.0"} 2.0' in output
+        assert 'test_duration_seconds_bucket{connection="ws/project",le="+Inf"} 2.0' in output
+        assert 'test_duration_seconds_sum{connection="ws/project"} 3.5' in output
+        assert 'test_duration_seconds_count{connection="ws/project"} 2.0' in output
+
+        with pytest.raises(ValueError):
+            counter.inc(project="ws/project")
+    finally:
+        metrics_functions.registry.remove(counter)
+        metrics_functions.registry.remove(histogram)
+
+
+def test_operation_metrics():
+    with pytest.raises(RuntimeError):
+        with timing_functions.span("pull", connection="ws/failing"):
+            with metrics_functions.track_operation("pull", "ws/failing"):
+                with timing_functions.span("geodiff diff"):
+                    pass
+                raise RuntimeError()
+
+    metrics_functions.observe_changeset(
+        "ws/failing", "push", 1024, [{"table": "a", "insert": 1, "update": 2, "delete": 3}]
+    )
+
+    output = metrics_functions.render()
+    assert 'dbsync_errors_total{connection="ws/failing",operation="pull"} 1.0' in output
+    assert 'dbsync_sync_duration_seconds_count{connection="ws/failing",operation="pull"} 1.0' in output
+    assert 'dbsync_geodiff_duration_seconds_count{connection="ws/failing",subcommand="diff"} 1.0' in output
+    assert 'dbsync_changeset_bytes_total{connection="ws/failing",direction="push"} 1024.0' in output
+    assert 'dbsync_changeset_rows_total{connection="ws/failing",direction="push",type="delete"} 3.0' in output
+
+
+def test_metrics_http_server():
+    server = metrics_functions.start_http_server(0)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert b"# TYPE dbsync_errors_total counter" in response.read()
+
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/other")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_summary_quantiles():
+    summary = metrics_functions.Summary("test_latency_seconds", "Test summary.", ["connection"], max_samples=10)
+    try:
+        for value in range(1, 21):
+            summary.observe(value, connection="ws/project")
+
+        output = summary.render()
+        # only the 10 most recent observations are used for quantiles
+        assert 'test_latency_seconds{connection="ws/project",quantile="0.5"} 15.0' in output
+        assert 'test_latency_seconds{connection="ws/project",quantile="0.99"} 20.0' in output
+        assert 'test_latency_seconds_sum{connection="ws/project"} 210.0' in output
+        assert 'test_latency_seconds_count{connection="ws/project"} 20.0' in output
+    finally:
+        metrics_functions.registry.remove(summary)
+
+
+def test_pull_latency_failure_skips_metric(monkeypatch, caplog):
+    def project_versions(project_path, since, to):
+        raise ClientError("server unavailable")
+
+    conn_cfg = types.SimpleNamespace(mergin_project="ws/latency")
+    mc = types.SimpleNamespace(project_versions=project_versions)
+    applied_time = datetime.datetime.now(datetime.timezone.utc)
+
+    # the pull is already done, so only a warning gets logged
+    dbsync._observe_pull_latency(conn_cfg, mc, "ws/latency", "v1", "v3", applied_time)
+    assert "Unable to measure sync latency of pulled versions" in caplog.text
+    assert (
+        'dbsync_sync_latency_seconds_count{connection="ws/latency",direction="pull"}' not in metrics_functions.render()
+    )
+
+    mc.project_versions = lambda project_path, since, to: [
+        {"created": (applied_time - datetime.timedelta(seconds=10)).isoformat()} for _ in range(since, to + 1)
+    ]
+    dbsync._observe_pull_latency(conn_cfg, mc, "ws/latency", "v1", "v3", applied_time)
+    output = metrics_functions.render()
+    assert 'dbsync_sync_latency_seconds_count{connection="ws/latency",direction="pull"} 2' in output
+    assert 'dbsync_sync_latency_seconds_sum{connection="ws/latency",direction="pull"} 20.0' in output
@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import time
+
+import pytest
+from mergin import ClientError, LoginError, MerginClient, MerginProject
+from mergin.common import CHUNK_SIZE
+
+import client_functions
+import dbsync
+from benchmarks import dataset
+from benchmarks.mock_server import MockMerginServer
+from config import config
+
+ROWS = 500
+
+
+@pytest.fixture
+def mock_server():
+    server = MockMerginServer({"user": "secret"}).start()
+    yield server
+    server.stop()
+
+
+def _table_content(gpkg_path):
+    conn = sqlite3.connect(gpkg_path)
+    content = conn.execute("SELECT fid, name, value FROM table_0 ORDER BY fid").fetchall()
+    conn.close()
+    return content
+
+
+def test_login(mock_server):
+    with pytest.raises(LoginError):
+        MerginClient(mock_server.url, login="user", password="wrong")
+    mc = MerginClient(mock_server.url, login="user", password="secret")
+    assert mc.username() == "user"
+
+
+def test_stored_token(mock_server, tmp_path, monkeypatch):
+    if "MERGIN" not in config:
+        config.update({"MERGIN": {}})
+    monkeypatch.setitem(config.mergin, "URL", mock_server.url)
+    monkeypatch.setitem(config.mergin, "USERNAME", "user")
+    monkeypatch.setitem(config.mergin, "TOKEN_FILE", str(tmp_path / "token.json"))
+
+    def create_client(auth_token=None):
+        return MerginClient(mock_server.url, auth_token=auth_token, login="user", password="secret")
+
+    manager = client_functions.MerginClientManager(config, create_client)
+    manager.client()
+    manager.close()
+    assert len(mock_server.tokens) == 1
+
+    # restarted daemon uses the stored token without logging in
+    manager = client_functions.MerginClientManager(config, create_client)
+    assert manager.client().user_info()["username"] == "user"
+    manager.close()
+    assert len(mock_server.tokens) == 1
+
+    # ... unless it was revoked
+    mock_server.tokens.clear()
+    manager = client_functions.MerginClientManager(config, create_client)
+    assert manager.client().user_info()["username"] == "user"
+    manager.close()
+    assert len(mock_server.tokens) == 1
+
+
+def test_push_pull_with_diffs(mock_server, tmp_path):
+    mc = MerginClient(mock_server.url, login="user", password="secret")
+    mc.create_project("workspace/project")
+    field_dir = str(tmp_path / "field")
+    office_dir = str(tmp_path / "office")
+
+    mc.download_project("workspace/project", field_dir)
+    dataset.create_gpkg(os.path.join(field_dir, "data.gpkg"), ROWS)
+    mc.push_project(field_dir)
+    mc.download_project("workspace/project", office_dir)
+    assert _table_content(os.path.join(office_dir, "data.gpkg")) == _table_content(os.path.join(field_dir, "data.gpkg"))
+
+    dataset.edit_gpkg(os.path.join(field_dir, "data.gpkg"), ROWS, 1, 0.1)
+    mc.push_project(field_dir)
+
+    info = mc.project_info("workspace/project", since="v1")
+    assert info["version"] == "v2"
+    assert "diff" in info["files"][0]["history"]["v2"]
+
+    mc.pull_project(office_dir)
+    assert _table_content(os.path.join(office_dir, "data.gpkg")) == _table_content(os.path.join(field_dir, "data.gpkg"))
+
+    projects = mc.get_projects_by_names(["workspace/project", "workspace/missing"])
+    assert projects["workspace/project"]["version"] == "v2"
+    assert projects["workspace/project"]["id"] == info["id"]
+    assert projects["workspace/missing"] == {"error": 404}
+    assert [v["name"] for v in mc.project_versions("workspace/project", since=1)] == ["v1", "v2"]
+
+    # pushing from outdated copy of the project fails
+    dataset.edit_gpkg(os.path.join(office_dir, "data.gpkg"), ROWS, 1, 0.1)
+    mc.push_project(office_dir)
+    dataset.edit_gpkg(os.path.join(field_dir, "data.gpkg"), ROWS, 1, 0.1)
+    with pytest.raises(ClientError):
+        mc.push_project(field_dir)
+
+    mc.delete_project_now("workspace/project")
+    with pytest.raises(ClientError):
+        mc.project_info("workspace/project")
+
+
+def test_latency_and_bandwidth(mock_server, tmp_path):
+    mc = MerginClient(mock_server.url, login="user", password="secret")
+    mc.create_project("workspace/project")
+    mc.download_project("workspace/project", str(tmp_path / "a"))
+    with open(tmp_path / "a" / "data.bin", "wb") as f:
+        f.write(b"x" * 100000)
+    mc.push_project(str(tmp_path / "a"))
+
+    mock_server.latency = 0.2
+    start = time.perf_counter()
+    mc.project_info("workspace/project")
+    assert time.perf_counter() - start >= 0.2
+
+    mock_server.latency = 0.0
+    mock_server.bandwidth = 500000
+    start = time.perf_counter()
+    mc.download_project("workspace/project", str(tmp_path / "b"))
+    assert time.perf_counter() - start >= 0.2
+    with open(tmp_path / "b" / "data.bin", "rb") as f:
+        assert f.read() == b"x" * 100000
+
+
+def test_download_files(mock_server, tmp_path):
+    # dbsync downloads files using internals of the client - make sure they work with the pinned client version
+    mc = MerginClient(mock_server.url, login="user", password="secret")
+    mc.create_project("workspace/project")
+    project_dir = str(tmp_path / "project")
+    mc.download_project("workspace/project", project_dir)
+    contents = {"large.bin": os.urandom(CHUNK_SIZE + 1000), "small.txt": b"small file"}
+    for path, content in contents.items():
+        with open(os.path.join(project_dir, path), "wb") as f:
+            f.write(content)
+    mc.push_project(project_dir)
+
+    mp = MerginProject(project_dir)
+    for path in contents:
+        with open(os.path.join(project_dir, path), "wb") as f:
+            f.write(b"local change")
+    dbsync._download_files(mc, mp, mp.files(), mp.version())
+
+    for path, content in contents.items():
+        with open(os.path.join(project_dir, path), "rb") as f:
+            assert f.read() == content
+    assert not any(mp.get_push_changes().values())
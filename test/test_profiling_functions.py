@@ -0,0 +1,35 @@
+import logging
+import pstats
+
+import profiling_functions
+
+
+def test_profile_cycles(tmp_path):
+    profiling_functions.start_profiling(2, str(tmp_path))
+
+    for _ in range(3):
+        with profiling_functions.profile("workspace/project"):
+            sum(range(1000))
+        profiling_functions.end_cycle()
+
+    profile_file = tmp_path / "workspace_project.pstats"
+    assert profile_file.exists()
+    stats = pstats.Stats(str(profile_file))
+    assert stats.total_calls > 0
+    # profiling stops after the given number of cycles
+    assert profiling_functions.profile_cycles_left == 0
+    assert profiling_functions.profilers == {}
+
+
+def test_log_memory_diff(caplog):
+    profiling_functions.start_memory_tracing()
+    try:
+        with caplog.at_level(logging.INFO):
+            profiling_functions.log_memory_diff()
+            data = [bytearray(1024) for _ in range(100)]
+            profiling_functions.log_memory_diff()
+        assert "Traced memory" in caplog.text
+        assert "Memory diff" in caplog.text
+        assert data
+    finally:
+        profiling_functions.tracemalloc.stop()
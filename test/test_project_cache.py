@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import uuid
+
+import pytest
+
+import dbsync
+from config import config
+from dbsync import DbSyncError, _get_mergin_project, _validate_local_project_id, cached_mergin_project_objects
+
+
+def _create_project_dir(path, version, project_id=None):
+    os.makedirs(os.path.join(path, ".mergin"), exist_ok=True)
+    metadata = {"name": "project", "namespace": "workspace", "version": version, "files": []}
+    if project_id:
+        metadata["id"] = project_id
+    with open(os.path.join(path, ".mergin", "mergin.json"), "w") as f:
+        json.dump(metadata, f)
+    return str(path)
+
+
+def test_project_cache_metadata_reload(tmp_path):
+    work_path = _create_project_dir(tmp_path / "project", "v1")
+    try:
+        mp = _get_mergin_project(work_path)
+        assert mp.version() == "v1"
+
+        # metadata written by somebody else (e.g. by the client on pull) get re-read
+        _create_project_dir(tmp_path / "project", "v10")
+        assert _get_mergin_project(work_path) is mp
+        assert mp.version() == "v10"
+    finally:
+        dbsync._forget_mergin_project(work_path)
+
+
+@pytest.fixture
+def mergin_config(monkeypatch):
+    """Allows changing settings in the `mergin` section of the config just for the test"""
+    if "MERGIN" not in config:
+        config.update({"MERGIN": {}})
+    return lambda key, value: monkeypatch.setitem(config.mergin, key, value)
+
+
+def test_project_cache_eviction(tmp_path, mergin_config):
+    mergin_config("project_cache_size", 2)
+    work_paths = [_create_project_dir(tmp_path / f"project{i}", "v1") for i in range(3)]
+    try:
+        mp0 = _get_mergin_project(work_paths[0])
+        _get_mergin_project(work_paths[1])
+        _get_mergin_project(work_paths[0])  # project0 becomes the most recently used
+        _get_mergin_project(work_paths[2])
+
+        assert list(cached_mergin_project_objects) == [work_paths[0], work_paths[2]]
+        assert mp0.geodiff is not None
+
+        _get_mergin_project(work_paths[1])
+        assert list(cached_mergin_project_objects) == [work_paths[2], work_paths[1]]
+        # evicted project has geodiff and log file released
+        assert mp0.geodiff is None
+        assert not [h for h in mp0.log.handlers if isinstance(h, logging.FileHandler)]
+    finally:
+        for work_path in work_paths:
+            dbsync._forget_mergin_project(work_path)
+
+
+def test_project_cache_eviction_in_use(tmp_path, mergin_config):
+    mergin_config("project_cache_size", 1)
+    work_paths = [_create_project_dir(tmp_path / f"project{i}", "v1") for i in range(2)]
+    try:
+        with dbsync._use_mergin_project(work_paths[0]):
+            mp0 = _get_mergin_project(work_paths[0])
+            # another thread needs another project - the one being used is evicted but not closed
+            _get_mergin_project(work_paths[1])
+            assert list(cached_mergin_project_objects) == [work_paths[1]]
+            assert mp0.geodiff is not None
+            assert _get_mergin_project(work_paths[0]) is mp0
+            _get_mergin_project(work_paths[1])
+        # closed once it is no longer used
+        assert mp0.geodiff is None
+    finally:
+        for work_path in work_paths:
+            dbsync._forget_mergin_project(work_path)
+
+
+class ProjectInfoClient:
+    """Client answering project info requests with a fixed project ID"""
+
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self.requests = 0
+
+    def project_info(self, project_path):
+        self.requests += 1
+        return {"id": self.project_id}
+
+
+def test_validated_project_id_cache(tmp_path, mergin_config, monkeypatch):
+    project_id = str(uuid.uuid4())
+    work_path = _create_project_dir(tmp_path / "project", "v1", project_id)
+    mc = ProjectInfoClient(project_id)
+    try:
+        mp = _get_mergin_project(work_path)
+
+        # project ID from the version query does not need another request
+        _validate_local_project_id(mp, mc, {"id": project_id, "version": "v1"})
+        assert mc.requests == 0
+
+        # validated project ID is cached
+        _validate_local_project_id(mp, mc)
+        assert mc.requests == 0
+
+        # ... until it expires
+        mergin_config("project_id_check_interval", 0)
+        _validate_local_project_id(mp, mc, {"id": project_id, "version": "v1"})
+        assert mc.requests == 0
+        _validate_local_project_id(mp, mc)
+        assert mc.requests == 1
+        monkeypatch.delitem(config.mergin, "project_id_check_interval")
+        _validate_local_project_id(mp, mc)
+        assert mc.requests == 2
+        _validate_local_project_id(mp, mc)
+        assert mc.requests == 2
+
+        # ... or until the working directory is removed
+        dbsync._forget_mergin_project(work_path)
+        mp = _get_mergin_project(work_path)
+        _validate_local_project_id(mp, mc)
+        assert mc.requests == 3
+
+        with pytest.raises(DbSyncError, match="does not match the server project ID"):
+            _validate_local_project_id(mp, mc, {"id": str(uuid.uuid4()), "version": "v1"})
+    finally:
+        dbsync._forget_mergin_project(work_path)
+
+
+def test_project_metadata_reload_after_client_write(tmp_path):
+    work_path = _create_project_dir(tmp_path / "project", "v1")
+    try:
+        mp = _get_mergin_project(work_path)
+        metadata_file = os.path.join(work_path, ".mergin", "mergin.json")
+        stat = os.stat(metadata_file)
+        # rewrite of the same size within the resolution of modification times
+        _create_project_dir(tmp_path / "project", "v2")
+        os.utime(metadata_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        assert _get_mergin_project(work_path).version() == "v1"
+
+        dbsync._reload_mergin_project_metadata(work_path)
+        assert _get_mergin_project(work_path) is mp
+        assert mp.version() == "v2"
+    finally:
+        dbsync._forget_mergin_project(work_path)
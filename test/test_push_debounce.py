@@ -0,0 +1,66 @@
+import types
+
+import changeset_functions
+import dbsync
+from dbsync import _should_defer_push, pending_push_changes
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _connection(**settings):
+    return types.SimpleNamespace(mergin_project="ws/project", get=lambda key, default=None: settings.get(key, default))
+
+
+def _write_changeset(path, edit):
+    """Writes changeset (in the binary format of SQLite session extension) inserting a row with the given ID"""
+    path.write_bytes(b"T\x01\x01edits\x00" + bytes([changeset_functions.OP_INSERT, 0, 1]) + edit.to_bytes(8, "big"))
+
+
+def test_defer_push_until_quiet(tmp_path, monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(dbsync.time, "monotonic", clock)
+    changeset = tmp_path / "changeset"
+    conn_cfg = _connection(push_quiet_time=30, push_max_delay=100)
+    try:
+        _write_changeset(changeset, 1)
+        assert _should_defer_push(conn_cfg, str(changeset))
+        clock.now += 20
+        _write_changeset(changeset, 2)
+        assert _should_defer_push(conn_cfg, str(changeset))
+        clock.now += 20
+        assert _should_defer_push(conn_cfg, str(changeset))
+        # no new edits for 30 seconds
+        clock.now += 10
+        assert not _should_defer_push(conn_cfg, str(changeset))
+    finally:
+        pending_push_changes.clear()
+
+
+def test_defer_push_max_delay(tmp_path, monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(dbsync.time, "monotonic", clock)
+    changeset = tmp_path / "changeset"
+    conn_cfg = _connection(push_quiet_time=30, push_max_delay=100)
+    try:
+        # changes keep coming, but they get pushed once they wait for `push_max_delay` seconds
+        for i in range(10):
+            _write_changeset(changeset, i)
+            assert _should_defer_push(conn_cfg, str(changeset))
+            clock.now += 10
+        _write_changeset(changeset, 10)
+        assert not _should_defer_push(conn_cfg, str(changeset))
+    finally:
+        pending_push_changes.clear()
+
+
+def test_no_debounce_by_default(tmp_path):
+    changeset = tmp_path / "changeset"
+    _write_changeset(changeset, 1)
+    assert not _should_defer_push(_connection(), str(changeset))
+    assert not pending_push_changes
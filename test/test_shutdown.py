@@ -0,0 +1,48 @@
+import os
+import signal
+import time
+import types
+
+import pytest
+
+import control_functions
+import dbsync
+import dbsync_daemon
+from config import config
+
+
+@pytest.fixture
+def restore_signal_handlers():
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+    dbsync.stop_requested.clear()
+
+
+def test_no_connections_processed_after_stop(restore_signal_handlers):
+    dbsync.stop_requested.set()
+    connection = types.SimpleNamespace(mergin_project="ws/project")
+    # would fail without a Mergin Maps client if the connection got processed
+    dbsync.dbsync_pull(None, [connection])
+    dbsync.dbsync_push(None, [connection])
+
+
+def test_graceful_shutdown(restore_signal_handlers):
+    scheduler = control_functions.SyncScheduler(["ws/project"])
+    config.update({"DAEMON": {"sleep_time": 10, "shutdown_timeout": 0.5}})
+    try:
+        dbsync_daemon.install_signal_handlers(scheduler)
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert dbsync.stop_requested.is_set()
+        start = time.monotonic()
+        assert scheduler.wait(10) == {}
+        assert time.monotonic() - start < 5
+        assert scheduler.status()["state"] == "stopping"
+
+        # work still running after the shutdown timeout gets interrupted
+        with pytest.raises(SystemExit):
+            time.sleep(10)
+        assert time.monotonic() - start < 5
+    finally:
+        config.unset("DAEMON", force=True)
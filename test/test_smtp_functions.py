@@ -0,0 +1,120 @@
+import logging
+import smtplib
+import time
+
+import pytest
+
+import smtp_functions
+from config import config
+
+
+class _FakeSMTP:
+    def __init__(self, sent, failures):
+        self.sent = sent
+        self.failures = failures
+
+    def sendmail(self, sender, recipients, message):
+        if self.failures:
+            self.failures.pop()
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        self.sent.append(message)
+
+    def quit(self):
+        pass
+
+
+@pytest.fixture
+def smtp(monkeypatch):
+    sent, failures, connections = [], [], []
+
+    def connect(config):
+        connections.append(_FakeSMTP(sent, failures))
+        return connections[-1]
+
+    monkeypatch.setattr(smtp_functions, "create_connection_and_log_user", connect)
+    config.update(
+        {
+            "NOTIFICATION": {
+                "smtp_server": "server",
+                "email_sender": "dbsync@info.com",
+                "email_subject": "DB Sync Error",
+                "email_recipients": ["recipient1@test.com"],
+                "minimal_email_interval": 1,
+            }
+        }
+    )
+    yield sent, failures, connections
+    config.unset("NOTIFICATION", force=True)
+
+
+def _wait_for(condition, timeout=5):
+    start = time.monotonic()
+    while not condition() and time.monotonic() - start < timeout:
+        time.sleep(0.01)
+
+
+def test_notifications_digest(smtp):
+    sent, failures, connections = smtp
+    notifier = smtp_functions.EmailNotifier(config)
+    try:
+        notifier.notify("pull failed", "ws/a")
+        _wait_for(lambda: len(sent) == 1)
+        assert "ws/a: 1 error(s)" in sent[0] and "pull failed" in sent[0]
+
+        # errors of a connection that already got an email wait for the interval, other connections are not affected
+        notifier.notify("push failed", "ws/a")
+        notifier.notify("push failed again", "ws/a")
+        notifier.notify("pull failed", "ws/b")
+        _wait_for(lambda: len(sent) == 2)
+        time.sleep(0.1)
+        assert len(sent) == 2
+        assert "ws/b: 1 error(s)" in sent[1] and "ws/a" not in sent[1]
+
+        # errors collected in the meantime are sent together once the interval passes
+        notifier.interval = 0.5
+        notifier.notify("push failed once more", "ws/a")
+        _wait_for(lambda: len(sent) == 3)
+        assert "ws/a: 3 error(s)" in sent[2] and "push failed again" in sent[2]
+        # the connection to the SMTP server got reused
+        assert len(connections) == 1
+    finally:
+        notifier.stop(5)
+
+
+def test_notifications_retry(smtp, caplog):
+    sent, failures, connections = smtp
+    notifier = smtp_functions.EmailNotifier(config)
+    notifier.retry_delays = (0.01, 0.01)
+    try:
+        failures.extend([True, True])
+        notifier.notify("pull failed", "ws/a")
+        _wait_for(lambda: len(sent) == 1)
+        assert len(sent) == 1
+        assert len(connections) == 3
+
+        # the error gets dropped when all retries fail
+        failures.extend([True, True, True, True])
+        with caplog.at_level(logging.WARNING):
+            notifier.notify("pull failed", "ws/b")
+            time.sleep(0.2)
+        assert len(sent) == 1
+        # ... but its content is logged
+        undelivered = [r for r in caplog.records if r.getMessage().startswith("Undelivered notification email")]
+        assert len(undelivered) == 1
+        assert undelivered[0].levelno == logging.WARNING
+        assert "ws/b: 1 error(s)" in undelivered[0].getMessage()
+    finally:
+        notifier.stop(5)
+
+
+def test_smtp_timeout(monkeypatch):
+    connections = []
+    monkeypatch.setattr(smtplib, "SMTP", lambda *args, **kwargs: connections.append(kwargs))
+    config.update({"NOTIFICATION": {"smtp_server": "server", "smtp_username": None}})
+    try:
+        smtp_functions.create_connection_and_log_user(config)
+        config.update({"NOTIFICATION": {"smtp_server": "server", "smtp_username": None, "smtp_timeout": 5}})
+        smtp_functions.create_connection_and_log_user(config)
+    finally:
+        config.unset("NOTIFICATION", force=True)
+    assert connections == [{"timeout": smtp_functions.DEFAULT_SMTP_TIMEOUT}, {"timeout": 5}]
@@ -0,0 +1,200 @@
+import datetime
+import os
+import types
+
+import psycopg2
+import pytest
+
+import dbsync
+from dbsync import (
+    _get_change_capture_names,
+    _get_file_fingerprint,
+    _get_unchanged_init_data,
+    _get_unchanged_tables,
+    _group_db_tables,
+    _split_tables,
+    _store_clean_table_stats,
+    clean_table_stats,
+    full_compare_times,
+    ready_change_capture,
+)
+
+
+def test_unchanged_tables(monkeypatch):
+    settings = {}
+    conn_cfg = types.SimpleNamespace(
+        mergin_project="ws/project", get=lambda key, default=None: settings.get(key, default)
+    )
+    now = 1000.0
+    monkeypatch.setattr(dbsync.time, "monotonic", lambda: now)
+    stats = {"a": (1001, 10, 2, 0, 10, None), "b": (1002, 5, 0, 1, 4, None), "c": (1003, 0, 0, 0, 0, None)}
+    try:
+        # nothing is known before the first sync
+        assert _get_unchanged_tables(conn_cfg, stats) == []
+
+        # only a full compare makes skipping tables possible
+        _store_clean_table_stats(conn_cfg, stats, now, False)
+        assert _get_unchanged_tables(conn_cfg, stats) == []
+        _store_clean_table_stats(conn_cfg, stats, now, True)
+        assert _get_unchanged_tables(conn_cfg, stats) == ["a", "b", "c"]
+
+        changed = {
+            "a": (1001, 11, 2, 0, 11, None),  # inserted row
+            "b": (1002, 5, 0, 1, 4, None),
+            "c": (1004, 0, 0, 0, 0, None),  # table re-created
+            "d": (1005, 0, 0, 0, 0, None),  # new table
+        }
+        assert _get_unchanged_tables(conn_cfg, changed) == ["b"]
+
+        # reset of statistics of the database
+        reset = {table: (*values[:-1], datetime.datetime(2024, 1, 1)) for table, values in stats.items()}
+        assert _get_unchanged_tables(conn_cfg, reset) == []
+
+        # all tables get compared periodically
+        now += dbsync.DEFAULT_FULL_COMPARE_INTERVAL
+        assert _get_unchanged_tables(conn_cfg, stats) == []
+        settings["full_compare_interval"] = 0
+        assert _get_unchanged_tables(conn_cfg, stats) == ["a", "b", "c"]
+        settings["full_compare_interval"] = 600
+        assert _get_unchanged_tables(conn_cfg, stats) == []
+    finally:
+        clean_table_stats.clear()
+        full_compare_times.clear()
+
+
+def test_split_tables():
+    sizes = {"big": 1000, "medium": 600, "small_1": 300, "small_2": 200, "tiny": 10}
+    groups = _split_tables(sizes, 2)
+    assert groups == [["big", "tiny"], ["medium", "small_1", "small_2"]]
+    assert sorted(t for group in _split_tables(sizes, 3) for t in group) == sorted(sizes)
+    assert _split_tables(sizes, 5) == [[t] for t in ["big", "medium", "small_1", "small_2", "tiny"]]
+
+
+def test_group_db_tables():
+    base = {"big": (1000, None), "deleted": (500, None), "ignored": (900, None)}
+    modified = {
+        "big": (1000, None),
+        "ignored": (900, None),
+        "measurements": (0, None),
+        "measurements_2023": (400, "measurements"),
+        "measurements_2024": (300, "measurements"),
+        "new": (100, None),
+    }
+    groups = _group_db_tables([base, modified], ["ignored"], 3)
+    assert groups == [["big"], ["measurements", "measurements_2023", "measurements_2024"], ["deleted", "new"]]
+
+    # every table is compared exactly once, including tables existing only in one of the schemas
+    tables = [table for group in groups for table in group]
+    assert sorted(tables) == sorted((set(base) | set(modified)) - {"ignored"})
+
+    assert _group_db_tables([base, modified], ["ignored"], 8) == [
+        ["big"],
+        ["measurements", "measurements_2023", "measurements_2024"],
+        ["deleted"],
+        ["new"],
+    ]
+    assert _group_db_tables([{}, {}], [], 4) == []
+
+
+def test_change_capture_names():
+    slot, publication = _get_change_capture_names(types.SimpleNamespace(base="Project-Base"))
+    assert slot == publication
+    assert slot.startswith("dbsync_project_base_")
+    assert slot != _get_change_capture_names(types.SimpleNamespace(base="project_base"))[0]
+    assert len(_get_change_capture_names(types.SimpleNamespace(base="x" * 100))[0]) <= 63
+
+
+def test_change_capture_set_up_once(monkeypatch):
+    def connect(conn_info):
+        raise psycopg2.OperationalError("connection refused")
+
+    monkeypatch.setattr(psycopg2, "connect", connect)
+    conn_cfg = types.SimpleNamespace(mergin_project="ws/logical", base="base", modified="modified", conn_info="")
+    with pytest.raises(dbsync.DbSyncError, match="Unable to set up logical replication slot"):
+        dbsync._ensure_change_capture(conn_cfg)
+
+    # once set up, pushes do not check the publication and the slot again
+    ready_change_capture.add("ws/logical")
+    try:
+        dbsync._ensure_change_capture(conn_cfg)
+        # ... unless reading of the slot fails
+        with pytest.raises(dbsync.DbSyncError, match="Unable to read changes"):
+            dbsync._get_logical_changes(conn_cfg)
+        assert "ws/logical" not in ready_change_capture
+    finally:
+        ready_change_capture.discard("ws/logical")
+
+
+def test_unchanged_init_data():
+    fingerprint = {
+        "version": "v3",
+        "gpkg": [1024, 1700000000000000000],
+        "base": {"a": ["c1", 16384, 10, 2, 0]},
+        "modified": {"a": ["c1", 16390, 12, 3, 1]},
+    }
+    # nothing was stored by older versions
+    assert _get_unchanged_init_data({"name": "ws/project", "version": "v3"}, fingerprint) == (False, False)
+
+    assert _get_unchanged_init_data({"fingerprint": fingerprint}, fingerprint) == (True, True)
+    assert _get_unchanged_init_data({"fingerprint": {**fingerprint, "modified": None}}, fingerprint) == (True, False)
+    for key, value in (
+        ("version", "v4"),
+        ("gpkg", [1024, 1700000000000000001]),
+        ("base", {"a": ["c1", 16384, 11, 2, 0]}),
+        ("base", {"a": ["c1", 16400, 10, 2, 0]}),
+    ):
+        assert _get_unchanged_init_data({"fingerprint": {**fingerprint, key: value}}, fingerprint) == (False, False)
+
+    # without counters of changed rows (`track_counts` is off) nothing is known
+    unknown = {**fingerprint, "base": None, "modified": None}
+    assert _get_unchanged_init_data({"fingerprint": unknown}, unknown) == (False, False)
+
+
+def test_file_fingerprint(tmp_path):
+    path = tmp_path / "data.gpkg"
+    path.write_bytes(b"abc")
+    fingerprint = _get_file_fingerprint(path)
+    assert fingerprint == _get_file_fingerprint(path)
+
+    # a rewrite of the same size changes the modification time
+    stat = os.stat(path)
+    path.write_bytes(b"abd")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert _get_file_fingerprint(path) != fingerprint
+
+
+def test_push_without_changes(monkeypatch):
+    conn_cfg = types.SimpleNamespace(mergin_project="ws/project", base="project_base")
+    confirmed = []
+    monkeypatch.setattr(dbsync, "_confirm_logical_changes", lambda conn_cfg, lsn: confirmed.append(lsn))
+    stats = {"a": (1001, 10, 2, 0, 10, None)}
+    dbsync.pending_push_changes["ws/project"] = ("digest", 0, 0)
+    try:
+        # a push skipped because no table changed forgets deferred changes like a push of an empty changeset
+        dbsync._finish_push(conn_cfg, stats, 1000.0, False, "0/16B3748")
+        assert "ws/project" not in dbsync.pending_push_changes
+        assert clean_table_stats["ws/project"] == stats
+        assert "ws/project" not in full_compare_times
+        assert confirmed == ["0/16B3748"]
+    finally:
+        clean_table_stats.clear()
+        full_compare_times.clear()
+        dbsync.pending_push_changes.clear()
+
+    comments = []
+    stored = {"name": "ws/project", "version": "v3", "project_id": "id", "fingerprint": {"version": "v3"}}
+    monkeypatch.setattr(dbsync, "_get_db_project_comment", lambda conn, schema: stored)
+    monkeypatch.setattr(dbsync, "_set_db_project_comment", lambda *args, **kwargs: comments.append((args, kwargs)))
+    fingerprint = {"a": ["md5", 16384, 10, 2, 0]}
+    dbsync._store_modified_fingerprint(None, conn_cfg, fingerprint)
+    assert comments == [
+        (
+            (None, "project_base", "ws/project", "v3", "id"),
+            {"fingerprint": {"version": "v3", "modified": fingerprint}},
+        )
+    ]
+
+    # nothing gets written if the stored fingerprint is the same
+    stored["fingerprint"]["modified"] = fingerprint
+    dbsync._store_modified_fingerprint(None, conn_cfg, fingerprint)
+    assert len(comments) == 1
@@ -0,0 +1,67 @@
+import subprocess
+import sys
+import threading
+import time
+
+import timing_functions
+
+
+def test_span_records():
+    timing_functions.start_cycle()
+
+    with timing_functions.span("pull", connection="workspace/project"):
+        with timing_functions.span("geodiff diff"):
+            subprocess.run([sys.executable, "-c", "pass"])
+
+    assert [r["phase"] for r in timing_functions.records] == ["geodiff diff", "pull"]
+    for record in timing_functions.records:
+        assert record["connection"] == "workspace/project"
+        assert record["wall_time"] >= 0
+        assert record["cpu_time"] >= 0
+    assert timing_functions.current_connection() is None
+    max_rss = timing_functions.children_max_rss()
+    assert max_rss is None or max_rss > 0
+
+    summary = timing_functions.cycle_summary()
+    assert summary.startswith("Cycle timing: ")
+    assert "geodiff diff" in summary
+    assert "pull" in summary
+
+    timing_functions.start_cycle()
+    assert timing_functions.records == []
+    assert timing_functions.cycle_summary() == "Cycle timing: no phases recorded"
+
+
+def test_span_listeners():
+    received = []
+    timing_functions.span_listeners.append(received.append)
+    try:
+        try:
+            with timing_functions.span("push", connection="workspace/project"):
+                raise ValueError()
+        except ValueError:
+            pass
+    finally:
+        timing_functions.span_listeners.remove(received.append)
+
+    assert len(received) == 1
+    assert received[0]["phase"] == "push"
+    assert received[0]["connection"] == "workspace/project"
+
+
+def test_span_cpu_time_of_thread():
+    timing_functions.start_cycle()
+
+    def busy():
+        end = time.perf_counter() + 0.3
+        while time.perf_counter() < end:
+            pass
+
+    with timing_functions.span("waiting"):
+        thread = threading.Thread(target=busy)
+        thread.start()
+        thread.join()
+
+    # CPU time used by other threads is not attributed to the span
+    assert timing_functions.records[0]["cpu_time"] < 0.15
+    timing_functions.start_cycle()
@@ -0,0 +1,106 @@
+"""
+Mergin Maps DB Sync - a tool for two-way synchronization between Mergin Maps and a PostGIS database
+
+Copyright (C) 2024 Lutra Consulting
+
+License: MIT
+"""
+
+import contextlib
+import logging
+import threading
+import time
+import typing
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+# Records of finished spans in the current sync cycle. Each record is a dictionary:
+#   { 'connection': 'workspace/project', 'phase': 'geodiff diff', 'start': 1700000000.0,
+#     'wall_time': 1.2, 'cpu_time': 0.9 }
+# where times are in seconds and 'cpu_time' is CPU time of the thread running the span (spans of other threads
+# running at the same time are not included, neither are child processes, e.g. geodiff).
+records = []
+
+# Callables that get each finished span record - used by exporters (e.g. metrics)
+span_listeners = []
+
+_records_lock = threading.Lock()
+_current = threading.local()
+
+
+def children_max_rss() -> typing.Optional[int]:
+    """
+    Returns peak resident set size (in kilobytes) of the largest child process (e.g. geodiff) since the start
+    of this process, or None if it is not available on the platform. It never decreases, so it can not be
+    attributed to spans.
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+def current_connection() -> typing.Optional[str]:
+    """Returns name of the connection (Mergin Maps project) being processed in this thread"""
+    return getattr(_current, "connection", None)
+
+
+@contextlib.contextmanager
+def span(phase: str, connection: str = None):
+    """Measures wall time and CPU time (of this thread) of the code in the `with` block and stores the record.
+    If connection is given, it is also used for all spans nested in this one, otherwise the connection
+    of the enclosing span is used."""
+    previous_connection = current_connection()
+    if connection is not None:
+        _current.connection = connection
+    start = time.time()
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield
+    finally:
+        record = {
+            "connection": current_connection(),
+            "phase": phase,
+            "start": start,
+            "wall_time": time.perf_counter() - wall_start,
+            "cpu_time": time.thread_time() - cpu_start,
+        }
+        _current.connection = previous_connection
+        with _records_lock:
+            records.append(record)
+        for listener in span_listeners:
+            try:
+                listener(record)
+            except Exception:
+                logging.exception("Failed to process timing record")
+
+
+def start_cycle() -> None:
+    """Forgets records of the previous sync cycle"""
+    with _records_lock:
+        records.clear()
+
+
+def cycle_summary() -> str:
+    """Returns a one-line summary of time spent in phases of the current sync cycle"""
+    with _records_lock:
+        cycle_records = list(records)
+
+    phases = {}
+    for record in cycle_records:
+        wall_time, cpu_time, count = phases.get(record["phase"], (0.0, 0.0, 0))
+        phases[record["phase"]] = (wall_time + record["wall_time"], cpu_time + record["cpu_time"], count + 1)
+
+    items = []
+    for phase, (wall_time, cpu_time, count) in sorted(phases.items(), key=lambda item: -item[1][0]):
+        items.append(f"{phase} {wall_time:.2f}s (cpu {cpu_time:.2f}s, {count}x)")
+
+    max_rss = children_max_rss()
+    if items and max_rss is not None:
+        items.append(f"children peak RSS since start {max_rss} kB")
+
+    return "Cycle timing: " + (", ".join(items) if items else "no phases recorded")